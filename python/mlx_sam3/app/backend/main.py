@@ -4,16 +4,19 @@ Provides endpoints for image upload, text prompts, box prompts, and segmentation
 """
 
 import io
+import json
 import os
 import sys
 import time
 import uuid
 from contextlib import asynccontextmanager
+from typing import Optional
 
 import mlx.core as mx
 import numpy as np
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from PIL import Image
 from pydantic import BaseModel
 
@@ -23,6 +26,21 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspa
 import sam3
 from sam3 import build_sam3_image_model
 from sam3.model.sam3_image_processor import Sam3Processor
+from sam3.serving import (
+    AdmissionController,
+    Deadline,
+    ModelWorker,
+    ResultCache,
+    ServingError,
+    SingleFlight,
+    content_hash,
+    encode_fields,
+    encode_member,
+    json_object,
+    normalize_box_prompts,
+    normalize_outputs,
+    normalize_text_prompt,
+)
 
 # Global model and processor
 model = None
@@ -31,6 +49,24 @@ processor = None
 # Session storage for processing states
 sessions: dict = {}
 
+# Encoded segmentation results keyed by (image hash, prompts, threshold)
+RESULT_CACHE_BYTES = 256 * 1024 * 1024
+result_cache = ResultCache(max_bytes=RESULT_CACHE_BYTES)
+
+# All model work runs on one thread; identical concurrent requests share it
+model_worker = ModelWorker()
+inflight = SingleFlight()
+
+# Bounds the model work admitted at once by predicted memory and queue depth
+admission = AdmissionController()
+
+# Seconds a request may take unless it sends an X-Request-Timeout-Ms header
+REQUEST_TIMEOUT_S = 120.0
+
+# Results a segment request may select with `outputs`, and the default selection
+RESPONSE_OUTPUTS = ("boxes", "scores", "masks", "semantic_seg")
+DEFAULT_OUTPUTS = ("boxes", "scores", "masks")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -50,6 +86,8 @@ async def lifespan(app: FastAPI):
     
     # Cleanup
     sessions.clear()
+    result_cache.clear()
+    model_worker.shutdown()
 
 
 app = FastAPI(
@@ -72,12 +110,14 @@ app.add_middleware(
 class TextPromptRequest(BaseModel):
     session_id: str
     prompt: str
+    outputs: Optional[list[str]] = None  # subset of RESPONSE_OUTPUTS
 
 
 class BoxPromptRequest(BaseModel):
     session_id: str
     box: list[float]  # [center_x, center_y, width, height] normalized
     label: bool  # True for positive, False for negative
+    outputs: Optional[list[str]] = None  # subset of RESPONSE_OUTPUTS
 
 
 class ConfidenceRequest(BaseModel):
@@ -130,17 +170,10 @@ def serialize_state(state: dict) -> dict:
     
     if "masks" in state:
         masks = state["masks"]
-        boxes = state["boxes"]
-        scores = state["scores"]
-        
         masks_list = []
-        boxes_list = []
-        scores_list = []
-        
-        for i in range(len(scores)):
+        # One full-size mask at a time, see LazyMasks
+        for i in range(len(masks)):
             mask_np = np.array(masks[i])
-            box_np = np.array(boxes[i])
-            score_np = float(np.array(scores[i]))
             
             # Convert mask to binary and get the 2D mask (handle [1, H, W] shape)
             mask_binary = (mask_np > 0.5).astype(np.uint8)
@@ -148,14 +181,24 @@ def serialize_state(state: dict) -> dict:
                 mask_binary = mask_binary[0]  # Take first channel
             
             # Encode as RLE
-            rle = mask_to_rle(mask_binary)
-            masks_list.append(rle)
-            boxes_list.append(box_np.tolist())
-            scores_list.append(score_np)
-        
+            masks_list.append(mask_to_rle(mask_binary))
         result["masks"] = masks_list
-        result["boxes"] = boxes_list
-        result["scores"] = scores_list
+
+    if "boxes" in state:
+        result["boxes"] = np.array(state["boxes"]).tolist()
+
+    if "scores" in state:
+        result["scores"] = np.array(state["scores"]).tolist()
+
+    if "semantic_seg" in state:
+        if state["semantic_seg"] is None:
+            # Gated by the presence score: an empty mask, one run of background
+            height, width = state["original_height"], state["original_width"]
+            result["semantic_seg"] = {"counts": [height * width], "size": [height, width]}
+        else:
+            # Logits of the semantic mask, [1, 1, H, W]
+            semantic_seg = np.array(state["semantic_seg"][0, 0])
+            result["semantic_seg"] = mask_to_rle((semantic_seg > 0).astype(np.uint8))
     
     if "prompted_boxes" in state:
         result["prompted_boxes"] = state["prompted_boxes"]
@@ -163,6 +206,124 @@ def serialize_state(state: dict) -> dict:
     return result
 
 
+def result_key(session: dict, prompt, boxes: list, outputs: tuple) -> tuple:
+    """Cache key for the results of prompting a session's image."""
+    return (
+        session["image_hash"],
+        normalize_text_prompt(prompt) if prompt is not None else None,
+        normalize_box_prompts(boxes),
+        outputs,
+        processor.confidence_threshold,
+    )
+
+
+def run_prompts(session: dict, prompt, boxes: list, outputs: tuple, cancel_check=None) -> dict:
+    """
+    Run grounding for the given prompts on a session's image.
+
+    Results may have been served from the cache or by another request, so the
+    model state can lag behind the session's prompts. Only the missing step is
+    run when the state is one prompt behind, otherwise all prompts are
+    re-applied at once. Must run on the model worker.
+    """
+    state = session["state"]
+    encoded_prompt, encoded_boxes = session["encoded_prompts"]
+
+    try:
+        if prompt is not None and encoded_boxes == boxes:
+            state = processor.set_text_prompt(prompt, state, cancel_check=cancel_check, outputs=outputs)
+        elif boxes and encoded_prompt == prompt and encoded_boxes == boxes[:-1]:
+            box, label = boxes[-1]
+            state = processor.add_geometric_prompt(
+                box, label, state, cancel_check=cancel_check, outputs=outputs
+            )
+        else:
+            state = processor.set_prompts(prompt, boxes, state, cancel_check=cancel_check, outputs=outputs)
+    except BaseException:
+        # The state may hold part of the prompts; re-apply all of them next time
+        session["encoded_prompts"] = (None, None)
+        raise
+
+    # Store prompted boxes for display, converted from normalized cxcywh to pixel xyxy
+    img_w = state["original_width"]
+    img_h = state["original_height"]
+    if boxes:
+        state["prompted_boxes"] = [
+            {
+                "box": [
+                    (cx - w / 2) * img_w,
+                    (cy - h / 2) * img_h,
+                    (cx + w / 2) * img_w,
+                    (cy + h / 2) * img_h,
+                ],
+                "label": label,
+            }
+            for (cx, cy, w, h), label in boxes
+        ]
+    else:
+        state.pop("prompted_boxes", None)
+
+    session["state"] = state
+    session["encoded_prompts"] = (prompt, list(boxes))
+    return state
+
+
+def segment(session: dict, prompt, boxes: list, outputs: tuple, key: tuple, deadline) -> tuple:
+    """Run, serialize and cache the results for a prompt set. Runs on the model worker."""
+    start_time = time.perf_counter()
+    state = run_prompts(session, prompt, boxes, outputs, cancel_check=deadline.check)
+    processing_time_ms = (time.perf_counter() - start_time) * 1000
+    start = time.perf_counter()
+    results = json.dumps(serialize_state(state)).encode()
+    end = time.perf_counter()
+    print(f"Serialization took {end - start:.4f} seconds")
+    result_cache.put(key, results)
+    return results, processing_time_ms
+
+
+async def segment_cached(session: dict, prompt, boxes: list, outputs: tuple, deadline: Deadline) -> tuple:
+    """Serve results from the cache, joining an identical in-flight request if any."""
+    key = result_key(session, prompt, boxes, outputs)
+    results = result_cache.get(key)
+    if results is not None:
+        return results, True, 0.0
+    width, height = session["image_size"]
+    results, processing_time_ms = await inflight.run(
+        key,
+        lambda group: admission.run(
+            "segment", width, height,
+            lambda: model_worker.run(segment, session, prompt, boxes, outputs, key, group, deadline=group),
+            deadline=group,
+        ),
+        deadline=deadline,
+    )
+    return results, False, processing_time_ms
+
+
+def load_image(contents: bytes, deadline) -> tuple:
+    """Decode an upload and run the backbone on it. Runs on the model worker."""
+    # Left undecoded so the processor can decode JPEGs at a reduced scale
+    image = Image.open(io.BytesIO(contents))
+    start_time = time.perf_counter()
+    state = processor.set_image(image, cancel_check=deadline.check)
+    processing_time_ms = (time.perf_counter() - start_time) * 1000
+    return state, (state["original_width"], state["original_height"]), processing_time_ms
+
+
+def results_response(session_id: str, fields: dict, results: bytes, cached: bool, processing_time_ms: float) -> Response:
+    """Build a JSON response around an already-encoded `results` payload."""
+    content = json_object(
+        encode_fields(session_id=session_id, **fields),
+        encode_member("results", results),
+        encode_fields(
+            cached=cached,
+            processing_time_ms=round(processing_time_ms, 2),
+            peak_memory_mb=round(mx.get_peak_memory() / (1024 * 1024), 2),
+        ),
+    )
+    return Response(content, media_type="application/json")
+
+
 @app.get("/")
 async def root():
     return {"message": "SAM3 Segmentation API", "status": "running"}
@@ -173,46 +334,81 @@ async def health():
     return {"status": "healthy", "model_loaded": model is not None}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Admission, cache and memory counters."""
+    return {
+        "admission": admission.stats(),
+        "result_cache": result_cache.stats(),
+        "single_flight": inflight.stats(),
+        "sessions": len(sessions),
+        "memory": {
+            "active_bytes": mx.get_active_memory(),
+            "peak_bytes": mx.get_peak_memory(),
+            "cache_bytes": mx.get_cache_memory(),
+        },
+    }
+
+
 @app.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(http_request: Request, file: UploadFile = File(...)):
     """Upload an image and initialize a session."""
     if processor is None:
         raise HTTPException(status_code=503, detail="Model not loaded yet")
     
     try:
+        deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+
         # Read and validate image
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
+        image_hash = content_hash(contents)
+        # Only reads the header, the image is decoded on the model worker
+        width, height = Image.open(io.BytesIO(contents)).size
         
         # Create session
         session_id = str(uuid.uuid4())
         
-        # Process image through model (timed)
-        start_time = time.perf_counter()
-        state = processor.set_image(image)
-        processing_time_ms = (time.perf_counter() - start_time) * 1000
+        # Process image through model (timed); identical concurrent uploads share one pass
+        state, image_size, processing_time_ms = await inflight.run(
+            (image_hash, "upload"),
+            lambda group: admission.run(
+                "set_image", width, height,
+                lambda: model_worker.run(load_image, contents, group, deadline=group),
+                deadline=group,
+            ),
+            deadline=deadline,
+        )
+        # Sessions share the backbone features but not the prompt state
+        state = {**state, "backbone_out": dict(state["backbone_out"])}
         
         # Store session with image info
         sessions[session_id] = {
             "state": state,
-            "image_size": image.size,
+            "image_size": image_size,
+            "image_hash": image_hash,
+            "prompt": None,
+            "boxes": [],
+            # prompts currently applied to the model state
+            "encoded_prompts": (None, []),
         }
         
         return {
             "session_id": session_id,
-            "width": image.size[0],
-            "height": image.size[1],
+            "width": image_size[0],
+            "height": image_size[1],
             "message": "Image uploaded and processed successfully",
             "processing_time_ms": round(processing_time_ms, 2),
             "peak_memory_mb": round(mx.get_peak_memory() / (1024 * 1024), 2)
         }
     
+    except ServingError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
 
 
 @app.post("/segment/text")
-async def segment_with_text(request: TextPromptRequest):
+async def segment_with_text(request: TextPromptRequest, http_request: Request):
     """Segment image using text prompt."""
     if processor is None:
         raise HTTPException(status_code=503, detail="Model not loaded yet")
@@ -222,29 +418,29 @@ async def segment_with_text(request: TextPromptRequest):
         raise HTTPException(status_code=404, detail="Session not found")
     
     try:
-        start_time = time.perf_counter()
-        state = processor.set_text_prompt(request.prompt, session["state"])
-        processing_time_ms = (time.perf_counter() - start_time) * 1000
-        session["state"] = state
-        start = time.perf_counter()
-        results = serialize_state(state)
-        end = time.perf_counter()
-        print(f"Serialization took {end - start:.4f} seconds")
-        
-        return {
-            "session_id": request.session_id,
-            "prompt": request.prompt,
-            "results": results,
-            "processing_time_ms": round(processing_time_ms, 2),
-            "peak_memory_mb": round(mx.get_peak_memory() / (1024 * 1024), 2)
-        }
+        deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+        outputs = normalize_outputs(request.outputs, RESPONSE_OUTPUTS, DEFAULT_OUTPUTS)
+        session["prompt"] = request.prompt
+        results, cached, processing_time_ms = await segment_cached(
+            session, request.prompt, list(session["boxes"]), outputs, deadline
+        )
+
+        return results_response(
+            request.session_id,
+            {"prompt": request.prompt},
+            results,
+            cached,
+            processing_time_ms,
+        )
     
+    except ServingError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during segmentation: {str(e)}")
 
 
 @app.post("/segment/box")
-async def add_box_prompt(request: BoxPromptRequest):
+async def add_box_prompt(request: BoxPromptRequest, http_request: Request):
     """Add a box prompt (positive or negative) and re-segment."""
     if processor is None:
         raise HTTPException(status_code=503, detail="Model not loaded yet")
@@ -254,43 +450,40 @@ async def add_box_prompt(request: BoxPromptRequest):
         raise HTTPException(status_code=404, detail="Session not found")
     
     try:
-        state = session["state"]
-        
-        # Store prompted box for display
-        if "prompted_boxes" not in state:
-            state["prompted_boxes"] = []
-        
-        # Convert from normalized cxcywh to pixel xyxy for display
-        img_w = state["original_width"]
-        img_h = state["original_height"]
-        cx, cy, w, h = request.box
-        x_min = (cx - w / 2) * img_w
-        y_min = (cy - h / 2) * img_h
-        x_max = (cx + w / 2) * img_w
-        y_max = (cy + h / 2) * img_h
-        
-        state["prompted_boxes"].append({
-            "box": [x_min, y_min, x_max, y_max],
-            "label": request.label
-        })
-        
-        start_time = time.perf_counter()
-        state = processor.add_geometric_prompt(request.box, request.label, state)
-        processing_time_ms = (time.perf_counter() - start_time) * 1000
-        session["state"] = state
-        
-        return {
-            "session_id": request.session_id,
-            "box_type": "positive" if request.label else "negative",
-            "results": serialize_state(state),
-            "processing_time_ms": round(processing_time_ms, 2),
-            "peak_memory_mb": round(mx.get_peak_memory() / (1024 * 1024), 2)
-        }
+        deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+        outputs = normalize_outputs(request.outputs, RESPONSE_OUTPUTS, DEFAULT_OUTPUTS)
+        session["boxes"].append((list(request.box), request.label))
+        results, cached, processing_time_ms = await segment_cached(
+            session, session["prompt"], list(session["boxes"]), outputs, deadline
+        )
+
+        return results_response(
+            request.session_id,
+            {"box_type": "positive" if request.label else "negative"},
+            results,
+            cached,
+            processing_time_ms,
+        )
     
+    except ServingError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error adding box prompt: {str(e)}")
 
 
+def reset_state(session: dict) -> tuple:
+    """Remove all prompts and results from a session's state. Runs on the model worker."""
+    state = session["state"]
+    start_time = time.perf_counter()
+    processor.reset_all_prompts(state)
+    processing_time_ms = (time.perf_counter() - start_time) * 1000
+    session["encoded_prompts"] = (None, [])
+
+    if "prompted_boxes" in state:
+        del state["prompted_boxes"]
+    return serialize_state(state), processing_time_ms
+
+
 @app.post("/reset")
 async def reset_prompts(request: SessionRequest):
     """Reset all prompts for a session."""
@@ -302,19 +495,14 @@ async def reset_prompts(request: SessionRequest):
         raise HTTPException(status_code=404, detail="Session not found")
     
     try:
-        state = session["state"]
-        
-        start_time = time.perf_counter()
-        processor.reset_all_prompts(state)
-        processing_time_ms = (time.perf_counter() - start_time) * 1000
-        
-        if "prompted_boxes" in state:
-            del state["prompted_boxes"]
+        session["prompt"] = None
+        session["boxes"] = []
+        results, processing_time_ms = await model_worker.run(reset_state, session)
         
         return {
             "session_id": request.session_id,
             "message": "All prompts reset",
-            "results": serialize_state(state),
+            "results": results,
             "processing_time_ms": round(processing_time_ms, 2),
             "peak_memory_mb": round(mx.get_peak_memory() / (1024 * 1024), 2)
         }
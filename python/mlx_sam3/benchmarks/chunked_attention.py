@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Peak memory and latency of chunked attention per block.
+
+Runs the attention of a global and a windowed ViT block, and the self- and
+text cross-attention of a fusion encoder layer, at --resolution, on random
+weights and inputs: unchunked (mx.fast.scaled_dot_product_attention), then
+chunked at each of --caps MB of scores (chunked_attention.attention within
+bound_attention_memory; on the GPU, where the fused kernel is used, chunking
+is forced). Reports the score matrix size, peak memory, median
+latency and largest difference to the unchunked output.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/chunked_attention.py
+  python3 benchmarks/chunked_attention.py --resolution 672 --caps 512 128 32 --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from unittest import mock
+
+import mlx.core as mx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model import chunked_attention as chunking
+from sam3.model.model_misc import MultiheadAttentionWrapper
+from sam3.model.vitdet import Attention
+
+PATCH_SIZE = 14
+WINDOW_SIZE = 24
+VIT_DIM, VIT_HEADS = 1024, 16
+ENCODER_DIM, ENCODER_HEADS = 256, 8
+TEXT_TOKENS = 32
+
+
+def measure(fn, runs):
+    """Peak memory in MB, median latency in ms and output of `fn()`."""
+    mx.eval(fn())
+    mx.clear_cache()
+    mx.reset_peak_memory()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = fn()
+        mx.eval(out)
+        times.append((time.perf_counter() - start) * 1000)
+    return mx.get_peak_memory() / 2**20, statistics.median(times), out
+
+
+def blocks(side):
+    """(name, attention module, inputs, score matrix shape) per block."""
+    windows = (side // WINDOW_SIZE) ** 2
+    vit = {}
+    for name, hw, batch in (("vit global", (side, side), 1), ("vit windowed", (WINDOW_SIZE,) * 2, windows)):
+        vit[name] = Attention(
+            VIT_DIM,
+            VIT_HEADS,
+            input_size=hw,
+            cls_token=False,
+            use_rope=True,
+            rope_pt_size=(WINDOW_SIZE, WINDOW_SIZE),
+            rope_interp=True,
+        )
+        x = mx.random.normal((batch, *hw, VIT_DIM))
+        yield name, vit[name], (x,), (batch, VIT_HEADS, hw[0] * hw[1], hw[0] * hw[1])
+
+    tokens = side * side
+    image = mx.random.normal((1, tokens, ENCODER_DIM))
+    text = mx.random.normal((1, TEXT_TOKENS, ENCODER_DIM))
+    yield (
+        "encoder self",
+        MultiheadAttentionWrapper(ENCODER_DIM, ENCODER_HEADS),
+        (image, image, image),
+        (1, ENCODER_HEADS, tokens, tokens),
+    )
+    yield (
+        "encoder text",
+        MultiheadAttentionWrapper(ENCODER_DIM, ENCODER_HEADS),
+        (image, text, text),
+        (1, ENCODER_HEADS, tokens, TEXT_TOKENS),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution", type=int, default=1008)
+    parser.add_argument("--caps", type=float, nargs="+", default=[256, 64, 16])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    # Chunk on every backend, to compare with the unchunked kernel
+    force = mock.patch.object(chunking, "fused_attention_available", lambda: False)
+    print(f"{'block':<14}{'scores MB':>10}{'cap MB':>8}{'peak MB':>9}{'ms':>9}{'max |diff|':>12}")
+    for name, module, inputs, scores_shape in blocks(args.resolution // PATCH_SIZE):
+        mx.eval(module.parameters(), inputs)
+        scores_mb = 4 * scores_shape[0] * scores_shape[1] * scores_shape[2] * scores_shape[3] / 2**20
+        module.attention_memory_cap = None
+        peak, ms, reference = measure(lambda: module(*inputs), args.runs)
+        print(f"{name:<14}{scores_mb:>10.1f}{'-':>8}{peak:>9.1f}{ms:>9.1f}{'':>12}")
+        for cap in args.caps:
+            module.attention_memory_cap = int(cap * 2**20)
+            with force, chunking.bound_attention_memory():
+                peak, ms, out = measure(lambda: module(*inputs), args.runs)
+            diff = mx.abs(out - reference).max().item()
+            print(f"{'':<14}{'':>10}{cap:>8.0f}{peak:>9.1f}{ms:>9.1f}{diff:>12.2e}")
+        del module, inputs, reference
+        mx.clear_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Compare compiled and eager latency per model stage.
+
+Builds the model twice, eager and with build_sam3_image_model(compile=True),
+and times each stage on the same inputs: the ViT trunk, the text encoder,
+detection (geometry encoder, encoder and decoder) and segmentation (pixel
+decoder and mask heads). Prompts cycle through --prompts and 0 to --max-boxes
+box prompts, so the compiled stages see several token length and box count
+buckets. Reports the median latency of both, the speedup, and the traced
+graphs and cache hit rate of each compiled stage.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/compile.py
+  python3 benchmarks/compile.py --image assets/images/appdemo.png --prompts person "a red car" --max-boxes 3 --runs 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor, transform
+
+STAGES = ("vision", "text", "detection", "segmentation")
+
+
+def random_boxes(rng, count):
+    """`count` (box, label) prompts, normalized cxcywh."""
+    return [((*rng.uniform(0.3, 0.7, 2), *rng.uniform(0.1, 0.3, 2)), bool(rng.integers(2))) for _ in range(count)]
+
+
+def timed(fn, times):
+    start = time.perf_counter()
+    out = fn()
+    mx.eval(out)
+    times.append((time.perf_counter() - start) * 1000)
+    return out
+
+
+def run(model, image, requests):
+    """Latencies in ms of each stage over `requests`, (prompt, boxes) pairs."""
+    processor = Sam3Processor(model)
+    trunk = model.backbone.vision_backbone.trunk
+    backbone_out = processor._compact_backbone_out(model.backbone.call_image(image))
+    mx.eval(backbone_out)
+
+    times = {stage: [] for stage in STAGES}
+    for prompt, boxes in requests:
+        timed(lambda: trunk(image), times["vision"])
+        text = timed(lambda: model.backbone.call_text([prompt]), times["text"])
+        geometric_prompt = model._get_dummy_prompt()
+        for box, label in boxes:
+            geometric_prompt.append_boxes(
+                mx.array(box, dtype=mx.float32).reshape(1, 1, 4),
+                mx.array([label], dtype=mx.bool_).reshape(1, 1),
+            )
+        out, segmentation_inputs = timed(
+            lambda: model.call_detection(
+                {**backbone_out, **text}, processor.find_stage, None, geometric_prompt
+            ),
+            times["detection"],
+        )
+        timed(lambda: model.call_segmentation(out, segmentation_inputs), times["segmentation"])
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--prompts", nargs="+", default=["person", "a red car", "the dog on the left of the bench"])
+    parser.add_argument("--max-boxes", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=12)
+    args = parser.parse_args()
+
+    image = transform(Image.open(args.image).convert("RGB"), 1008)[None]
+    rng = np.random.default_rng(0)
+    requests = [
+        (args.prompts[i % len(args.prompts)], random_boxes(rng, i % (args.max_boxes + 1)))
+        for i in range(args.runs)
+    ]
+
+    results = {}
+    for compiled in (False, True):
+        model = build_sam3_image_model(compile=compiled)
+        # Warm up kernels, and trace the graphs of every bucket
+        run(model, image, requests)
+        results[compiled] = run(model, image, requests)
+        if compiled:
+            stats = model.compile_stats()
+        del model
+        mx.clear_cache()
+
+    print(f"{'stage':<14}{'eager ms':>10}{'compiled ms':>13}{'speedup':>9}{'graphs':>8}{'hit rate':>10}")
+    for stage in STAGES:
+        eager = statistics.median(results[False][stage])
+        compiled = statistics.median(results[True][stage])
+        stage_stats = stats.get(stage, {})
+        print(
+            f"{stage:<14}{eager:>10.1f}{compiled:>13.1f}{eager / compiled:>8.2f}x"
+            f"{stage_stats.get('graphs', '-'):>8}{stage_stats.get('hit_rate', float('nan')):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark the CPU implementations of the image path conv layers.
+
+For each op of sam3.model.cpu_kernels at the shapes of the model at
+--resolution, checks that it matches the MLX layer it replaces on random
+inputs and weights, and reports the median latency of both on the CPU:
+
+- patch embedding: the 14 x 14 stride 14 conv of the ViT (PatchEmbed);
+- neck dconv: the 2 x 2 stride 2 transposed convs of Scale4FN and Scale2FN;
+- GroupNorm + ReLU: after each of the pixel decoder convs.
+
+No weights are needed.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/cpu_kernels.py
+  python3 benchmarks/cpu_kernels.py --resolution 672 --runs 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import mlx.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model.cpu_kernels import conv_transpose_nonoverlapping, group_norm_relu, patch_embed
+
+PATCH_SIZE = 14
+EMBED_DIM = 1024
+D_MODEL = 256
+
+
+def median_ms(fn, runs):
+    mx.eval(fn())
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        mx.eval(fn())
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def ops(resolution):
+    """(name, MLX layer call, CPU kernel call) at `resolution`."""
+    side = resolution // PATCH_SIZE
+
+    proj = nn.Conv2d(3, EMBED_DIM, kernel_size=PATCH_SIZE, stride=PATCH_SIZE, bias=False)
+    image = mx.random.normal((1, 3, resolution, resolution))
+    yield (
+        f"patch embed {resolution}",
+        lambda: proj(image.transpose(0, 2, 3, 1)),
+        lambda: patch_embed(image, proj.weight),
+    )
+
+    # Scale4FN: 1024 -> 512 at side, 512 -> 256 at 2 * side; Scale2FN: the first
+    for in_channels, size in ((EMBED_DIM, side), (EMBED_DIM // 2, 2 * side)):
+        dconv = nn.ConvTranspose2d(in_channels, in_channels // 2, kernel_size=2, stride=2)
+        dconv.bias = mx.random.normal(dconv.bias.shape)
+        x = mx.random.normal((1, size, size, in_channels))
+        yield (
+            f"dconv {in_channels} @ {size}",
+            lambda dconv=dconv, x=x: dconv(x),
+            lambda dconv=dconv, x=x: conv_transpose_nonoverlapping(x, dconv.weight, dconv.bias),
+        )
+
+    # Pixel decoder levels, at 1 / 4 and 1 / 2 of the stride 4 level
+    norm = nn.GroupNorm(8, D_MODEL)
+    norm.weight = mx.random.normal(norm.weight.shape)
+    norm.bias = mx.random.normal(norm.bias.shape)
+    for size in (side, 2 * side, 4 * side):
+        x = mx.random.normal((1, size, size, D_MODEL))
+        yield (
+            f"groupnorm+relu @ {size}",
+            lambda x=x: nn.relu(norm(x)),
+            lambda x=x: group_norm_relu(norm, x),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution", type=int, default=1008)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    mx.set_default_device(mx.cpu)
+    print(f"{'op':<24}{'max |diff|':>12}{'MLX ms':>10}{'CPU ms':>10}{'speedup':>9}")
+    for name, layer, kernel in ops(args.resolution):
+        diff = mx.abs(layer() - kernel()).max().item()
+        layer_ms = median_ms(layer, args.runs)
+        kernel_ms = median_ms(kernel, args.runs)
+        print(f"{name:<24}{diff:>12.2e}{layer_ms:>10.2f}{kernel_ms:>10.2f}{layer_ms / kernel_ms:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Count the layout copies of the image features per prompt.
+
+Sets an image, then builds the grounding graph of a text prompt (geometry
+encoder, fusion encoder, decoder and segmentation head; the backbone
+features are already evaluated) and counts in it, from mx.export_to_dot:
+
+- transposes: Transpose nodes (views);
+- copying reshapes: reshapes of a transposed, sliced or broadcast view, which
+  materialize a copy in the new layout;
+- casts: AsType nodes;
+- gathers: Gather nodes (indexing an array with an array).
+
+and reports the median latency of set_text_prompt.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/feature_layout.py
+  python3 benchmarks/feature_layout.py --image assets/images/appdemo.png --prompt person --runs 5
+"""
+import argparse
+import io
+import os
+import re
+import statistics
+import sys
+import time
+from collections import Counter
+
+import mlx.core as mx
+from mlx.utils import tree_flatten
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+
+# Primitives whose output is a view of their input
+VIEWS = {"Transpose", "Slice", "Broadcast", "ExpandDims", "Squeeze", "AsStrided"}
+
+
+def layout_ops(outputs) -> Counter:
+    """Transposes, copying reshapes, casts and gathers of the graph of
+    `outputs` (a tree of arrays)."""
+    dot = io.StringIO()
+    # The outputs also hold None and Python values
+    leaves = tree_flatten(outputs, is_leaf=lambda v: not isinstance(v, (list, tuple, dict)))
+    mx.export_to_dot(dot, *(v for _, v in leaves if isinstance(v, mx.array)))
+    labels, inputs, producer = {}, {}, {}
+    for line in dot.getvalue().splitlines():
+        node = re.match(r'\{ (\d+) \[label ="(\w+)"', line)
+        if node:
+            labels[node.group(1)] = node.group(2)
+            continue
+        edge = re.match(r'(\S+) -> (\S+)', line)
+        if edge:
+            src, dst = edge.groups()
+            if src.startswith('"'):
+                inputs.setdefault(dst, []).append(src)
+            else:
+                producer[dst] = src
+
+    def strided(array):
+        # Produced by a chain of views starting at a transpose, slice or broadcast
+        prim = producer.get(array)
+        return prim is not None and labels[prim] in VIEWS
+
+    counts = Counter()
+    for prim, label in labels.items():
+        if label == "Transpose":
+            counts["transposes"] += 1
+        elif label == "Reshape" and any(strided(a) for a in inputs.get(prim, ())):
+            counts["copying reshapes"] += 1
+        elif label == "AsType":
+            counts["casts"] += 1
+        elif label == "Gather":
+            counts["gathers"] += 1
+    return counts
+
+
+def grounding_outputs(model, processor, state, prompt):
+    """The unevaluated outputs of the model for `prompt` on `state`."""
+    backbone_out = {**state["backbone_out"], **model.backbone.call_text([prompt])}
+    mx.eval(backbone_out)
+    out, segmentation_inputs = model.call_detection(
+        backbone_out, processor.find_stage, None, model._get_dummy_prompt()
+    )
+    model.call_segmentation(out, segmentation_inputs)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--prompt", default="person")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_sam3_image_model()
+    processor = Sam3Processor(model)
+    state = processor.set_image(Image.open(args.image).convert("RGB"))
+
+    counts = layout_ops(grounding_outputs(model, processor, state, args.prompt))
+    for name in ("transposes", "copying reshapes", "casts", "gathers"):
+        print(f"{name:<18}{counts[name]:>6}")
+
+    processor.set_text_prompt(args.prompt, state)
+    times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        processor.set_text_prompt(args.prompt, state)
+        times.append((time.perf_counter() - start) * 1000)
+    print(f"{'set_text_prompt':<18}{statistics.median(times):>6.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
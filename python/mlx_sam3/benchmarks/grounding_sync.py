@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measure the per-prompt latency removed by sync-free postprocessing.
+
+Runs the same text prompts through Sam3Processor._call_grounding and through
+the previous postprocessing, which copied the keep mask to NumPy between the
+model and the selection. Each prompt is timed until its scores, boxes and
+mask logits are evaluated; the legacy mask logits are upsampled to the image
+size, as they were then (see benchmarks/mask_upsample.py for that part alone).
+Also checks that both paths keep the same detections.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/grounding_sync.py
+  python3 benchmarks/grounding_sync.py --image assets/images/appdemo.png --prompts person shoe --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from functools import partial
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model import box_ops
+from sam3.model.data_misc import interpolate
+from sam3.model.sam3_image_processor import Sam3Processor
+
+
+def legacy_call_grounding(processor: Sam3Processor, state):
+    """The previous _call_grounding, with a host sync before the selection."""
+    outputs = processor.model.call_grounding(
+        backbone_out=dict(state["backbone_out"]),
+        find_input=processor.find_stage,
+        geometric_prompt=state["geometric_prompt"],
+        find_target=None,
+    )
+    out_probs = mx.sigmoid(outputs["pred_logits"])
+    presence_score = mx.sigmoid(outputs["presence_logit_dec"])[:, None]
+    out_probs = (out_probs * presence_score).squeeze(-1)
+
+    keep = out_probs > processor.confidence_threshold
+    indices = mx.array(np.array(keep[0]).nonzero()[0])
+    out_probs = out_probs[0][indices]
+    out_masks = outputs["pred_masks"][0][indices]
+    boxes = box_ops.box_cxcywh_to_xyxy(outputs["pred_boxes"][0][indices])
+    img_h, img_w = state["original_height"], state["original_width"]
+    boxes = boxes * mx.array([img_w, img_h, img_w, img_h])[None, :]
+    interpolator = partial(interpolate, size=(img_h, img_w), mode="bilinear", align_corners=False)
+    out_masks = mx.sigmoid(interpolator(out_masks[:, None]))
+    state["semantic_seg"] = interpolator(outputs["semantic_seg"])
+    state["mask_logits"] = out_masks
+    state["masks"] = out_masks > 0.5
+    state["boxes"] = boxes
+    state["scores"] = out_probs
+    return state
+
+
+def timed(fn, processor, state, prompt):
+    processor.reset_all_prompts(state)
+    state["backbone_out"].update(processor.model.backbone.call_text([prompt]))
+    state["geometric_prompt"] = processor.model._get_dummy_prompt()
+    mx.eval(state["backbone_out"])
+    start = time.perf_counter()
+    fn(state)
+    mx.eval(state["scores"], state["boxes"], state["mask_logits"])
+    return (time.perf_counter() - start) * 1000, np.sort(np.array(state["scores"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "car", "dog"])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_sam3_image_model()
+    processor = Sam3Processor(model)
+    state = processor.set_image(Image.open(args.image))
+
+    paths = {
+        "legacy": partial(legacy_call_grounding, processor),
+        "sync-free": processor._call_grounding,
+    }
+    # Warm up both paths (kernel compilation, caches)
+    for fn in paths.values():
+        timed(fn, processor, state, args.prompts[0])
+
+    saved = []
+    for prompt in args.prompts:
+        times = {name: [] for name in paths}
+        scores = {}
+        for _ in range(args.runs):
+            for name, fn in paths.items():
+                ms, scores[name] = timed(fn, processor, state, prompt)
+                times[name].append(ms)
+        legacy = statistics.median(times["legacy"])
+        fast = statistics.median(times["sync-free"])
+        saved.append(legacy - fast)
+        same = scores["legacy"].shape == scores["sync-free"].shape and np.allclose(
+            scores["legacy"], scores["sync-free"], atol=1e-5
+        )
+        print(
+            f"{prompt!r:<12} detections {len(scores['sync-free']):3d}"
+            f"  legacy {legacy:8.1f} ms  sync-free {fast:8.1f} ms"
+            f"  saved {legacy - fast:7.1f} ms  same detections {same}"
+        )
+    print(f"mean latency removed per prompt: {statistics.mean(saved):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Accuracy, latency and memory of the half precision models.
+
+Builds the float32 model and the models with the ViT, text encoder and
+transformer cast to each of --dtypes, with the float32 islands of
+model_builder.cast_model (see build_sam3_image_model(dtype=...)), runs the
+same images and text prompts through each, and reports the weight size, the
+peak memory and median latency of set_image + set_text_prompt, the largest
+score difference against float32, and the mask drift: the share of the
+float32 detections matched by a mask with IoU >= --iou, and the mean best
+mask IoU. Masks are compared at --mask-side pixels on the longer side.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/half_precision.py
+  python3 benchmarks/half_precision.py --images assets/images/appdemo.png --prompts person shoe --dtypes bfloat16
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from mlx.utils import tree_flatten
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+
+
+def run(processor, image, prompt, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        state = processor.set_image(image)
+        state = processor.set_text_prompt(prompt, state)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), state
+
+
+def best_ious(reference, masks):
+    """Best IoU of each reference mask against `masks`, both [N, 1, H, W]."""
+    if len(reference) == 0:
+        return np.zeros(0)
+    if len(masks) == 0:
+        return np.zeros(len(reference))
+    ref = reference.reshape(len(reference), -1).astype(np.float32)
+    out = masks.reshape(len(masks), -1).astype(np.float32)
+    inter = ref @ out.T
+    union = ref.sum(1)[:, None] + out.sum(1)[None, :] - inter
+    return (inter / np.maximum(union, 1)).max(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="+", default=["assets/images/appdemo.png"])
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "car"])
+    parser.add_argument("--dtypes", nargs="+", choices=("bfloat16", "float16"), default=["bfloat16", "float16"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--mask-side", type=int, default=256)
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    requests = [(image, prompt) for image in images for prompt in args.prompts]
+
+    # float32 is the reference; confidence 0 keeps every query, so scores
+    # compare query by query
+    reference = {}
+    results = {}
+    for dtype in ["float32", *args.dtypes]:
+        model = build_sam3_image_model(dtype=None if dtype == "float32" else getattr(mx, dtype))
+        processor = Sam3Processor(model)
+        scorer = Sam3Processor(model, confidence_threshold=0.0)
+        weight_mb = sum(v.nbytes for _, v in tree_flatten(model.parameters())) / 2**20
+
+        latency, matched, score_diff = [], [], 0.0
+        mx.reset_peak_memory()
+        for i, (image, prompt) in enumerate(requests):
+            # Warm up kernels and caches
+            run(processor, image, prompt, 1)
+            ms, state = run(processor, image, prompt, args.runs)
+            latency.append(ms)
+            masks = np.array(state["masks"].resized(args.mask_side))
+            _, all_queries = run(scorer, image, prompt, 1)
+            scores = np.array(all_queries["scores"])
+            if dtype == "float32":
+                reference[i] = (masks, scores)
+            matched.append(best_ious(reference[i][0], masks))
+            score_diff = max(score_diff, float(np.abs(scores - reference[i][1]).max()))
+        results[dtype] = (
+            weight_mb, mx.get_peak_memory() / 2**20, statistics.median(latency), score_diff, np.concatenate(matched)
+        )
+        del model, processor, scorer
+        mx.clear_cache()
+
+    print(
+        f"{'dtype':>9}  {'size MB':>8}  {'peak MB':>8}  {'latency ms':>10}  {'score diff':>10}  {'matched':>8}  {'mean IoU':>8}"
+    )
+    for dtype, (weight_mb, peak_mb, ms, score_diff, ious) in results.items():
+        share = (ious >= args.iou).mean() if len(ious) else float("nan")
+        mean = ious.mean() if len(ious) else float("nan")
+        print(
+            f"{dtype:>9}  {weight_mb:>8.1f}  {peak_mb:>8.1f}  {ms:>10.1f}  {score_diff:>10.4f}  {share:>8.2f}  {mean:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
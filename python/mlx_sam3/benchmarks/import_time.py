@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Measure the cold-start import time of the inference path and check it against
+a budget.
+
+Imports `build_sam3_image_model` and `Sam3Processor` in fresh interpreters
+under `python -X importtime`. Reports the median wall time, the slowest
+modules (cumulative), and the third-party packages that were loaded. Exits
+with status 1 if the median exceeds --budget-ms or if any package beyond
+MLX, NumPy and PIL was imported.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/import_time.py
+  python3 benchmarks/import_time.py --budget-ms 300 --runs 10 --top 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ALLOWED = {"mlx", "numpy", "PIL", "sam3"}
+
+PROBE = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+elapsed = time.perf_counter() - start
+loaded = {name.split(".")[0] for name in set(sys.modules) - before}
+print(json.dumps({
+    "ms": elapsed * 1000,
+    "third_party": sorted(loaded - set(sys.stdlib_module_names) - {"_distutils_hack"}),
+}))
+"""
+
+
+def probe():
+    """One fresh interpreter: (wall ms, third-party packages, {module: cumulative us})."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cum, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cum)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    return stats["ms"], stats["third_party"], cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=500.0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to list")
+    args = parser.parse_args()
+
+    times = []
+    for _ in range(args.runs):
+        ms, third_party, cumulative = probe()
+        times.append(ms)
+    median = statistics.median(times)
+
+    print(f"import time median {median:.1f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    print("slowest modules, cumulative, last run:")
+    for name, us in sorted(cumulative.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    print(f"third-party packages: {', '.join(third_party)}")
+
+    failed = False
+    unexpected = sorted(set(third_party) - ALLOWED)
+    if unexpected:
+        print(f"FAIL: unexpected packages imported: {', '.join(unexpected)}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"FAIL: {median:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
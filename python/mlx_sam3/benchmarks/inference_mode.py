@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Check and time the inference mode (model_builder.set_inference_mode).
+
+Runs the same images and text prompts with the inference mode off and on
+and checks that the outputs are identical (the exit status is 1 otherwise):
+
+- the model outputs of each prompt (scores, boxes, presence, masks and
+  semantic segmentation), compared array by array;
+- the processor results (boxes, scores and masks).
+
+Then reports the median latency of each with the mode off and on:
+
+- set_image: the backbone, with or without the dropped FPN level;
+- set_text_prompt: the text encoder and grounding through the processor,
+  which only evaluates the outputs it returns;
+- full outputs: the text encoder and grounding with every model output
+  evaluated, as a caller reading all of them does.
+
+The model runs eagerly: compiled stages keep the mode they were traced with.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/inference_mode.py
+  python3 benchmarks/inference_mode.py --images assets/images/appdemo.png --prompts person --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from mlx.utils import tree_flatten
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+from sam3.model_builder import set_inference_mode
+
+
+def median_ms(fn, runs):
+    fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def model_outputs(model, processor, state, prompt):
+    """Every array the model outputs for `prompt` on `state`, evaluated."""
+    backbone_out = {**state["backbone_out"], **model.backbone.call_text([prompt])}
+    out = model.call_grounding(
+        backbone_out, processor.find_stage, None, model._get_dummy_prompt()
+    )
+    # The outputs also hold None and Python values
+    leaves = tree_flatten(out, is_leaf=lambda v: not isinstance(v, (list, tuple, dict)))
+    arrays = {k: v for k, v in leaves if isinstance(v, mx.array)}
+    mx.eval(arrays)
+    return arrays
+
+
+def processor_results(processor, state, prompt):
+    state = processor.set_text_prompt(prompt, state)
+    return {
+        "boxes": np.array(state["boxes"]),
+        "scores": np.array(state["scores"]),
+        "masks": np.array(state["masks"].resized(256)),
+    }
+
+
+def max_diffs(reference, outputs):
+    """Max |diff| of each key of `reference`; inf if missing or reshaped."""
+    diffs = {}
+    for key, ref in reference.items():
+        out = outputs.get(key)
+        if out is None or out.shape != ref.shape:
+            diffs[key] = float("inf")
+        elif ref.size:
+            diffs[key] = float(np.abs(np.array(ref, dtype=np.float64) - np.array(out)).max())
+        else:
+            diffs[key] = 0.0
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="+", default=["assets/images/appdemo.png"])
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "car"])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    model = build_sam3_image_model(inference_mode=False)
+    processor = Sam3Processor(model)
+
+    results = {}
+    for enabled in (False, True):
+        set_inference_mode(model, enabled)
+        outputs, timings = [], {"set_image": [], "set_text_prompt": [], "full outputs": []}
+        for image in images:
+            timings["set_image"].append(median_ms(lambda: processor.set_image(image), args.runs))
+            state = processor.set_image(image)
+            for prompt in args.prompts:
+                outputs.append((
+                    model_outputs(model, processor, state, prompt),
+                    processor_results(processor, state, prompt),
+                ))
+                timings["set_text_prompt"].append(
+                    median_ms(lambda: processor.set_text_prompt(prompt, state), args.runs)
+                )
+                timings["full outputs"].append(
+                    median_ms(lambda: model_outputs(model, processor, state, prompt), args.runs)
+                )
+        results[enabled] = (outputs, {k: statistics.median(v) for k, v in timings.items()})
+        mx.clear_cache()
+
+    # Parity: the worst difference of each output over all the prompts
+    worst = {}
+    for (ref_model, ref_proc), (out_model, out_proc) in zip(results[False][0], results[True][0]):
+        for diffs in (max_diffs(ref_model, out_model), max_diffs(ref_proc, out_proc)):
+            for key, diff in diffs.items():
+                worst[key] = max(worst.get(key, 0.0), diff)
+    print(f"{'output':<24}{'max |diff|':>12}")
+    for key, diff in sorted(worst.items()):
+        print(f"{key:<24}{diff:>12.2e}")
+    identical = all(diff == 0 for diff in worst.values())
+    print("identical outputs" if identical else "FAIL: outputs differ")
+
+    print()
+    print(f"{'stage':<18}{'off ms':>10}{'on ms':>10}{'saved ms':>10}{'speedup':>9}")
+    for stage, off_ms in results[False][1].items():
+        on_ms = results[True][1][stage]
+        print(f"{stage:<18}{off_ms:>10.1f}{on_ms:>10.1f}{off_ms - on_ms:>10.1f}{off_ms / on_ms:>8.2f}x")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Compare eager full-image mask upsampling with LazyMasks.
+
+Builds synthetic 288x288 mask logits with round objects of a given radius and
+produces binary masks for an image of --size, either by upsampling every mask
+to the image size at once (as _call_grounding used to) or one at a time
+through LazyMasks. Reports time and peak memory of both, and checks that the
+masks are identical. No model weights are needed.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/mask_upsample.py
+  python3 benchmarks/mask_upsample.py --size 3000x4000 --detections 50 --radius 4 16 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model.data_misc import interpolate
+from sam3.model.mask_ops import LazyMasks
+
+LOW_RES = 288
+
+
+def synthetic_logits(n: int, radius: int, seed: int = 0) -> mx.array:
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:LOW_RES, :LOW_RES]
+    logits = np.full((n, LOW_RES, LOW_RES), -4.0, dtype=np.float32)
+    for i in range(n):
+        cy, cx = rng.integers(radius, LOW_RES - radius, size=2)
+        logits[i][(yy - cy) ** 2 + (xx - cx) ** 2 < radius**2] = 4.0
+    return mx.array(logits)
+
+
+def measure(fn):
+    mx.clear_cache()
+    mx.reset_peak_memory()
+    before = mx.get_active_memory()
+    start = time.perf_counter()
+    out = fn()
+    elapsed = (time.perf_counter() - start) * 1000
+    return out, elapsed, (mx.get_peak_memory() - before) / (1024 * 1024)
+
+
+def eager(logits, size):
+    masks = interpolate(logits[:, None], size=size, mode="bilinear", align_corners=False)
+    masks = mx.sigmoid(masks) > 0.5
+    return np.array(masks)
+
+
+def lazy(logits, size):
+    # One full-size mask at a time, as the backends serialize them
+    masks = LazyMasks(logits, size)
+    return [np.array(masks[i]) for i in range(len(masks))]
+
+
+def crops_only(logits, size):
+    # What a consumer that encodes crops (e.g. as RLE with an offset) pays
+    masks = LazyMasks(logits, size)
+    return [np.array(masks.crop(i)[1]) for i in range(len(masks))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="3000x4000", help="HxW of the image")
+    parser.add_argument("--detections", type=int, default=20)
+    parser.add_argument("--radius", type=int, nargs="+", default=[4, 16, 64], help="object radius in mask cells")
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+
+    for radius in args.radius:
+        logits = synthetic_logits(args.detections, radius)
+        mx.eval(logits)
+        ref, eager_ms, eager_mb = measure(lambda: eager(logits, size))
+        out, lazy_ms, lazy_mb = measure(lambda: lazy(logits, size))
+        same = all(np.array_equal(ref[i], out[i]) for i in range(len(out)))
+        del ref, out
+        crops, crop_ms, crop_mb = measure(lambda: crops_only(logits, size))
+        print(
+            f"radius {radius:3d}  eager {eager_ms:8.1f} ms {eager_mb:8.1f} MB"
+            f"  | lazy {lazy_ms:8.1f} ms {lazy_mb:8.1f} MB"
+            f"  | crops only {crop_ms:8.1f} ms {crop_mb:8.1f} MB"
+            f"  identical {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
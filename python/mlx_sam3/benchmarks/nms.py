@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Check the on-device NMS against greedy NMS and time it.
+
+Builds synthetic score-sorted detections (clusters of jittered boxes and round
+masks on a 288x288 decoder grid, as many as the decoder has queries), runs
+sam3.model.nms with box and mask IoU thresholds, and compares the kept
+detections with a greedy NumPy NMS. No model weights are needed.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/nms.py
+  python3 benchmarks/nms.py --queries 200 --clusters 10 --box-iou 0.7 --mask-iou 0.7
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model.nms import mask_iou, nms
+
+LOW_RES = 288
+
+
+def synthetic_detections(queries: int, clusters: int, seed: int = 0):
+    """Score-sorted [K, 4] xyxy boxes in [0, 1] and [K, h, w] mask logits."""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.2, 0.8, size=(clusters, 2))
+    radii = rng.uniform(0.03, 0.15, size=clusters)
+    owner = rng.integers(0, clusters, size=queries)
+    center = centers[owner] + rng.normal(0, 0.01, size=(queries, 2))
+    radius = radii[owner] * rng.uniform(0.8, 1.2, size=queries)
+    boxes = np.concatenate([center - radius[:, None], center + radius[:, None]], axis=1)
+
+    grid = (np.arange(LOW_RES) + 0.5) / LOW_RES
+    dy = grid[None, :, None] - center[:, 1, None, None]
+    dx = grid[None, None, :] - center[:, 0, None, None]
+    logits = np.where(dx**2 + dy**2 < radius[:, None, None] ** 2, 4.0, -4.0)
+    return mx.array(boxes.astype(np.float32)), mx.array(logits.astype(np.float32))
+
+
+def greedy_nms(box_iou, mask_iou, box_threshold, mask_threshold):
+    overlaps = (box_iou > box_threshold) | (mask_iou > mask_threshold)
+    keep = np.ones(len(overlaps), dtype=bool)
+    for i in range(len(overlaps)):
+        if keep[i]:
+            keep[i + 1 :] &= ~overlaps[i, i + 1 :]
+    return keep
+
+
+def numpy_box_iou(boxes):
+    lt = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    rb = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(-1)
+    area = (boxes[:, 2:] - boxes[:, :2]).prod(-1)
+    return inter / (area[:, None] + area[None, :] - inter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--box-iou", type=float, default=0.7)
+    parser.add_argument("--mask-iou", type=float, default=0.7)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    boxes, logits = synthetic_detections(args.queries, args.clusters)
+    mx.eval(boxes, logits)
+
+    def run():
+        keep = nms(boxes, logits, box_iou_threshold=args.box_iou, mask_iou_threshold=args.mask_iou)
+        mx.eval(keep)
+        return keep
+
+    run()  # warm up
+    times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        keep = run()
+        times.append((time.perf_counter() - start) * 1000)
+
+    expected = greedy_nms(
+        numpy_box_iou(np.array(boxes)), np.array(mask_iou(logits)), args.box_iou, args.mask_iou
+    )
+    keep = np.array(keep)
+    print(
+        f"{args.queries} candidates -> {keep.sum()} kept"
+        f"  nms {statistics.median(times):.2f} ms"
+        f"  same as greedy NMS {np.array_equal(keep, expected)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Measure the throughput of pipelined processing on a stream of images.
+
+Feeds --count JPEG-encoded images (the given ones, cycled and resized to a few
+sizes) through decode, set_image, set_text_prompt and PNG encoding of the
+masks, first one after the other with blocking calls, then through
+Sam3Processor.stream, which overlaps the host work of neighbouring images
+with the device work of the current one. Reports images per second for both
+and checks that they produce the same number of detections.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/pipeline.py
+  python3 benchmarks/pipeline.py --images assets/images/appdemo.png --prompt person --count 32
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+
+SIZES = [(1920, 1080), (1280, 960), (4032, 3024), (800, 600)]
+
+
+def jpeg_stream(paths, count):
+    """`count` JPEG payloads of the images at a few sizes, encoded up front."""
+    images = [Image.open(path).convert("RGB") for path in paths]
+    payloads = []
+    for i in range(count):
+        image = images[i % len(images)].resize(SIZES[i % len(SIZES)])
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=90)
+        payloads.append(buffer.getvalue())
+    return payloads
+
+
+def encode_masks(state) -> list:
+    """PNG-encode every mask, as a client-facing service would."""
+    encoded = []
+    for mask in state["masks"]:
+        buffer = io.BytesIO()
+        Image.fromarray(np.array(mask[0]).astype(np.uint8) * 255).save(buffer, "PNG")
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def sequential(processor, payloads, prompt):
+    results = []
+    for payload in payloads:
+        state = processor.set_image(Image.open(io.BytesIO(payload)))
+        state = processor.set_text_prompt(prompt, state)
+        results.append(encode_masks(state))
+    return results
+
+
+def pipelined(processor, payloads, prompt):
+    requests = ((Image.open(io.BytesIO(payload)), prompt) for payload in payloads)
+    return list(processor.stream(requests, postprocess=encode_masks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="+", default=["assets/images/appdemo.png"])
+    parser.add_argument("--prompt", default="person")
+    parser.add_argument("--count", type=int, default=16)
+    args = parser.parse_args()
+
+    model = build_sam3_image_model()
+    processor = Sam3Processor(model)
+    payloads = jpeg_stream(args.images, args.count)
+    # Warm up kernels and caches
+    sequential(processor, payloads[:1], args.prompt)
+
+    rates = {}
+    counts = {}
+    for name, fn in (("sequential", sequential), ("pipelined", pipelined)):
+        mx.clear_cache()
+        start = time.perf_counter()
+        results = fn(processor, payloads, args.prompt)
+        elapsed = time.perf_counter() - start
+        rates[name] = len(payloads) / elapsed
+        counts[name] = [len(r) for r in results]
+        print(f"{name:<10} {elapsed * 1000:9.1f} ms  {rates[name]:6.2f} images/s")
+    print(
+        f"speedup {rates['pipelined'] / rates['sequential']:.2f}x"
+        f"  same detections {counts['sequential'] == counts['pipelined']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
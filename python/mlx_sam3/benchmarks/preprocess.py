@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Time the image preprocessing of Sam3Processor, step by step, against the
+previous float32 transform.
+
+Each input is benchmarked as given and re-encoded as a camera-sized JPEG
+(--jpeg-size), where draft-mode decoding applies. Reports the median time of
+each step, the decoded pixel count and the difference between the two
+outputs. No model weights are needed.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/preprocess.py
+  python3 benchmarks/preprocess.py --image assets/images/appdemo.png --jpeg-size 6000x4000 --runs 10
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model.sam3_image_processor import _normalize, load_rgb
+
+
+def legacy_steps(data: bytes, resolution: int):
+    """The previous transform: full decode, resize, float32 normalize on host."""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    yield "decode", img.width * img.height
+    img = img.resize((resolution, resolution), resample=Image.Resampling.LANCZOS)
+    yield "resize", None
+    img_np = np.array(img).astype(np.float32) / 255.0
+    img_np = (img_np - 0.5) / 0.5
+    yield "normalize (host)", None
+    out = mx.array(img_np).transpose(2, 0, 1)
+    mx.eval(out)
+    yield "to device", out
+
+
+def fast_steps(data: bytes, resolution: int):
+    """Sam3Processor.transform, split at its steps."""
+    img = load_rgb(Image.open(io.BytesIO(data)), resolution)
+    img.load()
+    yield "decode", img.width * img.height
+    img = img.resize((resolution, resolution), resample=Image.Resampling.LANCZOS, reducing_gap=3.0)
+    yield "resize", None
+    x = mx.array(np.asarray(img))
+    mx.eval(x)
+    yield "to device", None
+    out = _normalize(x)
+    mx.eval(out)
+    yield "normalize (device)", out
+
+
+def run(steps, data: bytes, resolution: int, runs: int):
+    times = {}
+    pixels = out = None
+    for _ in range(runs):
+        last = time.perf_counter()
+        for name, value in steps(data, resolution):
+            now = time.perf_counter()
+            times.setdefault(name, []).append(now - last)
+            last = now
+            if name == "decode":
+                pixels = value
+            elif value is not None:
+                out = value
+    medians = {name: statistics.median(t) * 1000 for name, t in times.items()}
+    return medians, pixels, out
+
+
+def report(label: str, data: bytes, resolution: int, runs: int):
+    print(f"\n{label}")
+    results = {}
+    for name, steps in (("legacy", legacy_steps), ("fast", fast_steps)):
+        medians, pixels, out = run(steps, data, resolution, runs)
+        results[name] = out
+        parts = "  ".join(f"{step} {ms:7.2f} ms" for step, ms in medians.items())
+        print(f"  {name:<7} total {sum(medians.values()):7.2f} ms  decoded {pixels / 1e6:5.1f} MP  | {parts}")
+    diff = mx.abs(results["legacy"] - results["fast"])
+    print(f"  abs difference max {diff.max().item():.4f}  mean {diff.mean().item():.4f} (inputs in [-1, 1])")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--jpeg-size", default="4032x3024", help="WxH of the re-encoded JPEG")
+    parser.add_argument("--resolution", type=int, default=1008)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        data = f.read()
+    report(f"{args.image} as given", data, args.resolution, args.runs)
+
+    width, height = (int(v) for v in args.jpeg_size.split("x"))
+    jpeg = io.BytesIO()
+    Image.open(io.BytesIO(data)).convert("RGB").resize((width, height)).save(jpeg, format="JPEG", quality=90)
+    report(f"{args.image} as a {width}x{height} JPEG", jpeg.getvalue(), args.resolution, args.runs)
+
+
+if __name__ == "__main__":
+    main()
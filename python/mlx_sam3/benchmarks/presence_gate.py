@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Measure what the presence gate saves on prompts with and without matches.
+
+Runs each text prompt on one image with Sam3Processor(presence_gate=False)
+and presence_gate=True, and reports the median latency of both and whether
+they return the same detections. Prompts for objects absent from the image
+skip the segmentation heads with the gate; present ones pay one more sync.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/presence_gate.py
+  python3 benchmarks/presence_gate.py --image assets/images/appdemo.png --prompts person giraffe piano --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+
+
+def timed(processor, state, prompt):
+    start = time.perf_counter()
+    state = processor.set_text_prompt(prompt, state)
+    mx.eval(state["scores"], state["boxes"], state["mask_logits"])
+    return (time.perf_counter() - start) * 1000, np.array(state["scores"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "giraffe", "piano", "submarine"])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    model = build_sam3_image_model()
+    processors = {
+        "ungated": Sam3Processor(model),
+        "gated": Sam3Processor(model, presence_gate=True),
+    }
+    state = processors["ungated"].set_image(Image.open(args.image))
+    # Warm up both paths
+    for processor in processors.values():
+        timed(processor, state, args.prompts[0])
+
+    for prompt in args.prompts:
+        times = {name: [] for name in processors}
+        scores = {}
+        for _ in range(args.runs):
+            for name, processor in processors.items():
+                ms, scores[name] = timed(processor, state, prompt)
+                times[name].append(ms)
+        ungated = statistics.median(times["ungated"])
+        gated = statistics.median(times["gated"])
+        same = np.array_equal(scores["ungated"], scores["gated"])
+        print(
+            f"{prompt!r:<14} detections {len(scores['gated']):3d}"
+            f"  ungated {ungated:8.1f} ms  gated {gated:8.1f} ms  same {same}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Accuracy versus latency of the input resolution buckets.
+
+Runs the same images and text prompts at each resolution and reports the
+median latency of set_image + set_text_prompt, and how closely each bucket
+reproduces the detections of the largest one: the share of its detections
+matched by a mask with IoU >= --iou, and the mean best mask IoU. Masks are
+compared at --mask-side pixels on the longer side.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/resolution_buckets.py
+  python3 benchmarks/resolution_buckets.py --images assets/images/appdemo.png --prompts person shoe --buckets 336 672 1008
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import RESOLUTION_BUCKETS, Sam3Processor
+
+
+def run(processor, image, prompt, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        state = processor.set_image(image)
+        state = processor.set_text_prompt(prompt, state)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), state
+
+
+def best_ious(reference, masks):
+    """Best IoU of each reference mask against `masks`, both [N, 1, H, W]."""
+    if len(reference) == 0:
+        return np.zeros(0)
+    if len(masks) == 0:
+        return np.zeros(len(reference))
+    ref = reference.reshape(len(reference), -1).astype(np.float32)
+    out = masks.reshape(len(masks), -1).astype(np.float32)
+    inter = ref @ out.T
+    union = ref.sum(1)[:, None] + out.sum(1)[None, :] - inter
+    return (inter / np.maximum(union, 1)).max(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="+", default=["assets/images/appdemo.png"])
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "car"])
+    parser.add_argument("--buckets", type=int, nargs="+", default=list(RESOLUTION_BUCKETS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--mask-side", type=int, default=256)
+    args = parser.parse_args()
+
+    model = build_sam3_image_model()
+    buckets = sorted(args.buckets, reverse=True)
+    processors = {res: Sam3Processor(model, resolution=res) for res in buckets}
+    images = [Image.open(path).convert("RGB") for path in args.images]
+
+    latency = {res: [] for res in buckets}
+    matched = {res: [] for res in buckets}
+    for image in images:
+        for prompt in args.prompts:
+            reference = None
+            for res in buckets:
+                # Warm up this bucket's kernels and caches
+                run(processors[res], image, prompt, 1)
+                ms, state = run(processors[res], image, prompt, args.runs)
+                latency[res].append(ms)
+                masks = np.array(state["masks"].resized(args.mask_side))
+                if reference is None:
+                    reference = masks
+                matched[res].append(best_ious(reference, masks))
+                mx.clear_cache()
+
+    print(f"{'resolution':>10}  {'latency ms':>10}  {'matched':>8}  {'mean IoU':>8}")
+    for res in buckets:
+        ious = np.concatenate(matched[res])
+        share = (ious >= args.iou).mean() if len(ious) else float("nan")
+        mean = ious.mean() if len(ious) else float("nan")
+        print(f"{res:>10}  {statistics.median(latency[res]):>10.1f}  {share:>8.2f}  {mean:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
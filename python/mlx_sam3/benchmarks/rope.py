@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Compare the real-valued rotary embedding of the ViT blocks with the complex one.
+
+For a windowed and a global attention block of the SAM3 ViT at --resolution,
+checks that apply_rotary_real (cos and sin tables, fused pair rotation)
+matches apply_rotary_enc (complex64 tables) on random queries and keys within
+--tolerance (the exit status is 1 otherwise), and reports the median latency of the rotation of both per block, and summed over
+the blocks of the trunk (28 windowed, 4 global). No weights are needed.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/rope.py
+  python3 benchmarks/rope.py --resolution 672 --runs 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3.model.vitdet import Attention, apply_rotary_enc, apply_rotary_real
+
+PATCH_SIZE = 14
+WINDOW_SIZE = 24
+NUM_HEADS = 16
+HEAD_DIM = 64
+BLOCKS = {"windowed": 28, "global": 4}
+
+
+def median_ms(fn, runs):
+    mx.eval(fn())
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        mx.eval(fn())
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolution", type=int, default=1008)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Largest max |diff| accepted")
+    args = parser.parse_args()
+
+    side = args.resolution // PATCH_SIZE
+    windows = (side // WINDOW_SIZE) ** 2
+    # (batch of windows, grid) of the queries and keys of each block type
+    shapes = {"windowed": (windows, (WINDOW_SIZE, WINDOW_SIZE)), "global": (1, (side, side))}
+
+    totals = {"complex": 0.0, "real": 0.0}
+    failed = []
+    print(f"{'block':<10}{'max |diff|':>12}{'complex ms':>12}{'real ms':>10}{'speedup':>9}")
+    for name, (batch, hw) in shapes.items():
+        attn = Attention(
+            NUM_HEADS * HEAD_DIM,
+            NUM_HEADS,
+            input_size=hw,
+            cls_token=False,
+            use_rope=True,
+            rope_pt_size=(WINDOW_SIZE, WINDOW_SIZE),
+            rope_interp=True,
+        )
+        freqs_cis = attn._compute_freqs_cis(hw)
+        cos, sin = attn._get_rope_tables(hw)
+        q = mx.random.normal((batch, NUM_HEADS, hw[0] * hw[1], HEAD_DIM))
+        k = mx.random.normal(q.shape)
+        mx.eval(q, k, freqs_cis, cos, sin)
+
+        reference = apply_rotary_enc(q, k, freqs_cis)
+        out = apply_rotary_real(q, k, cos, sin)
+        diff = max(mx.abs(a - b).max().item() for a, b in zip(reference, out))
+        if not diff <= args.tolerance:
+            failed.append(name)
+
+        complex_ms = median_ms(lambda: apply_rotary_enc(q, k, freqs_cis), args.runs)
+        real_ms = median_ms(lambda: apply_rotary_real(q, k, cos, sin), args.runs)
+        totals["complex"] += complex_ms * BLOCKS[name]
+        totals["real"] += real_ms * BLOCKS[name]
+        print(f"{name:<10}{diff:>12.2e}{complex_ms:>12.2f}{real_ms:>10.2f}{complex_ms / real_ms:>8.2f}x")
+    print(
+        f"{'trunk':<10}{'':>12}{totals['complex']:>12.2f}{totals['real']:>10.2f}"
+        f"{totals['complex'] / totals['real']:>8.2f}x"
+    )
+
+    if failed:
+        print(f"FAIL: {', '.join(failed)} differ by more than {args.tolerance:.0e}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Report the bytes each image session keeps alive after set_image.
+
+Compares the full backbone output (every FPN level plus a private copy of the
+positional encodings, as sessions used to store it) with the compact state
+stored by Sam3Processor, in float32 and in the optional reduced feature dtypes.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/session_memory.py
+  python3 benchmarks/session_memory.py --image assets/images/appdemo.png --sessions 4
+"""
+import argparse
+import os
+import sys
+
+import mlx.core as mx
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor, state_nbytes
+
+DTYPES = {"float32": None, "float16": mx.float16, "bfloat16": mx.bfloat16}
+
+
+def mb(nbytes: int) -> str:
+    return f"{nbytes / (1024 * 1024):8.1f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--sessions", type=int, default=3, help="sessions to open per configuration")
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    model = build_sam3_image_model()
+
+    # Previous layout: the full output, with the positional encodings copied per session
+    processor = Sam3Processor(model)
+    full = model.backbone.call_image(processor.transform(image)[None])
+    mx.eval(full)
+    full_bytes = state_nbytes(full)["owned"]
+    print(f"{'full backbone_out':<24} owned {mb(full_bytes)}")
+    del full
+
+    for name, dtype in DTYPES.items():
+        processor = Sam3Processor(model, feature_dtype=dtype)
+        mx.clear_cache()
+        before = mx.get_active_memory()
+        states = [processor.set_image(image) for _ in range(args.sessions)]
+        grown = (mx.get_active_memory() - before) / args.sessions
+        nbytes = state_nbytes(states[0], shared=processor.shared_arrays())
+        print(
+            f"{'compact ' + name:<24} owned {mb(nbytes['owned'])}"
+            f"  shared {mb(nbytes['shared'])}"
+            f"  active memory per session {mb(grown)}"
+            f"  ({full_bytes / nbytes['owned']:.1f}x smaller)"
+        )
+        del states
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Measure tiled segmentation of a large image.
+
+Runs Sam3Processor.segment_tiled on an image (upscaled to --size if given)
+for each --batch-size, and reports the number of tiles, wall time, peak MLX
+memory and the merged detections. For comparison, also runs the regular
+set_image + set_text_prompt path, which sees the image resized to the model
+resolution.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/tiled.py
+  python3 benchmarks/tiled.py --image assets/images/appdemo.png --size 6000x8000 --prompt person --batch-size 1 2 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import mlx.core as mx
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+from sam3.model.tiling import tile_origins, tile_stride
+
+
+def measure(fn):
+    mx.clear_cache()
+    mx.reset_peak_memory()
+    start = time.perf_counter()
+    out = fn()
+    mx.eval(out["scores"])
+    return out, (time.perf_counter() - start) * 1000, mx.get_peak_memory() / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="assets/images/appdemo.png")
+    parser.add_argument("--size", default=None, help="HxW to upscale the image to")
+    parser.add_argument("--prompt", default="person")
+    parser.add_argument("--overlap", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    if args.size is not None:
+        height, width = (int(v) for v in args.size.split("x"))
+        image = image.resize((width, height), resample=Image.Resampling.BICUBIC)
+    width, height = image.size
+
+    model = build_sam3_image_model()
+    processor = Sam3Processor(model)
+
+    def regular():
+        state = processor.set_image(image)
+        return processor.set_text_prompt(args.prompt, state)
+
+    out, ms, mb = measure(regular)
+    print(f"{width}x{height} resized to {processor.resolution}: {ms:8.1f} ms {mb:8.1f} MB  detections {len(out['scores'])}")
+
+    stride = tile_stride(processor.resolution, processor._mask_size(), args.overlap)
+    tiles = len(tile_origins(height, processor.resolution, stride)) * len(tile_origins(width, processor.resolution, stride))
+    for batch_size in args.batch_size:
+        out, ms, mb = measure(
+            lambda: processor.segment_tiled(image, args.prompt, tile_overlap=args.overlap, batch_size=batch_size)
+        )
+        print(
+            f"{width}x{height} tiled, {tiles} tiles, batch {batch_size}: {ms:8.1f} ms {mb:8.1f} MB"
+            f"  detections {len(out['scores'])}"
+        )
+
+
+if __name__ == "__main__":
+    main()
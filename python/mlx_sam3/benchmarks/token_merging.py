@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Speed and accuracy sweep of token merging.
+
+Builds the model once and, for each of --ratios, merges that ratio of the
+image tokens in the global ViT blocks and the fusion encoder self-attention
+(model_builder.set_token_merge_ratio), runs the same images and text prompts,
+and reports the median latency of set_image + set_text_prompt and the mask
+accuracy against ratio 0 (no merging): the share of the reference detections
+matched by a mask with IoU >= --iou, and the mean best mask IoU. Masks are
+compared at --mask-side pixels on the longer side.
+
+The model runs eagerly: compiled stages keep the ratio they were traced with.
+
+Run from the python/mlx_sam3 directory:
+  python3 benchmarks/token_merging.py
+  python3 benchmarks/token_merging.py --images assets/images/appdemo.png --prompts person --ratios 0.25 0.5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import mlx.core as mx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sam3 import build_sam3_image_model
+from sam3.model.sam3_image_processor import Sam3Processor
+from sam3.model.token_merging import MAX_MERGE_RATIO
+from sam3.model_builder import set_token_merge_ratio
+
+
+def run(processor, image, prompt, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        state = processor.set_image(image)
+        state = processor.set_text_prompt(prompt, state)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), state
+
+
+def best_ious(reference, masks):
+    """Best IoU of each reference mask against `masks`, both [N, 1, H, W]."""
+    if len(reference) == 0:
+        return np.zeros(0)
+    if len(masks) == 0:
+        return np.zeros(len(reference))
+    ref = reference.reshape(len(reference), -1).astype(np.float32)
+    out = masks.reshape(len(masks), -1).astype(np.float32)
+    inter = ref @ out.T
+    union = ref.sum(1)[:, None] + out.sum(1)[None, :] - inter
+    return (inter / np.maximum(union, 1)).max(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="+", default=["assets/images/appdemo.png"])
+    parser.add_argument("--prompts", nargs="+", default=["person", "shoe", "car"])
+    parser.add_argument("--ratios", nargs="+", type=float, default=[0.1, 0.25, 0.4, 0.5, 0.6, MAX_MERGE_RATIO])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--mask-side", type=int, default=256)
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    requests = [(image, prompt) for image in images for prompt in args.prompts]
+    model = build_sam3_image_model()
+    processor = Sam3Processor(model)
+
+    # Ratio 0 is the reference
+    reference = {}
+    results = {}
+    for ratio in [0.0, *args.ratios]:
+        set_token_merge_ratio(model, ratio)
+        latency, matched = [], []
+        for i, (image, prompt) in enumerate(requests):
+            # Warm up kernels and caches
+            run(processor, image, prompt, 1)
+            ms, state = run(processor, image, prompt, args.runs)
+            latency.append(ms)
+            masks = np.array(state["masks"].resized(args.mask_side))
+            if ratio == 0.0:
+                reference[i] = masks
+            matched.append(best_ious(reference[i], masks))
+        results[ratio] = (statistics.median(latency), np.concatenate(matched))
+        mx.clear_cache()
+
+    base_ms = results[0.0][0]
+    print(f"{'ratio':>6}  {'latency ms':>10}  {'speedup':>7}  {'matched':>8}  {'mean IoU':>8}")
+    for ratio, (ms, ious) in results.items():
+        share = (ious >= args.iou).mean() if len(ious) else float("nan")
+        mean = ious.mean() if len(ious) else float("nan")
+        print(f"{ratio:>6.2f}  {ms:>10.1f}  {base_ms / ms:>6.2f}x  {share:>8.2f}  {mean:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import torch
 import argparse
 import json
 from pathlib import Path
@@ -6,7 +5,9 @@ import shutil
 from typing import Dict, Union, Optional
 
 import mlx.core as mx
-from huggingface_hub import snapshot_download
+
+# torch and huggingface_hub are imported where used: building the model from
+# local weights needs neither
 
 
 MLX_COMMUNITY_REPO = "mlx-community/sam3-image"
@@ -17,6 +18,8 @@ def load_from_hub(
     hf_repo: str = MLX_COMMUNITY_REPO,
     local_dir: Optional[str] = None,
 ) -> Path:
+    from huggingface_hub import snapshot_download
+
     download_kwargs = {
         "repo_id": hf_repo,
         "allow_patterns": ["*.safetensors", "*.json"],
@@ -34,7 +37,11 @@ def load_from_hub(
     return weights_file
 
 
-def save_weights(save_path: Union[str, Path], weights: Dict[str, mx.array]) -> None:
+def save_weights(
+    save_path: Union[str, Path],
+    weights: Dict[str, mx.array],
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
     if isinstance(save_path, str):
         save_path = Path(save_path)
     save_path.mkdir(parents=True, exist_ok=True)
@@ -43,7 +50,7 @@ def save_weights(save_path: Union[str, Path], weights: Dict[str, mx.array]) -> N
     index_data = {"metadata": {"total_size": total_size}, "weight_map": {}}
 
     model_path = save_path / "model.safetensors"
-    mx.save_safetensors(str(model_path), weights)
+    mx.save_safetensors(str(model_path), weights, metadata=metadata)
     
     for weight_name in weights.keys():
         index_data["weight_map"][weight_name] = "model.safetensors"
@@ -56,6 +63,8 @@ def save_weights(save_path: Union[str, Path], weights: Dict[str, mx.array]) -> N
         json.dump(index_data, f, indent=4)
 
 def download(hf_repo):
+    from huggingface_hub import snapshot_download
+
     return Path(
         snapshot_download(
             repo_id=hf_repo,
@@ -90,6 +99,8 @@ def update_attn_keys(key, mlx_weights):
         mlx_weights.update(new_dict)
         
 def convert(model_path):
+    import torch
+
     weight_file = str(model_path / "sam3.pt")
     weights = torch.load(weight_file, map_location="cpu", weights_only=True)
 
@@ -181,8 +192,79 @@ def download_and_convert(
     return weights_file
     
 
+def quantize_checkpoint(
+    mlx_path: Union[str, Path],
+    checkpoint_path: Optional[Union[str, Path]] = None,
+    bits: int = 8,
+    group_size: int = 64,
+    exclude=(),
+) -> Path:
+    """Saves a quantized copy of the float checkpoint at `checkpoint_path`
+    (the MLX Community weights by default) to `mlx_path`, see
+    `model_builder.quantize_model`. The quantization parameters are stored in
+    the safetensors metadata, from which `build_sam3_image_model` rebuilds
+    the quantized layers."""
+    from mlx.utils import tree_flatten
+
+    from sam3.model_builder import build_sam3_image_model
+
+    model = build_sam3_image_model(
+        checkpoint_path=checkpoint_path,
+        quantize_bits=bits,
+        quantize_group_size=group_size,
+        quantize_exclude=exclude,
+    )
+    weights = dict(tree_flatten(model.parameters()))
+    config = {"bits": bits, "group_size": group_size, "exclude": list(exclude)}
+    save_weights(mlx_path, weights, metadata={"quantization": json.dumps(config)})
+    return Path(mlx_path) / "model.safetensors"
+
+
+def half_checkpoint(
+    mlx_path: Union[str, Path],
+    checkpoint_path: Optional[Union[str, Path]] = None,
+    dtype: str = "float16",
+) -> Path:
+    """Saves a copy of the float32 checkpoint at `checkpoint_path` (the MLX
+    Community weights by default) cast to `dtype` ("float16" or "bfloat16")
+    to `mlx_path`, see `model_builder.cast_model`: about half the size, and
+    half the load I/O. The float32 islands are saved as float32."""
+    from mlx.utils import tree_flatten
+
+    from sam3.model_builder import build_sam3_image_model
+
+    model = build_sam3_image_model(checkpoint_path=checkpoint_path, dtype=getattr(mx, dtype))
+    weights = dict(tree_flatten(model.parameters()))
+    save_weights(mlx_path, weights, metadata={"dtype": dtype})
+    return Path(mlx_path) / "model.safetensors"
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download SAM-3 MLX weights or convert from PyTorch")
+    subparsers = parser.add_subparsers(dest="command")
+    quantize_parser = subparsers.add_parser(
+        "quantize", help="Save a quantized checkpoint (8 or 4 bit linear layers)"
+    )
+    quantize_parser.add_argument("--bits", type=int, choices=(4, 8), default=8)
+    quantize_parser.add_argument("--group-size", type=int, choices=(32, 64, 128), default=64)
+    quantize_parser.add_argument(
+        "--exclude",
+        nargs="*",
+        default=[],
+        help="Module paths or globs of linear layers to keep in float, e.g. transformer.decoder.bbox_embed",
+    )
+    quantize_parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Float model.safetensors to quantize (default: the MLX Community weights)",
+    )
+    quantize_parser.add_argument(
+        "--mlx-path",
+        type=str,
+        default=None,
+        help="Directory to save the quantized weights to (default: sam3-<bits>bit)",
+    )
     parser.add_argument(
         "--mlx-repo",
         default=MLX_COMMUNITY_REPO,
@@ -206,9 +288,35 @@ if __name__ == "__main__":
         action="store_true",
         help="Convert from PyTorch weights instead of loading pre-converted MLX weights"
     )
+    half_parser = subparsers.add_parser(
+        "half", help="Save a float16 or bfloat16 checkpoint, with float32 islands"
+    )
+    half_parser.add_argument("--dtype", choices=("float16", "bfloat16"), default="float16")
+    half_parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="Float32 model.safetensors to cast (default: the MLX Community weights)",
+    )
+    half_parser.add_argument(
+        "--mlx-path",
+        type=str,
+        default=None,
+        help="Directory to save the cast weights to (default: sam3-<dtype>)",
+    )
     args = parser.parse_args()
 
-    if args.convert:
+    if args.command == "quantize":
+        mlx_path = args.mlx_path or f"sam3-{args.bits}bit"
+        weights_path = quantize_checkpoint(
+            mlx_path, args.checkpoint, args.bits, args.group_size, args.exclude
+        )
+        print(f"{args.bits}-bit weights saved to {weights_path}")
+    elif args.command == "half":
+        mlx_path = args.mlx_path or f"sam3-{args.dtype}"
+        weights_path = half_checkpoint(mlx_path, args.checkpoint, args.dtype)
+        print(f"{args.dtype} weights saved to {weights_path}")
+    elif args.convert:
         mlx_path = args.mlx_path or "sam3-mod-weights"
         print(f"Converting PyTorch weights from {args.pytorch_repo}...")
         model_path = download(args.pytorch_repo)
@@ -0,0 +1,179 @@
+"""
+Memory-bounded attention.
+
+mx.fast.scaled_dot_product_attention runs as one fused kernel on the GPU.
+Where it does not, e.g. on the CPU backend, it materializes the
+[B, heads, queries, keys] score matrix: at 1008 pixels a global ViT block
+(16 heads over 72 x 72 = 5184 tokens) and the fusion encoder self-attention
+(8 heads) hold 1.7 GB and 0.86 GB of float32 scores. `attention` then
+splits the queries, and if needed the keys, into chunks whose scores fit a
+memory cap, and combines the key chunks with an online softmax.
+
+Chunking only bounds memory if each chunk is evaluated before the next one
+is built, which forces the graph upstream of the attention to run while it
+is being built. Callers that evaluate right away opt in with
+`bound_attention_memory()`: Sam3Processor.set_image, segment_tiled and the
+synchronous prompting calls. set_image(blocking=False) opts in too when a
+ViT attention at the image's resolution exceeds its cap, trading its
+pipelining for bounded memory. Elsewhere attention stays lazy and unchunked:
+set_text_prompt_async keeps its pipelining but holds the full scores, and
+graphs built to read shapes and never evaluated are not run.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import mlx.core as mx
+
+from .compile_cache import is_tracing
+
+# Default cap on the score matrix of one attention call, in bytes
+ATTENTION_MEMORY_CAP = 256 * 2**20
+
+# Below this many queries per chunk, the keys are chunked too
+MIN_QUERY_CHUNK = 64
+
+_state = threading.local()
+
+
+@contextmanager
+def bound_attention_memory():
+    """Within this context, on this thread, `attention` chunks the attentions
+    over their memory cap and evaluates each chunk as it is built. For
+    callers that evaluate the graph they build right away."""
+    _state.depth = getattr(_state, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+
+
+def attention_memory_bounded() -> bool:
+    """Whether this thread is within `bound_attention_memory()`."""
+    return getattr(_state, "depth", 0) > 0
+
+
+def fused_attention_available() -> bool:
+    """Whether mx.fast.scaled_dot_product_attention runs fused, without
+    materializing the scores: on the GPU."""
+    return mx.default_device().type == mx.DeviceType.gpu
+
+
+def score_matrix_nbytes(q: mx.array, k: mx.array) -> int:
+    """Size of the [B, heads, Lq, Lk] scores of unfused attention."""
+    B, H, Lq, _ = q.shape
+    return B * H * Lq * k.shape[2] * q.dtype.size
+
+
+def _slice_mask(mask: mx.array, q_start: int, q_stop: int, k_start: int, k_stop: int) -> mx.array:
+    """The [..., q_start:q_stop, k_start:k_stop] block of a mask broadcast
+    over the scores; broadcast (size 1) dimensions are kept as is."""
+    if mask.shape[-2] > 1:
+        mask = mask[..., q_start:q_stop, :]
+    if mask.shape[-1] > 1:
+        mask = mask[..., k_start:k_stop]
+    return mask
+
+
+def chunked_attention(
+    q: mx.array,
+    k: mx.array,
+    v: mx.array,
+    scale: float,
+    mask: Optional[mx.array] = None,
+    memory_cap: int = ATTENTION_MEMORY_CAP,
+) -> mx.array:
+    """scaled_dot_product_attention on [B, heads, L, D] arrays, with at most
+    `memory_cap` bytes of float32 scores per chunk. `mask` is boolean (True
+    attends) or additive, broadcastable to [B, heads, Lq, Lk].
+
+    Queries are split first; only when fewer than MIN_QUERY_CHUNK queries fit
+    the cap are the keys split as well, the chunks of one query block then
+    being accumulated with an online (running max and sum) softmax.
+
+    Each chunk is evaluated before the next one is built: within one eval
+    the CPU backend allocates the outputs of the whole graph up front, which
+    would hold the scores of every chunk at once. Called directly while a
+    compiled stage is traced, chunks are left unevaluated (see
+    compile_cache.is_tracing).
+    """
+    B, H, Lq, _ = q.shape
+    Lk = k.shape[2]
+    q_chunk = max(1, memory_cap // (B * H * Lk * 4))
+    k_chunk = Lk
+    if q_chunk < min(Lq, MIN_QUERY_CHUNK):
+        q_chunk = min(Lq, MIN_QUERY_CHUNK)
+        k_chunk = max(1, memory_cap // (B * H * q_chunk * 4))
+    evaluate = not is_tracing()
+
+    def block_scores(q_block, q_start, q_stop, k_start, k_stop):
+        scores = (q_block @ k[:, :, k_start:k_stop].swapaxes(-1, -2)).astype(mx.float32)
+        if mask is None:
+            return scores
+        block_mask = _slice_mask(mask, q_start, q_stop, k_start, k_stop)
+        if block_mask.dtype == mx.bool_:
+            return mx.where(block_mask, scores, -float("inf"))
+        return scores + block_mask.astype(mx.float32)
+
+    q = q * scale
+    outputs = []
+    for q_start in range(0, Lq, q_chunk):
+        q_stop = min(q_start + q_chunk, Lq)
+        q_block = q[:, :, q_start:q_stop]
+        if k_chunk == Lk:
+            # Not bound to a name, so that the softmax reuses the scores buffer
+            out = mx.softmax(block_scores(q_block, q_start, q_stop, 0, Lk), axis=-1).astype(v.dtype) @ v
+        else:
+            running_max = running_sum = acc = None
+            for k_start in range(0, Lk, k_chunk):
+                k_stop = min(k_start + k_chunk, Lk)
+                scores = block_scores(q_block, q_start, q_stop, k_start, k_stop)
+                block_max = scores.max(axis=-1, keepdims=True)
+                new_max = block_max if running_max is None else mx.maximum(running_max, block_max)
+                # Rows masked so far have a max of -inf: shift them by 0 instead
+                shift = mx.where(mx.isinf(new_max), 0.0, new_max)
+                probs = mx.exp(scores - shift)
+                del scores
+                block_out = (probs.astype(v.dtype) @ v[:, :, k_start:k_stop]).astype(mx.float32)
+                if running_max is None:
+                    running_sum = probs.sum(axis=-1, keepdims=True)
+                    acc = block_out
+                else:
+                    correction = mx.exp(running_max - shift)
+                    running_sum = running_sum * correction + probs.sum(axis=-1, keepdims=True)
+                    acc = acc * correction + block_out
+                running_max = new_max
+                if evaluate:
+                    mx.eval(running_max, running_sum, acc)
+            out = acc / running_sum
+        out = out.astype(q.dtype)
+        if evaluate:
+            mx.eval(out)
+        outputs.append(out)
+    return outputs[0] if len(outputs) == 1 else mx.concatenate(outputs, axis=2)
+
+
+def attention(
+    q: mx.array,
+    k: mx.array,
+    v: mx.array,
+    scale: float,
+    mask: Optional[mx.array] = None,
+    memory_cap: Optional[int] = ATTENTION_MEMORY_CAP,
+) -> mx.array:
+    """mx.fast.scaled_dot_product_attention, or `chunked_attention` when the
+    fused kernel is unavailable, the scores would exceed `memory_cap` bytes
+    and the caller opted in with `bound_attention_memory()`. A `memory_cap`
+    of None always uses the former, as do compiled stages: chunks cannot be
+    evaluated one by one within a compiled graph, which then holds them all
+    at once anyway."""
+    if (
+        memory_cap is not None
+        and attention_memory_bounded()
+        and not fused_attention_available()
+        and not is_tracing()
+        and score_matrix_nbytes(q, k) > memory_cap
+    ):
+        return chunked_attention(q, k, v, scale, mask=mask, memory_cap=memory_cap)
+    return mx.fast.scaled_dot_product_attention(q, k, v, scale=scale, mask=mask)
@@ -0,0 +1,112 @@
+"""
+mx.compile'd model stages.
+
+mx.compile traces a function once per set of input shapes and reuses the
+traced graph for later calls with the same shapes. Prompt sizes vary from
+call to call (text length, number of boxes), so the compiled paths pad them to
+a few bucket sizes, with the padding masked, to keep the number of traced
+graphs small.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Sequence, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_flatten
+
+# Token counts of the text prompts (start and end tokens included), up to the
+# text encoder's context length
+TEXT_LENGTH_BUCKETS = (8, 16, 32)
+
+# Number of box prompts per image
+BOX_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16)
+
+
+def bucket_size(n: int, buckets: Sequence[int]) -> int:
+    """Smallest bucket of at least `n`, or `n` itself past the largest one."""
+    for size in sorted(buckets):
+        if size >= n:
+            return size
+    return n
+
+
+def pad_prompt_boxes(boxes: mx.array, mask: mx.array, labels: mx.array, buckets=BOX_COUNT_BUCKETS):
+    """Pads [N, B, 4] boxes, their [B, N] padding mask (True is padding) and
+    [N, B] labels to a bucket of N. Padded boxes are masked."""
+    pad = bucket_size(boxes.shape[0], buckets) - boxes.shape[0]
+    if pad == 0:
+        return boxes, mask, labels
+    boxes = mx.pad(boxes, ((0, pad), (0, 0), (0, 0)))
+    mask = mx.concatenate([mask, mx.ones((mask.shape[0], pad), dtype=mask.dtype)], axis=1)
+    labels = mx.pad(labels, ((0, pad), (0, 0)))
+    return boxes, mask, labels
+
+
+_state = threading.local()
+
+
+def is_tracing() -> bool:
+    """Whether a CompiledFunction is building or tracing its graph on this
+    thread. Arrays cannot be evaluated then."""
+    return getattr(_state, "depth", 0) > 0
+
+
+@contextmanager
+def _tracing():
+    _state.depth = getattr(_state, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+
+
+class CompiledFunction:
+    """`fn` compiled with mx.compile, counting how often its traced graphs are
+    reused.
+
+    A call is keyed by the shapes and dtypes of the arrays in its arguments
+    (and the values of the other leaves): the first call with a key traces a
+    new graph (a miss), later ones reuse it (a hit). `inputs` are the implicit
+    inputs of mx.compile, e.g. the module whose weights `fn` reads, so that
+    updated weights are picked up.
+    """
+
+    def __init__(self, fn: Callable, inputs=None):
+        self.fn = fn
+        self.compiled = mx.compile(fn, inputs=inputs)
+        self.keys = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        key = self._key(args)
+        if key in self.keys:
+            self.hits += 1
+            return self.compiled(*args)
+        self.misses += 1
+        self.keys.add(key)
+        with _tracing():
+            # Builds, without evaluating, the eager graph once: caches filled
+            # on first use (RoPE tables, coordinates) then hold regular arrays
+            # rather than traced ones, and do not change the inputs between
+            # the trace and the next call
+            self.fn(*args)
+            return self.compiled(*args)
+
+    @staticmethod
+    def _key(args) -> Tuple:
+        return tuple(
+            (path, v.shape, v.dtype) if isinstance(v, mx.array) else (path, v)
+            for path, v in tree_flatten(args)
+        )
+
+    def stats(self) -> Dict:
+        """Traced graphs, hits, misses and hit rate of the calls so far."""
+        calls = self.hits + self.misses
+        return {
+            "graphs": len(self.keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / calls if calls else 0.0,
+        }
@@ -0,0 +1,92 @@
+"""
+CPU implementations of the conv layers of the image path.
+
+On the CPU backend, MLX runs convolutions through its generic convolution
+path, and normalization layers as separate passes over their input. A few
+layers of the image path have cheaper equivalents there:
+
+- the patch embedding is a convolution whose stride equals its kernel
+  (14 x 14), i.e. one matmul over the non-overlapping patches;
+- the 2 x 2 stride 2 transposed convolutions of the neck do not overlap
+  either: one matmul to kh * kw * out channels per pixel, then a pixel
+  shuffle;
+- the GroupNorm + ReLU after each pixel decoder conv is a few passes over up
+  to 288 x 288 x 256 activations; here the normalization, the affine
+  transform and the ReLU are one pass once the group statistics are known.
+
+The modules use these when `cpu_kernels_enabled()`, i.e. when the default
+device is the CPU, and the MLX layers otherwise.
+"""
+
+from typing import Optional
+
+import mlx.core as mx
+import mlx.nn as nn
+
+
+def cpu_kernels_enabled() -> bool:
+    """Whether the layers below run their CPU implementations: when the
+    default device is the CPU."""
+    return mx.default_device().type == mx.DeviceType.cpu
+
+
+def patch_embed(x: mx.array, weight: mx.array, bias: Optional[mx.array] = None) -> mx.array:
+    """nn.Conv2d with a stride equal to its kernel and no padding, on a
+    [B, C, H, W] input and a [O, kh, kw, C] weight, as a matmul over the
+    patches; [B, H // kh, W // kw, O]."""
+    B, C, H, W = x.shape
+    O, kh, kw, _ = weight.shape
+    Hp, Wp = H // kh, W // kw
+    # The convolution drops the rows and columns past the last full patch
+    x = x[:, :, : Hp * kh, : Wp * kw]
+    patches = x.reshape(B, C, Hp, kh, Wp, kw).transpose(0, 2, 4, 3, 5, 1).reshape(B, Hp, Wp, kh * kw * C)
+    weight = weight.reshape(O, kh * kw * C)
+    if bias is None:
+        return patches @ weight.T
+    return mx.addmm(bias, patches, weight.T)
+
+
+def conv_transpose_nonoverlapping(x: mx.array, weight: mx.array, bias: Optional[mx.array] = None) -> mx.array:
+    """nn.ConvTranspose2d with a stride equal to its kernel and no padding,
+    on a [B, H, W, C] input and a [O, kh, kw, C] weight, as a matmul and a
+    pixel shuffle; [B, H * kh, W * kw, O]."""
+    B, H, W, C = x.shape
+    O, kh, kw, _ = weight.shape
+    # Rows ordered (kh, kw, O) so that each output pixel is contiguous
+    weight = weight.transpose(1, 2, 0, 3).reshape(kh * kw * O, C)
+    y = x @ weight.T
+    if bias is not None:
+        y = y + mx.tile(bias, kh * kw)
+    return y.reshape(B, H, W, kh, kw, O).transpose(0, 1, 3, 2, 4, 5).reshape(B, H * kh, W * kw, O)
+
+
+@mx.compile
+def _scale_shift_relu(x: mx.array, scale: mx.array, shift: mx.array) -> mx.array:
+    return mx.maximum(x * scale + shift, 0)
+
+
+def group_norm_relu(norm: nn.GroupNorm, x: mx.array) -> mx.array:
+    """nn.relu(norm(x)) for an affine nn.GroupNorm: the group statistics and
+    the affine transform are folded into a per channel scale and shift,
+    applied with the ReLU in one compiled pass."""
+    batch, *rest, dims = x.shape
+    num_groups = norm.num_groups
+    if norm.pytorch_compatible:
+        # Contiguous groups of channels
+        groups = x.reshape(batch, -1, num_groups, dims // num_groups)
+        axes = (1, 3)
+    else:
+        # Channels c and c + num_groups in the same group
+        groups = x.reshape(batch, -1, num_groups)
+        axes = (1,)
+    mean = groups.mean(axis=axes)
+    rstd = mx.rsqrt(groups.var(axis=axes) + norm.eps)
+    # [B, groups] -> [B, channels]
+    if norm.pytorch_compatible:
+        mean, rstd = (mx.repeat(a, dims // num_groups, axis=-1) for a in (mean, rstd))
+    else:
+        mean, rstd = (mx.tile(a, (1, dims // num_groups)) for a in (mean, rstd))
+    scale = norm.weight * rstd
+    shift = norm.bias - mean * scale
+    shape = (batch, *(1 for _ in rest), dims)
+    return _scale_shift_relu(x, scale.reshape(shape), shift.reshape(shape))
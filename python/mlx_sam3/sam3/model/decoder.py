@@ -13,6 +13,7 @@ from .model_misc import (
     inverse_sigmoid,
     MultiheadAttentionWrapper as MultiHeadAttention
 )
+from .positional_buffers import POSITIONAL_BUFFERS
 
 
 class TransformerDecoderLayer(nn.Module):
@@ -75,7 +76,7 @@ class TransformerDecoderLayer(nn.Module):
         memory_text: Optional[mx.array] = None,  # num_token, bs, d_model
         text_attention_mask: Optional[mx.array] = None,  # bs, num_token
         # for memory
-        memory: Optional[mx.array] = None,  # hw, bs, d_model
+        memory: Optional[mx.array] = None,  # bs, hw, d_model
         memory_key_padding_mask: Optional[mx.array] = None,
         memory_level_start_index: Optional[mx.array] = None,  # num_levels
         memory_spatial_shapes: Optional[mx.array] = None,  # bs, num_levels, 2
@@ -146,14 +147,10 @@ class TransformerDecoderLayer(nn.Module):
         # Cross attention to image
         tgt2 = self.cross_attn(
             queries=self.with_pos_embed(tgt, tgt_query_pos).transpose(1, 0, 2),
-            keys=self.with_pos_embed(memory, memory_pos).transpose(1, 0, 2),
-            values=memory.transpose(1, 0, 2),
+            keys=self.with_pos_embed(memory, memory_pos),
+            values=memory,
             attn_mask=cross_attn_mask,
-            key_padding_mask=(
-                memory_key_padding_mask.transpose(0, 1)
-                if memory_key_padding_mask is not None
-                else None
-            ),
+            key_padding_mask=memory_key_padding_mask,
         ).transpose(1, 0, 2)
         
         tgt = tgt + self.dropout1(tgt2)
@@ -256,17 +253,10 @@ class TransformerDecoder(nn.Module):
             n_input = 4 if boxRPB == "both" else 2
             self.boxRPB_embed_x = MLP(n_input, d_model, nheads, 2)
             self.boxRPB_embed_y = MLP(n_input, d_model, nheads, 2)
-            self.compilable_cord_cache = None
-            self.compilable_stored_size = None
-            self.coord_cache = {}
 
             if resolution is not None and stride is not None:
                 feat_size = resolution // stride
-                coords_h, coords_w = self._get_coords(
-                    feat_size, feat_size
-                )
-                self.compilable_cord_cache = (coords_h, coords_w)
-                self.compilable_stored_size = (feat_size, feat_size)
+                self._get_coords(feat_size, feat_size)
         
         # uses torchvision
         self.roi_pooler = None
@@ -296,31 +286,30 @@ class TransformerDecoder(nn.Module):
 
         self.compiled_mode = compile_mode
         self.compiled = False
+
+        # Only the last layer outputs, see model_builder.set_inference_mode
+        self.inference_mode = False
         
         for layer_idx, layer in enumerate(self.layers):
             layer.layer_idx = layer_idx
     
     @staticmethod
     def _get_coords(H, W):
-        if isinstance(H, mx.array):
-            H = H.item()
-        if isinstance(W, mx.array):
-            W = W.item()
+        """Normalized row and column coordinates of an H x W feature map,
+        shared through POSITIONAL_BUFFERS."""
+        def compute():
+            coords_h = mx.arange(0, H, dtype=mx.float32) / H
+            coords_w = mx.arange(0, W, dtype=mx.float32) / W
+            return coords_h, coords_w
 
-        coords_h = mx.arange(0, H, dtype=mx.float32) / H
-        coords_w = mx.arange(0, W, dtype=mx.float32) / W
-        return coords_h, coords_w
+        return POSITIONAL_BUFFERS.get(("coords", (H, W), None), compute)
 
     def _get_rpb_matrix(self, reference_boxes, feat_size):
         H, W = feat_size
         boxes_xyxy = box_cxcywh_to_xyxy(reference_boxes).transpose(1, 0, 2)
         bs, num_queries, _ = boxes_xyxy.shape
         
-        if feat_size not in self.coord_cache:
-            self.coord_cache[feat_size] = self._get_coords(
-                H, W
-            )
-        coords_h, coords_w = self.coord_cache[feat_size]
+        coords_h, coords_w = self._get_coords(H, W)
 
         assert coords_h.shape == (H,)
         assert coords_w.shape == (W,)
@@ -458,15 +447,21 @@ class TransformerDecoder(nn.Module):
         if is_instance_prompt and self.instance_norm is not None:
             out_norm = self.instance_norm
         
+        # At inference only the outputs of the last layer are read: the
+        # earlier ones are not computed, nor the box update after the last
+        last_only = self.inference_mode and not self.training
         for layer_idx, layer in enumerate(self.layers):
+            is_last = layer_idx == self.num_layers - 1
             reference_points_input = (
                 reference_boxes[:, :, None]
                 * mx.concat([valid_ratios, valid_ratios], -1)[None, :]
             ) # nq, bs, nlevel, 4
 
+            # The reference boxes stay in float32, the queries run in the
+            # dtype of the decoder
             query_sine_embed = gen_sineembed_for_position(
                 reference_points_input[:, :, 0, :], self.d_model
-            ) # nq, bs, d_model * 2
+            ).astype(output.dtype) # nq, bs, d_model * 2
 
             # conditional query
             query_pos = self.ref_point_head(query_sine_embed) # nq, bs, d_model
@@ -475,9 +470,11 @@ class TransformerDecoder(nn.Module):
                 assert (
                     spatial_shapes.shape[0] == 1
                 ), "only single scale support implemented"
+                # spatial_shapes is built from Python ints, so reading it back
+                # does not sync; ints key the coordinates by value
                 memory_mask = self._get_rpb_matrix(
                     reference_boxes,
-                    (spatial_shapes[0, 0], spatial_shapes[0, 1]),
+                    tuple(spatial_shapes.tolist()[0]),
                 )
                 memory_mask = memory_mask.flatten(0, 1)
             # if self.training:
@@ -509,7 +506,7 @@ class TransformerDecoder(nn.Module):
                 obj_roi_memory_mask=obj_roi_memory_mask,
             )
 
-            if self.box_refine:
+            if self.box_refine and not (last_only and is_last):
                 reference_before_sigmoid = inverse_sigmoid(reference_boxes)
                 if box_head_trk is None:
                     if not self.use_normed_output_consistently:
@@ -528,9 +525,11 @@ class TransformerDecoder(nn.Module):
                 reference_boxes = new_reference_points
                 if layer_idx != self.num_layers - 1:
                     intermediate_ref_boxes.append(new_reference_points)
-            else:
+            elif not self.box_refine:
                 raise NotImplemented('not implemented yet')
-            
+
+            if last_only and not is_last:
+                continue
             intermediate.append(out_norm(output))
             if self.presence_token is not None and is_instance_prompt is False:
                 intermediate_layer_presence_logits = self.presence_token_head(
@@ -548,6 +547,9 @@ class TransformerDecoder(nn.Module):
                 intermediate_presence_logits.append(intermediate_layer_presence_logits)
                 presence_feats = mx.array(presence_out)
         
+        if last_only:
+            # The reference boxes the last layer started from
+            intermediate_ref_boxes = intermediate_ref_boxes[-1:]
         return (
             mx.stack(intermediate),
             mx.stack(intermediate_ref_boxes),
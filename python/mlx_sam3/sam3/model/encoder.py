@@ -188,7 +188,7 @@ class TransformerEncoder(nn.Module):
     #     reference_points_list = []
     #     for lvl, (H_, W_) in enumerate()
 
-    def _prepare_multilevel_features(self, srcs, masks, pos_embeds):
+    def _prepare_multilevel_features(self, srcs, masks, pos_embeds, feat_sizes):
         assert (
             len(srcs) == self.num_feature_levels
         ), "mismatch between expected and received * of feature levels"
@@ -198,15 +198,11 @@ class TransformerEncoder(nn.Module):
         lvl_pos_embed_flatten = []
         spatial_shapes = []
         has_mask = masks is not None and masks[0] is not None
-        for lvl, (src, mask, pos_embed) in enumerate(zip(srcs, masks, pos_embeds)):
-            bs, c, h, w = src.shape
-            spatial_shape = (h, w)
-            spatial_shapes.append(spatial_shape)
-
-            src = src.flatten(2).transpose(0, 2, 1) # bs, c, h, w -> bs, c, hw -> bs, hw, c 
-            if has_mask:
-                mask = mask.flatten(1)
-            pos_embed = pos_embed.flatten(2).transpose(0, 2, 1)
+        if masks is None:
+            masks = [None] * len(srcs)
+        for lvl, (src, mask, pos_embed, (h, w)) in enumerate(zip(srcs, masks, pos_embeds, feat_sizes)):
+            # src and pos_embed are already bs, hw, c; mask bs, hw
+            spatial_shapes.append((h, w))
             if self.level_embed is not None:
                 lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)
             else:
@@ -247,12 +243,16 @@ class TransformerEncoder(nn.Module):
     def __call__(
         self,
         src: List[mx.array],
+        feat_sizes: List[Tuple[int, int]],
         src_key_padding_masks: Optional[List[mx.array]] = None,
         pos: Optional[List[mx.array]] = None,
         prompt: Optional[mx.array] = None,
         prompt_key_padding_mask: Optional[mx.array] = None,
         encoder_extra_kwargs: Optional[Dict] = None,
     ) -> Tuple[mx.array, Optional[mx.array], mx.array, mx.array, mx.array, mx.array]:
+        """`src` and `pos` are bs, hw, c per level, of (h, w) `feat_sizes`;
+        the memory, padding mask and position encoding are returned
+        batch-first as well."""
         assert (
             len(src) == self.num_feature_levels
         ), "must be equal to num_feature_levels"
@@ -269,7 +269,7 @@ class TransformerEncoder(nn.Module):
             level_start_index,
             valid_ratios,
             spatial_shapes
-        ) = self._prepare_multilevel_features(src, src_key_padding_masks, pos)
+        ) = self._prepare_multilevel_features(src, src_key_padding_masks, pos, feat_sizes)
 
         # reference_points = self.get_reference_points(
         #     spatial_shapes, valid_ratios, device=src_flatten.device
@@ -293,13 +293,9 @@ class TransformerEncoder(nn.Module):
             output = layer(**layer_kwargs)
         
         return (
-            output.transpose(1, 0, 2), # b, hw, c -> hw, b, c?
-            (
-                key_padding_masks_flatten.transpose(1, 0)
-                if key_padding_masks_flatten is not None
-                else None
-            ),
-            lvl_pos_embed_flatten.transpose(1, 0, 2),
+            output,
+            key_padding_masks_flatten,
+            lvl_pos_embed_flatten,
             level_start_index,
             spatial_shapes,
             valid_ratios
@@ -347,31 +343,14 @@ class TransformerEncoderFusion(TransformerEncoder):
         feat_sizes: Optional[List[int]] = None,
         encoder_extra_kwargs: Optional[Dict] = None,
     ):
-        bs = src[0].shape[1]
-        if feat_sizes is not None:
-            assert len(feat_sizes) == len(src)
-            if src_key_padding_mask is None:
-                src_key_padding_mask = [None] * len(src)
-            for i, (h, w) in enumerate(feat_sizes):
-                src[i] = src[i].reshape(h, w, bs, -1).transpose(2, 3, 0, 1)
-                src_pos[i] = src_pos[i].reshape(h, w, bs, -1).transpose(2, 3, 0, 1)
-                src_key_padding_mask[i] = (
-                    src_key_padding_mask[i].reshape(h, w, bs).transpose(2, 0, 1)
-                    if src_key_padding_mask[i] is not None
-                    else None
-                )
-        else:
-            assert all(
-                x.dim == 4 for x in src
-            ), "expected list of (bs, c, h, w) tensors"
+        # Image features stay batch-first (bs, hw, c) throughout
+        assert feat_sizes is not None and len(feat_sizes) == len(src)
         
         if self.add_pooled_text_to_img_feat:
             pooled_text = pool_text_feat(
                 prompt, prompt_key_padding_mask, self.pool_text_with_mask
             )
-            pooled_text = self.text_pooling_proj(pooled_text)[
-                ..., None, None
-            ]
+            pooled_text = self.text_pooling_proj(pooled_text)[:, None]
             src = [x + pooled_text for x in src]
         
         (
@@ -383,6 +362,7 @@ class TransformerEncoderFusion(TransformerEncoder):
             valid_ratios,
         ) = super().__call__(
             src,
+            feat_sizes,
             src_key_padding_masks=src_key_padding_mask,
             pos=src_pos,
             prompt=prompt.transpose(1, 0, 2),
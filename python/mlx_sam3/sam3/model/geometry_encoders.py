@@ -27,7 +27,9 @@ def concat_padded_sequences(seq1, mask1, seq2, mask2, return_index: bool = False
     is contiguous and also right-padded.
 
     Following pytorch's convention, tensors are sequence first, and the mask are
-    batch first, with 1s for padded values.
+    batch first, with 1s for padded values. Both masks must be right padded
+    (see is_right_padded): this is not checked, as reading the masks back
+    would sync, and cannot happen in a compiled graph.
 
     :param seq1: A tensor of shape (seq1_length, batch_size, hidden_size).
     :param mask1: A tensor of shape (batch_size, seq1_length).
@@ -46,9 +48,6 @@ def concat_padded_sequences(seq1, mask1, seq2, mask2, return_index: bool = False
     assert seq1_length == mask1.shape[1]
     assert seq2_length == mask2.shape[1]
 
-    assert is_right_padded(mask1)
-    assert is_right_padded(mask2)
-
     actual_seq1_lengths = (~mask1).sum(axis=-1)
     actual_seq2_lengths = (~mask2).sum(axis=-1)
 
@@ -452,13 +451,9 @@ class SequenceGeometryEncoder(nn.Module):
             # Will take H_out = num_points, w_out = 1
             grid = points.transpose(1, 0, 2)[:,:,None]
             grid = (grid * 2) - 1
-            img_feats_nhwc = img_feats.transpose(0, 2, 3, 1)
-            sampled_nhwc = grid_sample(
-                img_feats_nhwc, grid
-            )
-            sampled = sampled_nhwc.transpose(0, 3, 1, 2)
-            assert list(sampled.shape) == [bs, self.d_model, n_points, 1]
-            sampled = sampled.squeeze(-1).transpose(2, 0, 1)
+            sampled = grid_sample(img_feats, grid)
+            assert list(sampled.shape) == [bs, n_points, 1, self.d_model]
+            sampled = sampled.squeeze(2).transpose(1, 0, 2)
             proj = self.points_pool_project(sampled)
             if points_embed is None:
                 points_embed = proj
@@ -491,7 +486,7 @@ class SequenceGeometryEncoder(nn.Module):
             boxes_embed = proj
         
         if self.boxes_pool_project is not None:
-            H, W = img_feats.shape[-2:]
+            H, W = img_feats.shape[1:3]
 
             # boxes are [Num_boxes, bs, 4], normalized in [0, 1]
             # We need to denormalize, and convert to [x, y, x, y]
@@ -503,8 +498,9 @@ class SequenceGeometryEncoder(nn.Module):
             # In MLX, we use a list comprehension. This correctly handles any batch size (including bs=0)
             # and avoids indexing into empty dimensions.
             boxes_inp = [boxes_xyxy[:, i, :].astype(mx.float32) for i in range(bs)]
+            # roi_align and the pooling conv take N x C x H x W
             sampled = roi_align(
-                img_feats, boxes_inp, self.roi_size, self.roi_size
+                img_feats.transpose(0, 3, 1, 2), boxes_inp, self.roi_size, self.roi_size
             )
             assert list(sampled.shape) == [
                 bs * n_boxes,
@@ -588,11 +584,11 @@ class SequenceGeometryEncoder(nn.Module):
         masks = geo_prompt.mask_embeddings
         masks_mask = geo_prompt.mask_mask
         masks_labels = geo_prompt.mask_labels
-        seq_first_img_feats = img_feats[-1]  # [H*W, B, C]
-        seq_first_img_pos_embeds = (
+        img_tokens = img_feats[-1]  # [B, H*W, C]
+        img_pos_tokens = (
             img_pos_embeds[-1]
             if img_pos_embeds is not None
-            else mx.zeros_like(seq_first_img_feats)
+            else mx.zeros_like(img_tokens)
         )
 
         if self.points_pool_project or self.boxes_pool_project:
@@ -600,12 +596,10 @@ class SequenceGeometryEncoder(nn.Module):
             cur_img_feat = img_feats[-1]
             cur_img_feat = self.img_pre_norm(cur_img_feat)
             H, W = img_sizes[-1]
-            assert cur_img_feat.shape[0] == H * W
-            N, C = cur_img_feat.shape[-2:]
-            # Put back in NxCxHxW
-            cur_img_feat = cur_img_feat.transpose(1, 2, 0)
-            cur_img_feat = cur_img_feat.reshape(N, C, H, W)
-            img_feats = cur_img_feat
+            assert cur_img_feat.shape[1] == H * W
+            N, _, C = cur_img_feat.shape
+            # Put back in NxHxWxC, a free reshape
+            img_feats = cur_img_feat.reshape(N, H, W, C)
 
         if self.encode_boxes_as_points:
             assert boxes is not None
@@ -677,9 +671,9 @@ class SequenceGeometryEncoder(nn.Module):
             for lay in self.encode:
                 final_embeds = lay(
                     tgt=final_embeds.transpose(1, 0, 2),
-                    memory=seq_first_img_feats.transpose(1, 0, 2),
+                    memory=img_tokens,
                     tgt_key_padding_mask=final_mask,
-                    pos=seq_first_img_pos_embeds.transpose(1, 0, 2),
+                    pos=img_pos_tokens,
                 ).transpose(1, 0, 2)
             final_embeds = self.encode_norm(final_embeds)
         # Finally, concat mask embeddings if any
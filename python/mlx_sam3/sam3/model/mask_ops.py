@@ -0,0 +1,203 @@
+"""
+Instance masks kept at the decoder resolution and upsampled on demand.
+
+Upsampling matches `data_misc.interpolate(mode="bilinear", align_corners=False)`
+followed by thresholding at 0.5, but is computed only inside the region where
+each mask can be positive, then pasted into an empty canvas.
+"""
+
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+import mlx.core as mx
+
+
+def mask_support_boxes(logits: mx.array) -> mx.array:
+    """Inclusive [x0, y0, x1, y1] bounds of the positive cells of [N, h, w] mask
+    logits. Empty masks get x0 > x1 (and y0 > y1).
+    """
+    _, h, w = logits.shape
+    positive = logits > 0
+    rows = positive.any(axis=2)
+    cols = positive.any(axis=1)
+    y0 = mx.argmax(rows, axis=1)
+    y1 = h - 1 - mx.argmax(rows[:, ::-1], axis=1)
+    x0 = mx.argmax(cols, axis=1)
+    x1 = w - 1 - mx.argmax(cols[:, ::-1], axis=1)
+    empty = ~rows.any(axis=1)
+    x0 = mx.where(empty, w, x0)
+    y0 = mx.where(empty, h, y0)
+    return mx.stack([x0, y0, x1, y1], axis=-1).astype(mx.int32)
+
+
+def _axis_taps(start: int, stop: int, out_size: int, in_size: int):
+    """Bilinear (align_corners=False) source taps of output pixels [start, stop)
+    of an axis resized from `in_size` to `out_size`."""
+    # Same arithmetic as nn.Upsample, so that values match it bit for bit
+    step = 1 / (out_size / in_size)
+    offset = ((out_size - 1) * step - in_size + 1) / 2
+    src = mx.arange(start, stop, dtype=mx.float32) * step - offset
+    src = mx.clip(src, 0, in_size - 1)
+    lo = mx.floor(src)
+    weight = src - lo
+    lo = lo.astype(mx.int32)
+    hi = mx.minimum(lo + 1, in_size - 1)
+    return lo, hi, weight
+
+
+def upsample_crop(
+    logits: mx.array, out_size: Tuple[int, int], y0: int, y1: int, x0: int, x1: int
+) -> mx.array:
+    """Rows y0:y1 and columns x0:x1 of a [h, w] map bilinearly resized to
+    `out_size` (H, W). Costs O((y1 - y0) * (w + x1 - x0)), not O(H * W).
+    """
+    h, w = logits.shape
+    ylo, yhi, wy = _axis_taps(y0, y1, out_size[0], h)
+    xlo, xhi, wx = _axis_taps(x0, x1, out_size[1], w)
+    rows = logits[ylo] * (1 - wy)[:, None] + logits[yhi] * wy[:, None]
+    return rows[:, xlo] * (1 - wx) + rows[:, xhi] * wx
+
+
+class LazyMasks:
+    """Binary instance masks at image resolution, computed one at a time.
+
+    Holds the [N, h, w] decoder mask logits. `masks[i]` returns a bool
+    [1, H, W] mx.array like the eagerly upsampled masks did, where (H, W) is
+    `size`, scaled down so that its longer side is at most `max_side`.
+    Only the support of each mask, padded by one low-resolution cell (the
+    reach of bilinear interpolation), is upsampled.
+    """
+
+    def __init__(
+        self,
+        logits: mx.array,
+        size: Tuple[int, int],
+        support: Optional[mx.array] = None,
+        max_side: Optional[int] = None,
+    ):
+        self.logits = logits
+        self.image_size = tuple(size)
+        self.max_side = max_side
+        self._support = support
+
+        height, width = self.image_size
+        scale = 1.0
+        if max_side is not None and max(height, width) > max_side:
+            scale = max_side / max(height, width)
+        self.scale = scale
+        self.size = (max(1, round(height * scale)), max(1, round(width * scale)))
+
+    def resized(self, max_side: Optional[int]) -> "LazyMasks":
+        """The same masks with a different `max_side`."""
+        return LazyMasks(self.logits, self.image_size, self._support, max_side)
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        return (len(self), 1, *self.size)
+
+    def __len__(self) -> int:
+        return self.logits.shape[0]
+
+    def _support_host(self) -> np.ndarray:
+        if self._support is None:
+            self._support = mask_support_boxes(self.logits)
+        return np.array(self._support)
+
+    def crop_box(self, index: int) -> Tuple[int, int, int, int]:
+        """(y0, y1, x0, x1) output region outside of which mask `index` is empty."""
+        x0, y0, x1, y1 = (int(v) for v in self._support_host()[index])
+        if x0 > x1:
+            return (0, 0, 0, 0)
+        h, w = self.logits.shape[1:]
+        out_h, out_w = self.size
+        # Output pixels whose bilinear taps reach a positive cell
+        return (
+            max(0, math.floor((y0 - 0.5) * out_h / h)),
+            min(out_h, math.ceil((y1 + 1.5) * out_h / h)),
+            max(0, math.floor((x0 - 0.5) * out_w / w)),
+            min(out_w, math.ceil((x1 + 1.5) * out_w / w)),
+        )
+
+    def crop(self, index: int) -> Tuple[Tuple[int, int, int, int], mx.array]:
+        """The crop box of mask `index` and its bool mask inside it."""
+        y0, y1, x0, x1 = box = self.crop_box(index)
+        if y0 >= y1 or x0 >= x1:
+            return box, mx.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=mx.bool_)
+        return box, upsample_crop(self.logits[index], self.size, y0, y1, x0, x1) > 0
+
+    def __getitem__(self, index: int) -> mx.array:
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"mask index {index} out of range for {len(self)} masks")
+        index %= len(self)
+        (y0, y1, x0, x1), crop = self.crop(index)
+        canvas = mx.zeros(self.size, dtype=mx.bool_)
+        if crop.size:
+            canvas[y0:y1, x0:x1] = crop
+        return canvas[None]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.zeros(self.shape, dtype=bool)
+        for i in range(len(self)):
+            (y0, y1, x0, x1), crop = self.crop(i)
+            out[i, 0, y0:y1, x0:x1] = np.array(crop)
+        return out if dtype is None else out.astype(dtype)
+
+
+class TiledMasks(LazyMasks):
+    """LazyMasks of detections merged from the tiles of a larger image.
+
+    Mask `i` holds the decoder logits of the `tile_size` (H, W) tile whose
+    top-left corner is at pixel `origins[i]` (y, x) of the image; it is
+    upsampled over that tile and clipped to the image.
+    """
+
+    def __init__(
+        self,
+        logits: mx.array,
+        origins: np.ndarray,
+        tile_size: Tuple[int, int],
+        size: Tuple[int, int],
+        support: Optional[mx.array] = None,
+        max_side: Optional[int] = None,
+    ):
+        super().__init__(logits, size, support, max_side)
+        self.origins = np.asarray(origins)
+        self.tile_size = tuple(tile_size)
+        tile_h, tile_w = self.tile_size
+        self._tile = LazyMasks(
+            logits,
+            (max(1, round(tile_h * self.scale)), max(1, round(tile_w * self.scale))),
+            support,
+        )
+
+    def resized(self, max_side: Optional[int]) -> "TiledMasks":
+        return TiledMasks(
+            self.logits, self.origins, self.tile_size, self.image_size, self._tile._support, max_side
+        )
+
+    def _origin(self, index: int) -> Tuple[int, int]:
+        y, x = self.origins[index]
+        return round(y * self.scale), round(x * self.scale)
+
+    def crop_box(self, index: int) -> Tuple[int, int, int, int]:
+        y0, y1, x0, x1 = self._tile.crop_box(index)
+        oy, ox = self._origin(index)
+        h, w = self.size
+        y0, y1 = min(h, max(0, y0 + oy)), min(h, max(0, y1 + oy))
+        x0, x1 = min(w, max(0, x0 + ox)), min(w, max(0, x1 + ox))
+        if y0 >= y1 or x0 >= x1:
+            return (0, 0, 0, 0)
+        return (y0, y1, x0, x1)
+
+    def crop(self, index: int) -> Tuple[Tuple[int, int, int, int], mx.array]:
+        y0, y1, x0, x1 = box = self.crop_box(index)
+        if y0 >= y1 or x0 >= x1:
+            return box, mx.zeros((0, 0), dtype=mx.bool_)
+        oy, ox = self._origin(index)
+        crop = upsample_crop(self.logits[index], self._tile.size, y0 - oy, y1 - oy, x0 - ox, x1 - ox)
+        return box, crop > 0
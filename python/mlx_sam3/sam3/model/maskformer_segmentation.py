@@ -5,6 +5,7 @@ import math
 import mlx.core as mx
 import mlx.nn as nn
 
+from .cpu_kernels import cpu_kernels_enabled, group_norm_relu
 from .model_misc import MLP
 
 
@@ -26,22 +27,22 @@ class MaskPredictor(nn.Module):
             if pixel_embed.ndim == 3:
                 # batch size was omitted
                 mask_preds = mx.einsum(
-                    "bqc,chw->bqhw", self.mask_embed(obj_queries), pixel_embed
+                    "bqc,hwc->bqhw", self.mask_embed(obj_queries), pixel_embed
                 )
             else:
                 mask_preds = mx.einsum(
-                    "bqc,bchw->bqhw", self.mask_embed(obj_queries), pixel_embed
+                    "bqc,bhwc->bqhw", self.mask_embed(obj_queries), pixel_embed
                 )
         else:
             # Assumed to have aux masks
             if pixel_embed.ndim == 3:
                 # batch size was omitted
                 mask_preds = mx.einsum(
-                    "lbqc,chw->lbqhw", self.mask_embed(obj_queries), pixel_embed
+                    "lbqc,hwc->lbqhw", self.mask_embed(obj_queries), pixel_embed
                 )
             else:
                 mask_preds = mx.einsum(
-                    "lbqc,bchw->lbqhw", self.mask_embed(obj_queries), pixel_embed
+                    "lbqc,bhwc->lbqhw", self.mask_embed(obj_queries), pixel_embed
                 )
 
         return mask_preds
@@ -101,10 +102,10 @@ class SegmentationHead(nn.Module):
             else:
                 # Bs=1, we rely on broadcasting for query-based processing
                 backbone_visual_feats = [bb_feat for bb_feat in backbone_feats]
-            # Extract visual embeddings
-            encoder_hidden_states = encoder_hidden_states.transpose(1, 2, 0)
-            spatial_dim = math.prod(backbone_feats[-1].shape[-2:])
-            encoder_visual_embed = encoder_hidden_states[..., :spatial_dim].reshape(
+            # Extract visual embeddings: the first hw tokens are the last
+            # level, bs, hw, c -> bs, h, w, c
+            spatial_dim = math.prod(backbone_feats[-1].shape[1:3])
+            encoder_visual_embed = encoder_hidden_states[:, :spatial_dim].reshape(
                 -1, *backbone_feats[-1].shape[1:]
             )
 
@@ -137,7 +138,7 @@ class SegmentationHead(nn.Module):
         )
 
         if self.no_dec:
-            mask_pred = self.mask_predictor(pixel_embed.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+            mask_pred = self.mask_predictor(pixel_embed).transpose(0, 3, 1, 2)
         elif self.aux_masks:
             mask_pred = self.mask_predictor(obj_queries, pixel_embed)
         else:
@@ -172,8 +173,7 @@ class PixelDecoder(nn.Module):
 
     def __call__(self, backbone_feats: List[mx.array]):
         # Assumes backbone features are already projected (C == hidden dim)
-
-        backbone_feats = [x.transpose(0, 2, 3, 1) for x in backbone_feats]
+        # and channels-last (bs, h, w, c); so is the output
 
         prev_fpn = backbone_feats[-1]
         fpn_feats = backbone_feats[:-1]
@@ -195,9 +195,12 @@ class PixelDecoder(nn.Module):
                 # only one conv layer
                 layer_idx = 0
             prev_fpn = self.conv_layers[layer_idx](prev_fpn)
-            prev_fpn = nn.relu(self.norms[layer_idx](prev_fpn))
+            if cpu_kernels_enabled():
+                prev_fpn = group_norm_relu(self.norms[layer_idx], prev_fpn)
+            else:
+                prev_fpn = nn.relu(self.norms[layer_idx](prev_fpn))
 
-        return prev_fpn.transpose(0, 3, 1, 2)
+        return prev_fpn
 
 class UniversalSegmentationHead(SegmentationHead):
     """This module handles semantic+instance segmentation"""
@@ -256,24 +259,24 @@ class UniversalSegmentationHead(SegmentationHead):
         **kwargs,
     ) -> Dict[str, Optional[mx.array]]:
         assert encoder_hidden_states is not None
-        bs = encoder_hidden_states.shape[1]
+        # encoder_hidden_states is batch-first (bs, hw, c), prompt seq-first
+        bs = encoder_hidden_states.shape[0]
 
         if self.cross_attend_prompt is not None:
-            t_encoder_hidden_states = encoder_hidden_states.transpose(1, 0, 2)
             t_prompt = prompt.transpose(1, 0, 2)
 
-            tgt2 = self.cross_attn_norm(t_encoder_hidden_states)
+            tgt2 = self.cross_attn_norm(encoder_hidden_states)
             tgt2 = self.cross_attend_prompt(
                 queries=tgt2,
                 keys=t_prompt,
                 values=t_prompt,
                 key_padding_mask=prompt_mask,
-            ).transpose(1, 0, 2)
+            )
             encoder_hidden_states = tgt2 + encoder_hidden_states
 
         presence_logit = None
         if self.presence_head is not None:
-            pooled_enc = encoder_hidden_states.mean(0)
+            pooled_enc = encoder_hidden_states.mean(1)
             presence_logit = (
                 self.presence_head(
                     pooled_enc.view(1, bs, 1, self.d_model),
@@ -290,11 +293,10 @@ class UniversalSegmentationHead(SegmentationHead):
             encoder_hidden_states=encoder_hidden_states,
         )
 
-        # TODO: once works fix to make this transposing back and forth efficient
-        instance_embeds = self.instance_seg_head(pixel_embed.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+        instance_embeds = self.instance_seg_head(pixel_embed)
 
         if self.no_dec:
-            mask_pred = self.mask_predictor(instance_embeds)
+            mask_pred = self.mask_predictor(instance_embeds).transpose(0, 3, 1, 2)
         elif self.aux_masks:
             mask_pred = self.mask_predictor(obj_queries, instance_embeds)
         else:
@@ -302,6 +304,6 @@ class UniversalSegmentationHead(SegmentationHead):
 
         return {
             "pred_masks": mask_pred,
-            "semantic_seg": self.semantic_seg_head(pixel_embed.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2),
+            "semantic_seg": self.semantic_seg_head(pixel_embed).transpose(0, 3, 1, 2),
             "presence_logit": presence_logit,
         }
\ No newline at end of file
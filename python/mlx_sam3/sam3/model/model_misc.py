@@ -7,8 +7,13 @@ import mlx.core as mx
 import mlx.nn as nn
 from mlx.utils import tree_map_with_path
 
+from .chunked_attention import ATTENTION_MEMORY_CAP, attention
+from .token_merging import merged_attention
+
 def inverse_sigmoid(x, eps=1e-3):
-    x = mx.clip(x, 0, 1)
+    # In float32 whatever the input: eps is below the resolution of float16
+    # and bfloat16 near 1
+    x = mx.clip(x.astype(mx.float32), 0, 1)
     x1 = mx.clip(x, eps, None)
     x2 = mx.clip((1-x), eps, None)
     return mx.log(x1 / x2)
@@ -18,6 +23,13 @@ class MultiheadAttentionWrapper(nn.MultiHeadAttention):
     def __init__(self, *args, **kwargs):
         kwargs["bias"] = True
         super().__init__(*args, **kwargs)
+        # Chunks the attention above this many bytes of scores when the fused
+        # kernel is unavailable, see chunked_attention.attention
+        self.attention_memory_cap = ATTENTION_MEMORY_CAP
+        # Merges this ratio of the tokens of unmasked self-attention when
+        # above 0, see token_merging.merged_attention
+        self.token_merge_ratio = 0.0
+
     def __call__(self, *args, **kwargs):
 
         if kwargs.get('attn_mask', None) is None:
@@ -67,11 +79,38 @@ class MultiheadAttentionWrapper(nn.MultiHeadAttention):
         else:
             final_mask = normalized_attn_mask
 
+        # Additive masks must match the queries in half precision
+        if final_mask is not None:
+            queries = args[0] if len(args) > 0 else kwargs["queries"]
+            final_mask = final_mask.astype(queries.dtype)
+
         kwargs.pop('attn_mask', None)
         kwargs.pop('key_padding_mask', None)
         kwargs['mask'] = final_mask
 
-        return super().__call__(*args, **kwargs)
+        return self._attend(*args, **kwargs)
+
+    def _attend(self, queries, keys, values, mask=None):
+        """nn.MultiHeadAttention.__call__, through chunked_attention.attention."""
+        queries = self.query_proj(queries)
+        keys = self.key_proj(keys)
+        values = self.value_proj(values)
+
+        num_heads = self.num_heads
+        queries = mx.unflatten(queries, -1, (num_heads, -1)).transpose(0, 2, 1, 3)
+        keys = mx.unflatten(keys, -1, (num_heads, -1)).transpose(0, 2, 1, 3)
+        values = mx.unflatten(values, -1, (num_heads, -1)).transpose(0, 2, 1, 3)
+        scale = math.sqrt(1 / queries.shape[-1])
+        if self.token_merge_ratio > 0 and mask is None and queries.shape == keys.shape:
+            output = merged_attention(
+                queries, keys, values, scale, self.token_merge_ratio, memory_cap=self.attention_memory_cap
+            )
+        else:
+            output = attention(
+                queries, keys, values, scale, mask=mask, memory_cap=self.attention_memory_cap
+            )
+        output = output.transpose(0, 2, 1, 3).flatten(-2, -1)
+        return self.out_proj(output)
 
 
 class DotProductScoring(nn.Module):
@@ -5,23 +5,28 @@ from typing import List, Optional, Tuple
 import mlx.core as mx
 import mlx.nn as nn
 
+from .cpu_kernels import conv_transpose_nonoverlapping, cpu_kernels_enabled
+
+
+class ConvTranspose2x2(nn.ConvTranspose2d):
+    """2 x 2 stride 2 nn.ConvTranspose2d, a matmul and a pixel shuffle on the
+    CPU, see cpu_kernels.conv_transpose_nonoverlapping."""
+
+    def __init__(self, in_channels: int, out_channels: int):
+        super().__init__(in_channels, out_channels, kernel_size=2, stride=2)
+
+    def __call__(self, x):
+        if cpu_kernels_enabled():
+            return conv_transpose_nonoverlapping(x, self.weight, self.bias if "bias" in self else None)
+        return super().__call__(x)
+
 
 class Scale4FN(nn.Module):
     def __init__(self, in_channels: int, d_model: int, use_bias: bool = True):
         super().__init__()
-        self.dconv_2x2_0 = nn.ConvTranspose2d(
-            in_channels,
-            in_channels // 2,
-            kernel_size=2,
-            stride=2
-        )
+        self.dconv_2x2_0 = ConvTranspose2x2(in_channels, in_channels // 2)
         self.gelu = nn.GELU()
-        self.dconv_2x2_1 = nn.ConvTranspose2d(
-            in_channels // 2,
-            in_channels // 4,
-            kernel_size=2,
-            stride=2
-        )
+        self.dconv_2x2_1 = ConvTranspose2x2(in_channels // 2, in_channels // 4)
         self.conv_1x1 = nn.Conv2d(
             in_channels=in_channels // 4,
             out_channels=d_model,
@@ -46,12 +51,7 @@ class Scale4FN(nn.Module):
 class Scale2FN(nn.Module):
     def __init__(self, in_channels: int, d_model: int, use_bias: bool = True):
         super().__init__()
-        self.dconv_2x2 = nn.ConvTranspose2d(
-            in_channels,
-            in_channels // 2,
-            kernel_size=2,
-            stride=2
-        )
+        self.dconv_2x2 = ConvTranspose2x2(in_channels, in_channels // 2)
         self.gelu = nn.GELU()
         self.conv_1x1 = nn.Conv2d(
             in_channels=in_channels // 2,
@@ -177,31 +177,38 @@ class Sam3DualViTDetNeck(nn.Module):
                 raise NotImplementedError(f"Scale factor {scale} not supported yet.")
         return convs
         
+    def _position_encoding(self, nchw_shape, dtype, channels_last=False):
+        # Only cast when needed so the shared cached encoding is returned as is
+        pos = self.position_encoding(nchw_shape, channels_last=channels_last)
+        return pos if pos.dtype == dtype else pos.astype(dtype)
+
     def __call__(
-        self, x_list: List[mx.array]
+        self, x_list: List[mx.array], scalp: int = 0
     ) -> Tuple[
         List[mx.array],
         List[mx.array],
         Optional[List[mx.array]],
         Optional[List[mx.array]],
     ]:
-
+        """SAM3 features and their position encodings are NHWC, the layout
+        Sam3Image works in; the SAM2 ones NCHW. The last `scalp` levels
+        (the lowest resolution ones) are not computed."""
         xs = self.trunk(x_list)
         sam3_out, sam3_pos = [], []
         sam2_out, sam2_pos = None, None       
         if self.sam2_convs is not None:
             sam2_out, sam2_pos = [], []
         x = xs[-1].transpose(0, 2, 3, 1)
-        for i in range(len(self.convs)):
+        for i in range(len(self.convs) - scalp):
             sam3_x_out = self.convs[i](x)
             nchw_shape = (sam3_x_out.shape[0], sam3_x_out.shape[3], sam3_x_out.shape[1], sam3_x_out.shape[2])
-            sam3_out.append(sam3_x_out.transpose(0, 3, 1, 2))
-            sam3_pos.append(self.position_encoding(nchw_shape).astype(sam3_x_out.dtype))
+            sam3_out.append(sam3_x_out)
+            sam3_pos.append(self._position_encoding(nchw_shape, sam3_x_out.dtype, channels_last=True))
 
             if self.sam2_convs is not None:
                 sam2_x_out = self.sam2_convs[i](x)
                 nchw_shape = (sam2_x_out.shape[0], sam2_x_out.shape[3], sam2_x_out.shape[1], sam2_x_out.shape[2])
                 sam2_out.append(sam2_x_out.transpose(0, 3, 1, 2))
-                sam2_pos.append(self.position_encoding(nchw_shape).astype(sam2_x_out.dtype))
+                sam2_pos.append(self._position_encoding(nchw_shape, sam2_x_out.dtype))
 
         return sam3_out, sam3_pos, sam2_out, sam2_pos
\ No newline at end of file
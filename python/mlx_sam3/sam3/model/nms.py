@@ -0,0 +1,122 @@
+"""
+Duplicate suppression for detections, vectorized in MLX.
+
+Candidates are expected sorted by descending score. Suppression is computed
+with Cluster-NMS, which iterates a matrix form of greedy NMS to its fixed point
+and keeps exactly the detections greedy NMS would, without host syncs. Mask
+IoU is only computed for the pairs that can exceed the threshold, whose
+indices are read on the host (one sync).
+"""
+
+from typing import Optional
+
+import mlx.core as mx
+import numpy as np
+
+from sam3.model.box_ops import box_iou
+from sam3.model.mask_ops import mask_support_boxes
+
+# Pairs of masks compared per step of `mask_overlaps`
+PAIR_CHUNK = 256
+
+
+def cluster_nms(overlaps: mx.array) -> mx.array:
+    """Greedy NMS keep mask for [K, K] bool `overlaps` of score-sorted candidates.
+    A candidate is dropped if an earlier kept candidate overlaps it.
+    """
+    k = overlaps.shape[0]
+    rank = mx.arange(k)
+    # Only higher-scored candidates suppress
+    overlaps = overlaps & (rank[:, None] < rank[None, :])
+    keep = mx.ones((k,), dtype=mx.bool_)
+    # Converges in at most k steps; once converged, further steps are no-ops
+    for _ in range(k):
+        keep = ~(overlaps & keep[:, None]).any(axis=0)
+    return keep
+
+
+def mask_iou(mask_logits: mx.array) -> mx.array:
+    """[K, K] IoU between the binarized [K, h, w] mask logits."""
+    masks = (mask_logits > 0).reshape(mask_logits.shape[0], -1).astype(mx.float32)
+    inter = masks @ masks.T
+    area = masks.sum(axis=1)
+    union = area[:, None] + area[None, :] - inter
+    return inter / mx.maximum(union, 1)
+
+
+def pack_bits(masks: mx.array) -> mx.array:
+    """Bool [K, n] -> uint32 [K, ceil(n / 32)], 32 cells per word."""
+    k, n = masks.shape
+    masks = mx.pad(masks, [(0, 0), (0, -n % 32)]).reshape(k, -1, 32).astype(mx.uint32)
+    return (masks << mx.arange(32, dtype=mx.uint32)).sum(axis=-1).astype(mx.uint32)
+
+
+def popcount(words: mx.array) -> mx.array:
+    """Set bits of each uint32 word (SWAR)."""
+    words = words - ((words >> 1) & 0x55555555)
+    words = (words & 0x33333333) + ((words >> 2) & 0x33333333)
+    words = (words + (words >> 4)) & 0x0F0F0F0F
+    return (words * 0x01010101) >> 24
+
+
+def mask_overlaps(
+    mask_logits: mx.array, threshold: float, candidates: Optional[mx.array] = None
+) -> mx.array:
+    """[K, K] bool, `mask_iou(mask_logits) > threshold` above the diagonal.
+    The support boxes of the masks bound the intersection of each pair, and
+    with their areas the IoU: only the pairs whose bound exceeds `threshold`
+    are compared, on bit-packed masks. `candidates`, bool [K], further
+    restricts the pairs to those between candidates.
+    """
+    k = mask_logits.shape[0]
+    masks = (mask_logits > 0).reshape(k, -1)
+    area = masks.astype(mx.int32).sum(axis=1)
+
+    # Cells shared by the support boxes, at most the smaller area
+    support = mask_support_boxes(mask_logits)
+    lt = mx.maximum(support[:, None, :2], support[None, :, :2])
+    rb = mx.minimum(support[:, None, 2:], support[None, :, 2:])
+    inter = mx.minimum(
+        mx.maximum(rb - lt + 1, 0).prod(axis=-1), mx.minimum(area[:, None], area[None, :])
+    )
+    union = area[:, None] + area[None, :] - inter
+    possible = mx.triu(inter / mx.maximum(union, 1) > threshold, k=1)
+    if candidates is not None:
+        possible = possible & candidates[:, None] & candidates[None, :]
+    first, second = np.nonzero(np.array(possible))
+
+    overlaps = mx.zeros((k * k,), dtype=mx.bool_)
+    if len(first) == 0:
+        return overlaps.reshape(k, k)
+    words = pack_bits(masks)
+    for start in range(0, len(first), PAIR_CHUNK):
+        i = mx.array(first[start:start + PAIR_CHUNK])
+        j = mx.array(second[start:start + PAIR_CHUNK])
+        inter = popcount(words[i] & words[j]).sum(axis=1).astype(mx.int32)
+        union = area[i] + area[j] - inter
+        overlaps[i * k + j] = inter / mx.maximum(union, 1) > threshold
+    return overlaps.reshape(k, k)
+
+
+def nms(
+    boxes: mx.array,
+    mask_logits: Optional[mx.array] = None,
+    box_iou_threshold: Optional[float] = None,
+    mask_iou_threshold: Optional[float] = None,
+    candidates: Optional[mx.array] = None,
+) -> mx.array:
+    """Keep mask over score-sorted candidates. A candidate overlaps another when
+    its box IoU exceeds `box_iou_threshold` or its mask IoU exceeds
+    `mask_iou_threshold`; a threshold of None disables that test.
+    `boxes` are [K, 4] in [x0, y0, x1, y1], `mask_logits` [K, h, w].
+    `candidates`, bool [K], marks the detections the caller may keep (e.g.
+    those above the score threshold): mask IoU is only computed between them,
+    so the result is only meaningful for them.
+    """
+    k = boxes.shape[0]
+    overlaps = mx.zeros((k, k), dtype=mx.bool_)
+    if box_iou_threshold is not None:
+        overlaps = overlaps | (box_iou(boxes, boxes)[0] > box_iou_threshold)
+    if mask_iou_threshold is not None:
+        overlaps = overlaps | mask_overlaps(mask_logits, mask_iou_threshold, candidates)
+    return cluster_nms(overlaps)
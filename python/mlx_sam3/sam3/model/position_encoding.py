@@ -1,9 +1,11 @@
 import math
-from typing import Optional
+from typing import Optional, Sequence
 
 import mlx.core as mx
 import mlx.nn as nn
 
+from .positional_buffers import POSITIONAL_BUFFERS
+
 
 class PositionEmbeddingSine(nn.Module):
     def __init__(
@@ -13,7 +15,13 @@ class PositionEmbeddingSine(nn.Module):
         normalize: bool = True,
         scale: Optional[float] = None,
         precompute_resolution: Optional[int] = None,
+        precompute_strides: Sequence[float] = (4, 8, 16, 32),
     ):
+        """`precompute_resolution` computes the encodings of the feature maps
+        of an image of that size, one per stride in `precompute_strides`.
+        Other sizes are computed on first use. Encodings are held once, in
+        POSITIONAL_BUFFERS.
+        """
         super().__init__()
         assert num_pos_feats % 2 == 0, "Expecting even model width"
         self.num_pos_feats = num_pos_feats // 2
@@ -25,18 +33,10 @@ class PositionEmbeddingSine(nn.Module):
             scale = 2 * math.pi
         self.scale = scale
         
-        self.cache = {}
         if precompute_resolution is not None:
-            
-            precompute_sizes = [
-                (precompute_resolution // 4, precompute_resolution // 4),
-                (precompute_resolution // 8, precompute_resolution // 8),
-                (precompute_resolution // 16, precompute_resolution // 16),
-                (precompute_resolution // 32, precompute_resolution // 32),
-            ]
-            for size in precompute_sizes:
-                tensors = mx.zeros((1,1) + size)
-                self(tensors)
+            for stride in precompute_strides:
+                size = int(precompute_resolution // stride)
+                self((1, 1, size, size))
     
     def _encode_xy(self, x, y):
         assert len(x) == len(y) and x.ndim == y.ndim == 1
@@ -73,30 +73,41 @@ class PositionEmbeddingSine(nn.Module):
         pos = mx.concat((pos_y, pos_x, labels[:, :, None]), axis=2)
         return mx.stop_gradient(pos)
     
-    def __call__(self, x: mx.array | tuple) -> mx.array:
+    def __call__(self, x: mx.array | tuple, channels_last: bool = False) -> mx.array:
         """
         Args:
             x: Either an mx.array (NCHW format) or a shape tuple (N, C, H, W)
+            channels_last: Return the encoding in NHWC format, the layout it
+                is stored in, instead of a transposed view of it
         Returns:
-            Position encoding in NCHW format
+            Position encoding in NCHW format, or NHWC with `channels_last`
         """
         shape = x if isinstance(x, tuple) else x.shape
         batch, _, height, width = shape
         
-        cache_key = (height, width)
-        if cache_key in self.cache:
-            return mx.repeat(self.cache[cache_key][None], repeats=batch, axis=0)
-        
+        # The encoding only depends on the spatial size, so every caller shares
+        # the registered array by reference instead of holding its own copy
+        key = (
+            "sine", (height, width), 2 * self.num_pos_feats,
+            self.temperature, self.normalize, self.scale,
+        )
+        pos = POSITIONAL_BUFFERS.get(key, lambda: self._compute(height, width))
+        if batch != 1:
+            pos = mx.broadcast_to(pos, (batch,) + pos.shape[1:])
+        return pos if channels_last else pos.transpose(0, 3, 1, 2)
+
+    def _compute(self, height, width):
+        """Position encoding for one (height, width) grid, as a [1, H, W, C] array."""
         y_embed = (
             mx.arange(1, height + 1, dtype=mx.float32)
             .reshape(1, -1, 1)
         )
-        y_embed = mx.broadcast_to(y_embed, (batch, height, width))
+        y_embed = mx.broadcast_to(y_embed, (1, height, width))
         x_embed = (
             mx.arange(1, width + 1, dtype=mx.float32)
             .reshape(1, 1, -1)
         )
-        x_embed = mx.broadcast_to(x_embed, (batch, height, width))
+        x_embed = mx.broadcast_to(x_embed, (1, height, width))
 
         if self.normalize:
             eps = 1e-6
@@ -116,9 +127,5 @@ class PositionEmbeddingSine(nn.Module):
             (mx.sin(pos_y[:, :, :, 0::2]), mx.cos(pos_y[:, :, :, 1::2])),
             axis=4
         ).flatten(3)
-        pos = mx.concat((pos_y, pos_x), axis=3).transpose(0, 3, 1, 2)
-        if cache_key is not None:
-            self.cache[cache_key] = pos[0]
+        pos = mx.concat((pos_y, pos_x), axis=3)
         return mx.stop_gradient(pos)
-
-            
\ No newline at end of file
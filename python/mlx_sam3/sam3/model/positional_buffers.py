@@ -0,0 +1,48 @@
+"""
+Positional buffers shared by the modules of the model.
+
+Rotary tables, sine encodings, decoder coordinates and the tiled absolute
+position embedding only depend on a kind, a grid size, a width and a few
+constants, not on the module that reads them. Every module reads them from
+one registry, which computes each once, on first use, and holds it once.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_flatten
+
+
+class PositionalBuffers:
+    """Buffers keyed by (kind, size, dim, *constants)."""
+
+    def __init__(self):
+        # key -> (source, buffer)
+        self._buffers: Dict[Tuple, Tuple[Optional[mx.array], Any]] = {}
+
+    def get(self, key: Tuple, compute: Callable[[], Any], source: Optional[mx.array] = None):
+        """The buffer (an array or a tree of arrays) under `key`, computed with
+        `compute()` and evaluated when missing. A buffer derived from a weight,
+        e.g. a learned embedding, passes it as `source`: it is recomputed once
+        the weight is replaced (loaded, cast or quantized)."""
+        entry = self._buffers.get(key)
+        if entry is None or entry[0] is not source:
+            buffer = compute()
+            mx.eval(buffer)
+            entry = self._buffers[key] = (source, buffer)
+        return entry[1]
+
+    def arrays(self) -> List[mx.array]:
+        return [v for _, buffer in self._buffers.values() for _, v in tree_flatten(buffer)]
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.arrays())
+
+    def clear(self):
+        self._buffers.clear()
+
+    def __len__(self) -> int:
+        return len(self._buffers)
+
+
+POSITIONAL_BUFFERS = PositionalBuffers()
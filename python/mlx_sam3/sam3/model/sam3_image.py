@@ -3,6 +3,8 @@ import mlx.core as mx
 import mlx.nn as nn
 
 from sam3.model.box_ops import box_cxcywh_to_xywh, box_cxcywh_to_xyxy
+from sam3.model.compile_cache import CompiledFunction, pad_prompt_boxes
+from sam3.model.data_misc import FindStage
 from sam3.model.vl_combiner import SAM3VLBackbone
 from sam3.model.geometry_encoders import Prompt
 from sam3.model.model_misc import MLP, DotProductScoring, inverse_sigmoid
@@ -16,6 +18,12 @@ def _update_out(out, out_name, out_value, auxiliary=True, update_aux=True):
         for aux_output, aux_value in zip(out["aux_outputs"], out_value[:-1]):
             aux_output[out_name] = aux_value
 
+def _select_images(x, img_ids):
+    """x[img_ids]; features of a single image are broadcast, not copied."""
+    if x.shape[0] == 1:
+        return mx.broadcast_to(x, (img_ids.shape[0], *x.shape[1:]))
+    return x[img_ids]
+
 class Sam3Image(nn.Module):
     TEXT_ID_FOR_TEXT = 0
     TEXT_ID_FOR_VISUAL = 1
@@ -41,6 +49,7 @@ class Sam3Image(nn.Module):
         separate_scorer_for_instance: bool = False,
         num_interactive_steps_val: int = 0,
         inst_interactive_predictor = None,
+        compile_mode=None,
         **kwargs,
     ):
         super().__init__()
@@ -100,6 +109,27 @@ class Sam3Image(nn.Module):
 
         self.inst_interactive_predictor = inst_interactive_predictor
 
+        # Detection and segmentation compiled per image size and prompt
+        # length bucket, see CompiledFunction
+        self.compile_mode = compile_mode
+        self.compiled_detection = None
+        self.compiled_segmentation = None
+        if compile_mode:
+            self.compiled_detection = CompiledFunction(
+                self._detect,
+                inputs=[self.geometry_encoder, self.transformer, self.dot_prod_scoring],
+            )
+            if segmentation_head is not None:
+                self.compiled_segmentation = CompiledFunction(
+                    self._segment, inputs=self.segmentation_head
+                )
+
+    @property
+    def dtype(self) -> mx.Dtype:
+        """dtype the backbone and transformer run in: float32, or float16 or
+        bfloat16 once cast with model_builder.cast_model."""
+        return self.transformer.decoder.norm.weight.dtype
+
     def _get_img_feats(self, backbone_out, img_ids):
         """ Retrieve correct image features from backbone output."""
         if "backbone_fpn" in backbone_out:
@@ -112,12 +142,10 @@ class Sam3Image(nn.Module):
             
             vis_feats = backbone_out["backbone_fpn"][-self.num_feature_levels :]
             vis_pos_enc = backbone_out["vision_pos_enc"][-self.num_feature_levels :]
-            vis_feat_sizes = [x.shape[-2:] for x in vis_pos_enc] # (H, W) Shapes
-            # index and flatten visual features  NxCxHxW => HWxNxC (batch-first => seq-first)
-            img_feats = [x[img_ids].flatten(2).transpose(2, 0, 1) for x in vis_feats]
-            img_pos_embeds = [
-                x[img_ids].flatten(2).transpose(2, 0, 1) for x in vis_pos_enc
-            ]
+            vis_feat_sizes = [x.shape[1:3] for x in vis_pos_enc] # (H, W) Shapes
+            # index and flatten visual features  NxHxWxC => NxHWxC, a view
+            img_feats = [_select_images(x.flatten(1, 2), img_ids) for x in vis_feats]
+            img_pos_embeds = [_select_images(x.flatten(1, 2), img_ids) for x in vis_pos_enc]
             return backbone_out, img_feats, img_pos_embeds, vis_feat_sizes
         
         # Image features not available in backbone out, so we compute on the fly
@@ -168,6 +196,8 @@ class Sam3Image(nn.Module):
         else:
             prompt = mx.concat([geo_feats, visual_prompt_embed], axis=0)
             prompt_mask = mx.concat([geo_masks, visual_prompt_mask], axis=1)
+        # The geometry encoder runs in float32
+        prompt = prompt.astype(self.dtype)
         
         return prompt, prompt_mask, backbone_out
 
@@ -183,7 +213,10 @@ class Sam3Image(nn.Module):
         feat_tuple = self._get_img_feats(backbone_out, find_input.img_ids)
         backbone_out, img_feats, img_pos_embeds, vis_feat_sizes = feat_tuple
 
-        # Run the encoder
+        # Run the encoder, in the dtype of the transformer: the sine position
+        # encodings are float32
+        img_feats = [x.astype(self.dtype) for x in img_feats]
+        img_pos_embeds = [x.astype(self.dtype) for x in img_pos_embeds]
         prompt_pos_embed = mx.zeros_like(prompt)
         memory = self.transformer.encoder(
             src=img_feats,
@@ -222,7 +255,7 @@ class Sam3Image(nn.Module):
         prompt_mask,
         encoder_out,
     ):
-        bs = memory.shape[1]
+        bs = memory.shape[0]
         query_embed = self.transformer.decoder.query_embed.weight
         tgt = mx.tile(query_embed[:,None], (1,bs,1))
 
@@ -316,11 +349,11 @@ class Sam3Image(nn.Module):
             ), -10.0, 10.0)
         
         _update_out(
-            out, "pred_logits", outputs_class[:, :, :num_o2o], update_aux=self.train
+            out, "pred_logits", outputs_class[:, :, :num_o2o], update_aux=self.training
         )
 
         _update_out(
-            out, "pred_boxes", outputs_coord[:, :, :num_o2o], update_aux=self.train
+            out, "pred_boxes", outputs_coord[:, :, :num_o2o], update_aux=self.training
         )
         _update_out(
             out,
@@ -395,6 +428,46 @@ class Sam3Image(nn.Module):
         find_input,
         find_target,
         geometric_prompt: Prompt,
+        run_segmentation: bool = True,
+    ):
+        """`run_segmentation=False` skips the segmentation head: no
+        "pred_masks" or "semantic_seg" in the output.
+        """
+        out, segmentation_inputs = self.call_detection(
+            backbone_out, find_input, find_target, geometric_prompt
+        )
+        if run_segmentation:
+            self.call_segmentation(out, segmentation_inputs)
+
+        # if self.training or self.num_interactive_steps_val > 0:
+            # self._compute_matching(out, self._back_convert(find_target))
+        return out
+
+    def call_detection(
+        self,
+        backbone_out,
+        find_input,
+        find_target,
+        geometric_prompt: Prompt,
+    ):
+        """Geometry encoder, encoder and decoder: scores, boxes and presence.
+        Returns the output and what `call_segmentation` needs to add the masks
+        to it later, e.g. only once the scores are known.
+        """
+        if (
+            self.compiled_detection is not None
+            and not self.training
+            and geometric_prompt.mask_embeddings is None
+        ):
+            return self._call_detection_compiled(backbone_out, find_input, geometric_prompt)
+        return self._call_detection(backbone_out, find_input, find_target, geometric_prompt)
+
+    def _call_detection(
+        self,
+        backbone_out,
+        find_input,
+        find_target,
+        geometric_prompt: Prompt,
     ):
         # profile geometry encoder
         prompt, prompt_mask, backbone_out = self._encode_prompt(
@@ -406,13 +479,12 @@ class Sam3Image(nn.Module):
             backbone_out, find_input, prompt, prompt_mask
         )
 
-        out = {
-            "encoder_hidden_states": encoder_out["encoder_hidden_states"],
-            "prev_encoder_out": {
+        out = {"encoder_hidden_states": encoder_out["encoder_hidden_states"]}
+        if self.training:
+            out["prev_encoder_out"] = {
                 "encoder_out": encoder_out,
                 "backbone_out": backbone_out,
-            },
-        }
+            }
 
         # profile decoder
         out, hs = self._run_decoder(
@@ -425,9 +497,7 @@ class Sam3Image(nn.Module):
             encoder_out=encoder_out,
         )
 
-        # profile segmentation heads
-        self._run_segmentation_heads(
-            out=out,
+        segmentation_inputs = dict(
             backbone_out=backbone_out,
             img_ids=find_input.img_ids,
             vis_feat_sizes=encoder_out["vis_feat_sizes"],
@@ -436,11 +506,99 @@ class Sam3Image(nn.Module):
             prompt_mask=prompt_mask,
             hs=hs,
         )
-
-        # if self.training or self.num_interactive_steps_val > 0:
-            # self._compute_matching(out, self._back_convert(find_target))
+        return out, segmentation_inputs
+
+    def call_segmentation(self, out, segmentation_inputs):
+        """Adds "pred_masks" and "semantic_seg" to a `call_detection` output."""
+        if self.compiled_segmentation is not None and not self.training:
+            out.update(
+                self.compiled_segmentation(
+                    segmentation_inputs["backbone_out"]["backbone_fpn"],
+                    segmentation_inputs["img_ids"],
+                    segmentation_inputs["encoder_hidden_states"],
+                    segmentation_inputs["prompt"],
+                    segmentation_inputs["prompt_mask"],
+                    segmentation_inputs["hs"],
+                )
+            )
+            return out
+        # profile segmentation heads
+        self._run_segmentation_heads(out=out, **segmentation_inputs)
         return out
 
+    def _call_detection_compiled(self, backbone_out, find_input, geometric_prompt: Prompt):
+        # Box prompts padded to a count bucket, masked
+        boxes, box_mask, box_labels = pad_prompt_boxes(
+            geometric_prompt.box_embeddings,
+            geometric_prompt.box_mask,
+            geometric_prompt.box_labels,
+        )
+        prompt = {
+            "box_embeddings": boxes,
+            "box_mask": box_mask,
+            "box_labels": box_labels,
+            "point_embeddings": geometric_prompt.point_embeddings,
+            "point_mask": geometric_prompt.point_mask,
+            "point_labels": geometric_prompt.point_labels,
+        }
+        out, segmentation_inputs = self.compiled_detection(
+            backbone_out, find_input.img_ids, find_input.text_ids, prompt
+        )
+        vis_pos_enc = backbone_out["vision_pos_enc"][-self.num_feature_levels :]
+        segmentation_inputs.update(
+            backbone_out=backbone_out,
+            img_ids=find_input.img_ids,
+            vis_feat_sizes=[x.shape[1:3] for x in vis_pos_enc],
+        )
+        return out, segmentation_inputs
+
+    def _detect(self, backbone_out, img_ids, text_ids, prompt):
+        """`_call_detection` on arrays only, as compiled."""
+        find_input = FindStage(
+            img_ids=img_ids,
+            text_ids=text_ids,
+            input_boxes=None,
+            input_boxes_mask=None,
+            input_boxes_label=None,
+            input_points=None,
+            input_points_mask=None,
+        )
+        out, segmentation_inputs = self._call_detection(
+            backbone_out, find_input, None, Prompt(**prompt)
+        )
+        out = {k: v for k, v in out.items() if v is not None}
+        segmentation_inputs = {
+            k: segmentation_inputs[k]
+            for k in ("encoder_hidden_states", "prompt", "prompt_mask", "hs")
+        }
+        return out, segmentation_inputs
+
+    def _segment(self, backbone_fpn, img_ids, encoder_hidden_states, prompt, prompt_mask, hs):
+        """`_run_segmentation_heads` on arrays only, as compiled."""
+        out = {}
+        self._run_segmentation_heads(
+            out=out,
+            backbone_out={"backbone_fpn": backbone_fpn},
+            img_ids=img_ids,
+            vis_feat_sizes=None,
+            encoder_hidden_states=encoder_hidden_states,
+            prompt=prompt,
+            prompt_mask=prompt_mask,
+            hs=hs,
+        )
+        return {k: v for k, v in out.items() if v is not None}
+
+
+    def compile_stats(self) -> Dict[str, Dict]:
+        """Traced graphs and cache hits of each compiled stage, see
+        CompiledFunction. Empty unless the model was built with compile."""
+        stages = {
+            "vision": getattr(self.backbone.vision_backbone.trunk, "compiled", None),
+            "text": getattr(self.backbone.language_backbone, "compiled", None),
+            "detection": self.compiled_detection,
+            "segmentation": self.compiled_segmentation,
+        }
+        return {name: stage.stats() for name, stage in stages.items() if stage is not None}
 
     def _get_dummy_prompt(self, num_prompts=1):
         geometric_prompt = Prompt(
@@ -1,39 +1,219 @@
+import io
+import math
+import os
 import time
+from contextlib import nullcontext
 from functools import partial
 
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 import PIL
 from PIL import Image
 import numpy as np
 import mlx.core as mx
 
 from sam3.model import box_ops
+from sam3.model.chunked_attention import bound_attention_memory, fused_attention_available
 from sam3.model.data_misc import FindStage, interpolate
+from sam3.model.mask_ops import LazyMasks, TiledMasks, mask_support_boxes
+from sam3.model.nms import nms
+from sam3.model.positional_buffers import POSITIONAL_BUFFERS
+from sam3.model.tiling import TileMerger, tile_origins, tile_stride
 
-# TODO: remove this, using for testing
-import torch
-from torchvision.transforms import v2
 
+# Input resolutions the model runs at: multiples of the ViT patch size (14)
+# times its attention window (24) tokens
+RESOLUTION_BUCKETS = (336, 672, 1008)
 
-def transform(image_path_or_pil, resolution):
-    if isinstance(image_path_or_pil, str):
-        img = Image.open(image_path_or_pil).convert("RGB")
+# Upper bound on the pixels decoded per image, after JPEG draft-mode reduction
+# (~192 MB as RGB). Larger images are rejected rather than decoded.
+MAX_DECODE_PIXELS = 64 * 1024 * 1024
+
+
+@mx.compile
+def _normalize(img):
+    """uint8 [H, W, C] -> float32 [C, H, W] in [-1, 1], as one fused device op."""
+    return (img.astype(mx.float32) * (2.0 / 255.0) - 1.0).transpose(2, 0, 1)
+
+
+def _reopen(img):
+    """A fresh handle on the encoded file an undecoded PIL image was opened
+    from, or None if it is decoded or the file cannot be read again."""
+    if not getattr(img, "tile", None):
+        return None
+    if getattr(img, "filename", None):
+        return Image.open(img.filename)
+    if hasattr(img.fp, "getvalue"):
+        # In-memory file, e.g. Image.open(io.BytesIO(data)); getvalue leaves its position alone
+        return Image.open(io.BytesIO(img.fp.getvalue()))
+    return None
+
+
+def load_rgb(image, resolution, max_decode_pixels=MAX_DECODE_PIXELS):
+    """Decode an image to RGB, at the smallest scale covering `resolution`.
+    `image` is a path, encoded bytes or a PIL image. A JPEG is decoded in
+    draft mode at the nearest reduced DCT scale (1/2, 1/4, 1/8) that stays
+    at least `resolution` on both sides; `resolution=None` decodes at full
+    size. A PIL image is never changed: an undecoded one (e.g. fresh from
+    Image.open) is opened again from its file to be drafted, a decoded one
+    is used as is.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        img = Image.open(image)
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        img = Image.open(io.BytesIO(image))
     else:
-        img = image_path_or_pil.convert("RGB")
-    
-    img = img.resize((resolution, resolution), resample=Image.Resampling.LANCZOS)
-    img_np = np.array(img).astype(np.float32) / 255.0 # [H, W, C]
+        img = _reopen(image) or image
+
+    # No-op for other formats
+    if img is not image and resolution is not None:
+        img.draft("RGB", (resolution, resolution))
+    width, height = img.size
+    if width * height > max_decode_pixels:
+        raise ValueError(
+            f"Image of {width}x{height} pixels exceeds the decode limit of {max_decode_pixels} pixels"
+        )
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+
+def select_resolution(width, height, buckets=RESOLUTION_BUCKETS):
+    """The smallest bucket covering the longer image side, else the largest."""
+    side = max(width, height)
+    for resolution in sorted(buckets):
+        if resolution >= side:
+            return resolution
+    return max(buckets)
+
+
+def transform(image, resolution, max_decode_pixels=MAX_DECODE_PIXELS):
+    img = load_rgb(image, resolution, max_decode_pixels)
+    # Resize in uint8; reducing_gap box-reduces by an integer factor before LANCZOS
+    img = img.resize((resolution, resolution), resample=Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    # One uint8 host-to-device copy, normalized and transposed on device
+    return _normalize(mx.array(np.asarray(img)))  # [H, W, C] -> [C, H, W]
+
+# Results a grounding call can store in the state, under these keys
+OUTPUTS = ("boxes", "scores", "masks", "mask_logits", "semantic_seg")
+
+
+def check_outputs(outputs) -> frozenset:
+    """The requested subset of OUTPUTS, all of them if `outputs` is None."""
+    if outputs is None:
+        return frozenset(OUTPUTS)
+    outputs = frozenset(outputs)
+    unknown = outputs.difference(OUTPUTS)
+    if unknown:
+        raise ValueError(f"Unknown outputs {sorted(unknown)}, expected a subset of {OUTPUTS}")
+    return outputs
+
+
+def state_nbytes(state, shared=()) -> Dict[str, int]:
+    """Bytes held by the arrays of a processor state.
+    Arrays in `shared` (compared by identity, e.g. cached positional encodings)
+    are reported separately since every state references the same ones.
+    Each array is counted once, even if referenced from several keys.
+    """
+    shared_ids = {id(x) for x in shared}
+    seen = set()
+    totals = {"owned": 0, "shared": 0}
 
-    img_np = (img_np - 0.5) / 0.5
+    def visit(obj):
+        if isinstance(obj, mx.array):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                totals["shared" if id(obj) in shared_ids else "owned"] += obj.nbytes
+        elif isinstance(obj, dict):
+            for v in obj.values():
+                visit(v)
+        elif isinstance(obj, (list, tuple)):
+            for v in obj:
+                visit(v)
+
+    visit(state)
+    return totals
+
+
+class GroundingFuture:
+    """A grounding call whose device work is scheduled but may not be done.
+    `result()` waits for it, stores the outputs in the state and returns the
+    state; later calls return the same state.
+    """
+
+    def __init__(self, finish):
+        self._finish = finish
+        self._state = None
+
+    def result(self) -> Dict:
+        if self._finish is not None:
+            self._state = self._finish()
+            self._finish = None
+        return self._state
 
-    return mx.array(img_np).transpose(2, 0, 1)  # [H, W, C] -> [C, H, W]
 
 class Sam3Processor:
-    def __init__(self, model, resolution=1008, confidence_threshold=0.5):
+    def __init__(
+        self,
+        model,
+        resolution=1008,
+        confidence_threshold=0.5,
+        feature_dtype=None,
+        max_decode_pixels=MAX_DECODE_PIXELS,
+        mask_max_side=None,
+        max_detections=None,
+        box_nms_threshold=None,
+        mask_nms_threshold=None,
+        resolution_buckets=RESOLUTION_BUCKETS,
+        presence_gate=False,
+    ):
+        """`resolution` is the side of the square model input, or "auto" to
+        pick from `resolution_buckets` per image with `select_resolution`.
+        Resolutions must be multiples of the ViT patch size times its window.
+        `feature_dtype` optionally stores the per-image backbone features in
+        a smaller dtype (e.g. mx.float16 or mx.bfloat16); they are cast back
+        to the dtype of the model (`model.dtype`) when grounding reads them.
+        `max_decode_pixels` bounds the decoded size of the images given to
+        `set_image`, see `load_rgb`.
+        `mask_max_side` caps the longer side of the instance masks in
+        state["masks"] (a LazyMasks, upsampled on demand); boxes stay in image
+        pixels.
+        `max_detections` keeps only the highest scored detections.
+        `box_nms_threshold` and `mask_nms_threshold` drop a detection whose box
+        IoU, or mask IoU at the decoder resolution, with a higher scored one
+        exceeds them. Both run on device before the masks are upsampled; None
+        disables them.
+        `presence_gate` evaluates the scores before the segmentation heads,
+        which then only run if a query clears `confidence_threshold`: negative
+        prompts skip the pixel decoder and the mask heads, at the cost of a
+        second sync for positive ones. Their state["semantic_seg"] is then
+        None, standing for a map with no positive pixel.
+        """
         self.model = model
-        self.resolution = resolution
+        self.auto_resolution = resolution == "auto"
+        self.resolution_buckets = tuple(sorted(resolution_buckets))
+        # The largest bucket when automatic, e.g. for tiles
+        self.resolution = max(self.resolution_buckets) if self.auto_resolution else resolution
+        step = self._resolution_step()
+        for res in self.resolution_buckets if self.auto_resolution else (resolution,):
+            if res % step != 0:
+                raise ValueError(f"Resolution {res} is not a multiple of {step} (patch size times window)")
         self.confidence_threshold = confidence_threshold
-        self.transform = partial(transform, resolution=self.resolution)
+        self.feature_dtype = feature_dtype
+        self.max_decode_pixels = max_decode_pixels
+        self.mask_max_side = mask_max_side
+        self.max_detections = max_detections
+        self.box_nms_threshold = box_nms_threshold
+        self.mask_nms_threshold = mask_nms_threshold
+        self.presence_gate = presence_gate
+        # The prompting methods accept a `cancel_check` callable, called at stage
+        # boundaries (before and after the backbone, before grounding is
+        # evaluated); it may raise to abandon the call. They also accept
+        # `outputs`, a subset of OUTPUTS: the rest is neither computed nor
+        # kept in the state.
+        self.transform = partial(
+            transform, resolution=self.resolution, max_decode_pixels=max_decode_pixels
+        )
 
 
         self.find_stage = FindStage(
@@ -47,7 +227,15 @@ class Sam3Processor:
         )
 
    
-    def set_image(self, image, state=None):
+    def set_image(self, image, state=None, cancel_check=None, blocking=True):
+        """Decodes `image` and computes its backbone features.
+        With `blocking=False` the features are only scheduled (mx.async_eval):
+        the call returns once the host work is done and the state can be
+        prompted right away, e.g. with `set_text_prompt_async`. The attention
+        memory cap then only applies at resolutions where a ViT attention
+        exceeds it (see `_backbone_attention_capped`): the backbone is then
+        evaluated as its attention chunks are built, see chunked_attention.
+        """
         if state is None:
             state = {}
         
@@ -58,16 +246,33 @@ class Sam3Processor:
         else:
             raise ValueError("Image must be a PIL image")
         
-        image = self.transform(image)[None]
+        resolution = self.resolution
+        if self.auto_resolution:
+            resolution = select_resolution(width, height, self.resolution_buckets)
+        image = transform(image, resolution, self.max_decode_pixels)[None]
+        if cancel_check is not None:
+            cancel_check()
 
         state["original_height"] = height
         state["original_width"] = width
+        state["resolution"] = resolution
         import time
         start = time.perf_counter()
-        state["backbone_out"] = self.model.backbone.call_image(image)
-        mx.eval(state)
-        second = time.perf_counter()
-        print(f"Backbone pass took {second - start:.2f} Seconds")
+        # Chunked attention evaluates as the graph is built: when blocking, or
+        # when the scores would not fit the cap anyway
+        bounded = blocking or self._backbone_attention_capped(resolution)
+        with bound_attention_memory() if bounded else nullcontext():
+            state["backbone_out"] = self._compact_backbone_out(
+                self.model.backbone.call_image(image)
+            )
+        if blocking:
+            mx.eval(state)
+            second = time.perf_counter()
+            print(f"Backbone pass took {second - start:.2f} Seconds")
+        else:
+            mx.async_eval(state["backbone_out"])
+        if cancel_check is not None:
+            cancel_check()
         inst_interactivity_en = self.model.inst_interactive_predictor is not None
         if inst_interactivity_en and "sam2_backbone_out" in state["backbone_out"]:
             sam2_backbone_out = state["backbone_out"]["sam2_backbone_out"]
@@ -83,21 +288,208 @@ class Sam3Processor:
             )
         return state
 
+    def _compact_backbone_out(self, backbone_out: Dict) -> Dict:
+        """Keep only what grounding reads from the backbone output.
+        The segmentation head reads every FPN level, the encoder only the last
+        `num_feature_levels`. Features and positional encodings are NHWC, the
+        layout the model reads them in on every prompt. Positional encodings
+        come from the shared POSITIONAL_BUFFERS and are kept by reference, or
+        cast once per image to the dtype of the model.
+        """
+        fpn = backbone_out["backbone_fpn"]
+        if self.model.segmentation_head is None:
+            fpn = fpn[-self.model.num_feature_levels:]
+        if self.feature_dtype is not None:
+            fpn = [x.astype(self.feature_dtype) for x in fpn]
+        pos = [x.astype(self.model.dtype) for x in backbone_out["vision_pos_enc"][-self.model.num_feature_levels:]]
+
+        compact = {
+            "vision_features": fpn[-1],
+            "vision_pos_enc": pos,
+            "backbone_fpn": fpn,
+        }
+        if "sam2_backbone_out" in backbone_out:
+            compact["sam2_backbone_out"] = backbone_out["sam2_backbone_out"]
+        return compact
+
+    def shared_arrays(self) -> List[mx.array]:
+        """Arrays referenced by every state, e.g. for `state_nbytes`."""
+        return POSITIONAL_BUFFERS.arrays()
+
+    def segment_tiled(
+        self,
+        image,
+        prompt: str,
+        tile_overlap=256,
+        batch_size=2,
+        box_nms_threshold=0.5,
+        mask_nms_threshold=0.5,
+        cancel_check=None,
+    ) -> Dict:
+        """Text-prompted segmentation of an image larger than `resolution`, at
+        native scale.
+        The image is cut into square tiles of `resolution` pixels overlapping by
+        about `tile_overlap` (see sam3.model.tiling). Their backbone features
+        are computed `batch_size` tiles at a time, and the text prompt, encoded
+        once, is grounded on each tile with the usual threshold and NMS.
+        Detections are merged across tiles as they come, greedily in tile
+        order (see TileMerger), so memory is bounded by one batch of tile
+        features plus the surviving detections. Returns a state with "boxes",
+        "scores" and "masks" (a TiledMasks) for the whole image, which cannot
+        be prompted further.
+        An undecoded `image` is decoded again from its file at full size, see
+        `load_rgb`; a decoded one is tiled as it is.
+        """
+        if not isinstance(image, PIL.Image.Image):
+            raise ValueError("Image must be a PIL image")
+        # No draft-mode reduction; the size is the decoded one
+        image = load_rgb(image, None, self.max_decode_pixels)
+        width, height = image.size
+
+        tile = self.resolution
+        mask_size = self._mask_size()
+        stride = tile_stride(tile, mask_size, tile_overlap)
+        origins = [
+            (y, x)
+            for y in tile_origins(height, tile, stride)
+            for x in tile_origins(width, tile, stride)
+        ]
+
+        text_outputs = self.model.backbone.call_text([prompt])
+        merger = TileMerger(tile / mask_size, box_nms_threshold, mask_nms_threshold)
+        for start in range(0, len(origins), batch_size):
+            batch = origins[start:start + batch_size]
+            # Tiles past the image edge are padded with black by PIL
+            pixels = mx.concatenate(
+                [self.transform(image.crop((x, y, x + tile, y + tile)))[None] for y, x in batch]
+            )
+            with bound_attention_memory():
+                backbone_out = self._compact_backbone_out(self.model.backbone.call_image(pixels))
+                mx.eval(backbone_out)
+            if cancel_check is not None:
+                cancel_check()
+            for i, (y, x) in enumerate(batch):
+                tile_state = {
+                    "backbone_out": {**self._select_image(backbone_out, i), **text_outputs},
+                    "geometric_prompt": self.model._get_dummy_prompt(),
+                    "original_height": tile,
+                    "original_width": tile,
+                }
+                self._call_grounding(tile_state, cancel_check, ("boxes", "scores", "mask_logits"))
+                merger.add(
+                    (y, x),
+                    tile_state["boxes"] + mx.array([x, y, x, y], dtype=mx.float32),
+                    tile_state["scores"],
+                    tile_state["mask_logits"],
+                )
+            del backbone_out
+
+        boxes, scores, logits, mask_origins, support = merger.result()
+        if self.max_detections is not None:
+            boxes, scores, logits = (x[: self.max_detections] for x in (boxes, scores, logits))
+            mask_origins, support = mask_origins[: self.max_detections], support[: self.max_detections]
+        return {
+            "original_height": height,
+            "original_width": width,
+            "boxes": mx.clip(boxes, 0, mx.array([width, height, width, height])),
+            "scores": scores,
+            "masks": TiledMasks(
+                logits, mask_origins, (tile, tile), (height, width), support, max_side=self.mask_max_side
+            ),
+        }
+
+    def _resolution_step(self) -> int:
+        """Resolutions are multiples of this: one patch per token and whole
+        attention windows, so windows need no padding."""
+        trunk = self.model.backbone.vision_backbone.trunk
+        patch_size = trunk.patch_embed.proj.weight.shape[1]
+        window_size = max((block.window_size for block in trunk.blocks), default=0)
+        return patch_size * max(window_size, 1)
+
+    def _mask_size(self) -> int:
+        """Side of the decoder mask logits: the first FPN level, the ViT
+        token grid upsampled by the first neck scale factor (x4)."""
+        neck = self.model.backbone.vision_backbone
+        patch_size = neck.trunk.patch_embed.proj.weight.shape[1]
+        return int(self.resolution // patch_size * neck.scale_factors[0])
+
+    def _backbone_attention_capped(self, resolution) -> bool:
+        """Whether the scores of a ViT block at `resolution` exceed its
+        attention memory cap on this device (see chunked_attention)."""
+        if fused_attention_available():
+            return False
+        trunk = self.model.backbone.vision_backbone.trunk
+        weight = trunk.patch_embed.proj.weight
+        side = resolution // weight.shape[1]
+        for block in trunk.blocks:
+            cap = block.attn.attention_memory_cap
+            if cap is None:
+                continue
+            if block.window_size > 0:
+                windows, tokens = math.ceil(side / block.window_size) ** 2, block.window_size ** 2
+            else:
+                windows, tokens = 1, side ** 2
+            if windows * block.attn.num_heads * tokens ** 2 * weight.dtype.size > cap:
+                return True
+        return False
+
+    @staticmethod
+    def _select_image(backbone_out: Dict, index: int) -> Dict:
+        """The compacted backbone output of one image of a batch."""
+        fpn = [x[index:index + 1] for x in backbone_out["backbone_fpn"]]
+        return {
+            "vision_features": fpn[-1],
+            "vision_pos_enc": [x[:1] for x in backbone_out["vision_pos_enc"]],
+            "backbone_fpn": fpn,
+        }
+
     def set_image_batch(self, iamges: List[np.ndarray], state=None):
         pass
 
-    def set_text_prompt(self, prompt: str, state: Dict):
+    def set_text_prompt(self, prompt: str, state: Dict, cancel_check=None, outputs=None):
+        with bound_attention_memory():
+            future = self.set_text_prompt_async(prompt, state, cancel_check, outputs)
+        return future.result()
+
+    def set_text_prompt_async(self, prompt: str, state: Dict, cancel_check=None, outputs=None) -> GroundingFuture:
+        """Like `set_text_prompt`, but returns as soon as the device work is
+        scheduled. Results land in `state` when the future's `result()` is
+        called; the state must not be prompted again before that. The
+        attention memory cap does not apply, see chunked_attention.
+        """
         if "backbone_out" not in state:
             raise ValueError("You must call set_image before set_text_prompt")
-        
+
         text_outputs = self.model.backbone.call_text([prompt])
         # will erase the previous text prompt if any
         state["backbone_out"].update(text_outputs)
         if "geometric_prompt" not in state:
             state["geometric_prompt"] = self.model._get_dummy_prompt()
-        return self._call_grounding(state)
+        return self._start_grounding(state, cancel_check, outputs)
+
+    def stream(self, requests: Iterable, outputs=None, postprocess: Optional[Callable] = None) -> Iterator:
+        """Pipelined text prompting of a stream of images.
+        `requests` yields (image, prompt) pairs; results are yielded in order,
+        as `postprocess(state)` if given (e.g. RLE or PNG encoding), else the
+        state. While the device runs request N, the host decodes and resizes
+        request N+1 and finishes request N-1.
+        """
+        previous = None
+        for image, prompt in requests:
+            state = self.set_image(image, blocking=False)
+            future = self.set_text_prompt_async(prompt, state, outputs=outputs)
+            if previous is not None:
+                yield self._finish_stream(previous, postprocess)
+            previous = future
+        if previous is not None:
+            yield self._finish_stream(previous, postprocess)
+
+    @staticmethod
+    def _finish_stream(future: GroundingFuture, postprocess: Optional[Callable]):
+        state = future.result()
+        return state if postprocess is None else postprocess(state)
 
-    def add_geometric_prompt(self, box: List, label: bool, state: Dict):
+    def add_geometric_prompt(self, box: List, label: bool, state: Dict, cancel_check=None, outputs=None):
         """Adds a box prompt and run the inference.
         The image needs to be set, but not necessarily the text prompt.
         The box is assumed to be in [center_x, center_y, width, height] format and normalized in [0, 1] range.
@@ -121,7 +513,30 @@ class Sam3Processor:
         labels = mx.array([label], dtype=mx.bool_).reshape(1, 1)
         state["geometric_prompt"].append_boxes(boxes, labels)
 
-        return self._call_grounding(state)
+        return self._call_grounding(state, cancel_check, outputs)
+
+    def set_prompts(self, prompt: Optional[str], boxes: List, state: Dict, cancel_check=None, outputs=None):
+        """Replaces all the prompts and runs the inference once.
+        `prompt` is the text prompt, or None to rely only on the geometric prompts.
+        `boxes` is a list of (box, label) pairs, in the format of `add_geometric_prompt`.
+        """
+        if "backbone_out" not in state:
+            raise ValueError("You must call set_image before set_prompts")
+
+        self.reset_all_prompts(state)
+        text_outputs = self.model.backbone.call_text(
+            [prompt if prompt is not None else "visual"]
+        )
+        state["backbone_out"].update(text_outputs)
+
+        state["geometric_prompt"] = self.model._get_dummy_prompt()
+        for box, label in boxes:
+            state["geometric_prompt"].append_boxes(
+                mx.array(box, dtype=mx.float32).reshape(1, 1, 4),
+                mx.array([label], dtype=mx.bool_).reshape(1, 1),
+            )
+
+        return self._call_grounding(state, cancel_check, outputs)
 
     def reset_all_prompts(self, state: Dict):
         """Removes all the prompts and results"""
@@ -135,7 +550,7 @@ class Sam3Processor:
                 if key in state["backbone_out"]:
                     del state["backbone_out"][key]
 
-        keys_to_del = ["geometric_prompt", "boxes", "masks", "masks_logits", "scores"]
+        keys_to_del = ["geometric_prompt", *OUTPUTS]
         for key in keys_to_del:
             if key in state:
                 del state[key]
@@ -143,51 +558,135 @@ class Sam3Processor:
     def set_confidence_threshold(self, threshold: float, state=None):
         pass
 
-    def _call_grounding(self, state: Dict):
-        outputs = self.model.call_grounding(
-            backbone_out=state["backbone_out"],
+    def _call_grounding(self, state: Dict, cancel_check=None, outputs=None):
+        with bound_attention_memory():
+            future = self._start_grounding(state, cancel_check, outputs)
+        return future.result()
+
+    def _start_grounding(self, state: Dict, cancel_check=None, outputs=None) -> GroundingFuture:
+        """Builds the grounding graph and schedules it with mx.async_eval. The
+        returned future stores the results in `state` once they are ready."""
+        outputs = check_outputs(outputs)
+        # Shallow copy: the model pops and adds entries it does not own
+        backbone_out = dict(state["backbone_out"])
+        if self.feature_dtype is not None:
+            fpn = [x.astype(self.model.dtype) for x in backbone_out["backbone_fpn"]]
+            backbone_out["backbone_fpn"] = fpn
+            backbone_out["vision_features"] = fpn[-1]
+
+        with_masks = "masks" in outputs or "mask_logits" in outputs
+        with_semantic_seg = "semantic_seg" in outputs
+        # Mask NMS reads the instance masks even if they are not returned, so
+        # that the kept detections do not depend on `outputs`
+        with_mask_nms = self.mask_nms_threshold is not None
+        model_out, segmentation_inputs = self.model.call_detection(
+            backbone_out=backbone_out,
             find_input=self.find_stage,
             geometric_prompt=state["geometric_prompt"],
-            find_target=None
+            find_target=None,
         )
 
-        out_bbox = outputs["pred_boxes"]
-        out_logits = outputs["pred_logits"]
-        out_masks = outputs["pred_masks"]
-        out_probs = mx.sigmoid(out_logits)
-        presence_score = mx.sigmoid(outputs["presence_logit_dec"])[:,None]
-        out_probs = (out_probs * presence_score).squeeze(-1)
+        out_probs = mx.sigmoid(model_out["pred_logits"])
+        presence_score = mx.sigmoid(model_out["presence_logit_dec"])[:,None]
+        out_probs = (out_probs * presence_score).squeeze(-1)[0]
 
+        # Without any query above the threshold nothing is kept, so the
+        # segmentation heads are not needed
+        gated = False
+        if self.presence_gate and (with_masks or with_semantic_seg or with_mask_nms):
+            if cancel_check is not None:
+                cancel_check()
+            gated = not (out_probs.max() > self.confidence_threshold).item()
+        if with_masks or with_semantic_seg or with_mask_nms:
+            if gated:
+                with_mask_nms = False
+            else:
+                self.model.call_segmentation(model_out, segmentation_inputs)
+
+        # Selection stays on device: queries sorted by score, so the ones
+        # above the threshold come first and only their count reaches the host
+        order = mx.argsort(-out_probs)
+        out_probs = out_probs[order]
         keep = out_probs > self.confidence_threshold
-        mask_np = np.array(keep[0])
-        indices = mx.array(mask_np.nonzero()[0])
-        out_probs = out_probs[0][indices]
-        # out_probs = out_probs[keep]
-        out_masks = out_masks[0][indices]
-        out_bbox = out_bbox[0][indices]
-        seg_mask = outputs['semantic_seg']
 
         # convert box to [x0, y0, x1, y1] format
-        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
+        boxes = box_ops.box_cxcywh_to_xyxy(model_out["pred_boxes"][0][order])
+
+        if self.box_nms_threshold is not None or with_mask_nms:
+            keep = keep & nms(
+                boxes,
+                model_out["pred_masks"][0][order] if with_mask_nms else None,
+                box_iou_threshold=self.box_nms_threshold,
+                mask_iou_threshold=self.mask_nms_threshold,
+                candidates=keep,
+            )
+            # Survivors first, still by descending score
+            rank = mx.arange(keep.shape[0])
+            survivors = mx.argsort(mx.where(keep, rank, rank + keep.shape[0]))
+            order = order[survivors]
+            out_probs = out_probs[survivors]
+            boxes = boxes[survivors]
+        num_kept = keep.sum()
+        if self.max_detections is not None:
+            num_kept = mx.minimum(num_kept, self.max_detections)
 
         img_h = state["original_height"]
         img_w = state["original_width"]
         scale_fct = mx.array([img_w, img_h, img_w, img_h])
         boxes = boxes * scale_fct[None, :]
 
-        interpolator = partial(interpolate,
-            size=(img_h, img_w),
-            mode="bilinear",
-            align_corners=False,
-        )
-        out_masks = interpolator(out_masks[:, None])
-        out_masks = mx.sigmoid(out_masks)
+        # Heads that are not evaluated are never computed
+        pending = [num_kept, order, out_probs, boxes]
+        if with_masks and not gated:
+            out_masks = model_out["pred_masks"][0]
+            support = mask_support_boxes(out_masks)[order]
+            pending += [out_masks, support]
+        if with_semantic_seg and not gated:
+            seg_mask = model_out["semantic_seg"]
+            pending.append(seg_mask)
+
+        if cancel_check is not None:
+            cancel_check()
+        # The one sync of the call (plus one each for the presence gate and
+        # mask NMS, see sam3.model.nms): encoder,
+        # decoder, heads and selection run as a single graph, scheduled here
+        # and waited for by the future
+        mx.async_eval(*pending)
+
+        def finish():
+            mx.eval(*pending)
+            count = num_kept.item()
 
-        seg_mask = interpolator(seg_mask)
+            for key in OUTPUTS:
+                state.pop(key, None)
+            if with_masks:
+                # Instance masks stay at the decoder resolution, see LazyMasks
+                if gated:
+                    # The masks have the size of the first FPN level, NHWC
+                    mask_size = state["backbone_out"]["backbone_fpn"][0].shape[1:3]
+                    mask_logits = mx.zeros((0, *mask_size))
+                    kept_support = mx.zeros((0, 4), dtype=mx.int32)
+                else:
+                    mask_logits = out_masks[order[:count]]
+                    kept_support = support[:count]
+                if "mask_logits" in outputs:
+                    state["mask_logits"] = mask_logits
+                if "masks" in outputs:
+                    state["masks"] = LazyMasks(
+                        mask_logits, (img_h, img_w), kept_support, max_side=self.mask_max_side
+                    )
+            if with_semantic_seg:
+                if gated:
+                    # Nothing positive: no full-resolution map of -inf
+                    state["semantic_seg"] = None
+                else:
+                    state["semantic_seg"] = interpolate(
+                        seg_mask, size=(img_h, img_w), mode="bilinear", align_corners=False
+                    )
+            if "boxes" in outputs:
+                state["boxes"] = boxes[:count]
+            if "scores" in outputs:
+                state["scores"] = out_probs[:count]
+            return state
 
-        state["semantic_seg"] = seg_mask
-        state["mask_logits"] = out_masks
-        state["masks"] = out_masks > 0.5
-        state["boxes"] = boxes
-        state["scores"] = out_probs
-        return state
\ No newline at end of file
+        return GroundingFuture(finish)
@@ -4,6 +4,7 @@ from typing import Callable, List, Optional, Tuple, Union
 import mlx.core as mx
 import mlx.nn as nn
 
+from .compile_cache import TEXT_LENGTH_BUCKETS, CompiledFunction, bucket_size
 from .model_misc import LayerScale
 
 class MLP(nn.Module):
@@ -212,20 +213,27 @@ class TextTransformer(nn.Module):
         mask = mx.triu(mask, k=1)
         return mask
 
-    def __call__(
-        self, text: mx.array
-    ) -> Union[mx.array, Tuple[mx.array, mx.array]]:
+    def encode_tokens(self, text: mx.array, inputs_embeds: Optional[mx.array] = None) -> mx.array:
+        """The final hidden states of `text`, [batch_size, n_ctx, width],
+        before pooling and projection. `inputs_embeds` are the token
+        embeddings of `text`, if already computed."""
         seq_len = text.shape[1]
-        x = self.token_embedding(text)  # [batch_size, n_ctx, d_model]
+        if inputs_embeds is None:
+            inputs_embeds = self.token_embedding(text)  # [batch_size, n_ctx, d_model]
 
         attn_mask = self.attn_mask
         if attn_mask is not None:
             attn_mask = attn_mask[:seq_len, :seq_len]
 
-        x = x + self.positional_embedding[:seq_len]
+        x = inputs_embeds + self.positional_embedding[:seq_len]
         x = self.transformer(x, attn_mask=attn_mask)
 
-        x = self.ln_final(x)
+        return self.ln_final(x)
+
+    def __call__(
+        self, text: mx.array
+    ) -> Union[mx.array, Tuple[mx.array, mx.array]]:
+        x = self.encode_tokens(text)
         pooled, tokens = text_global_pool(x, text, pool_type=self.pool_type)
         if self.text_projection is not None:
             if isinstance(self.text_projection, nn.Linear):
@@ -270,6 +278,33 @@ class VETextEncoder(nn.Module):
         )
         self.resizer = nn.Linear(self.encoder.width, d_model)
 
+        # Compiled per batch size and token length bucket, see CompiledFunction
+        self.compile_mode = compile_mode
+        self.compiled = CompiledFunction(self._encode, inputs=self) if compile_mode else None
+
+        # Embeds the tokens once and skips the pooled projection, see
+        # model_builder.set_inference_mode
+        self.inference_mode = False
+
+    def _encode(self, tokenized: mx.array) -> Tuple[mx.array, mx.array]:
+        # manually embed the tokens
+        inputs_embeds = self.encoder.token_embedding(
+            tokenized
+        )  # [b, seq_len, d=1024]
+        if self.inference_mode and not self.training and self.encoder.pool_type == "none":
+            # Only the tokens are read: the pooled output is not projected,
+            # and the embeddings above are reused
+            text_memory = self.encoder.encode_tokens(tokenized, inputs_embeds)
+        else:
+            _, text_memory = self.encoder(tokenized)  # [b, seq_len, d=1024]
+
+        assert text_memory.shape[1] == inputs_embeds.shape[1]
+        # Transpose memory because pytorch's attention expects sequence first
+        text_memory = text_memory.transpose(1, 0, 2)
+        # Resize the encoder hidden states to be of the same d_model as the decoder
+        text_memory_resized = self.resizer(text_memory)
+        return inputs_embeds, text_memory_resized
+
     def __call__(
         self,
         text: Union[List[str], Tuple[mx.array, mx.array, dict]],
@@ -281,21 +316,18 @@ class VETextEncoder(nn.Module):
 
             # Encode the text
             tokenized = self.tokenizer(text, context_length=self.context_length)  # [b, seq_len]
+            if self.compiled is not None:
+                # Cut to the longest prompt, rounded up to a length bucket. The
+                # encoder is causal, so the kept positions do not depend on
+                # the cut ones, which are padding masked downstream anyway
+                length = bucket_size(int((tokenized != 0).sum(axis=1).max()), TEXT_LENGTH_BUCKETS)
+                tokenized = tokenized[:, : min(length, self.context_length)]
             text_attention_mask = (tokenized != 0).astype(mx.bool_)
 
-            # manually embed the tokens
-            inputs_embeds = self.encoder.token_embedding(
-                tokenized
-            )  # [b, seq_len, d=1024]
-            _, text_memory = self.encoder(tokenized)  # [b, seq_len, d=1024]
-
-            assert text_memory.shape[1] == inputs_embeds.shape[1]
+            encode = self._encode if self.compiled is None or self.training else self.compiled
+            inputs_embeds, text_memory_resized = encode(tokenized)
             # Invert attention mask because its the opposite in pytorch transformer
             text_attention_mask = mx.not_equal(text_attention_mask, 1)
-            # Transpose memory because pytorch's attention expects sequence first
-            text_memory = text_memory.transpose(1, 0, 2)
-            # Resize the encoder hidden states to be of the same d_model as the decoder
-            text_memory_resized = self.resizer(text_memory)
         else:
             # The text is already encoded, use as is.
             text_attention_mask, text_memory_resized, tokenized = text
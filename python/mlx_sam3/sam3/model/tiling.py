@@ -0,0 +1,154 @@
+"""
+Tiled inference on images larger than the model resolution.
+
+The image is cut into overlapping square tiles of `resolution` pixels, each
+seen by the model at native scale. Tile origins are multiples of a whole
+number of decoder mask cells (resolution / mask_size pixels), so the masks of
+all tiles lie on one global cell grid and can be compared exactly across
+seams.
+"""
+
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+import mlx.core as mx
+
+from sam3.model.box_ops import box_iou
+from sam3.model.mask_ops import mask_support_boxes
+
+
+def tile_stride(resolution: int, mask_size: int, overlap: int) -> int:
+    """Largest stride of at most `resolution - overlap` pixels that moves a
+    tile by whole mask cells and whole pixels."""
+    step = resolution // math.gcd(resolution, mask_size)
+    return max(step, (resolution - overlap) // step * step)
+
+
+def tile_origins(length: int, tile: int, stride: int) -> List[int]:
+    """Tile starts along an axis of `length` pixels. The last tile may extend
+    past the image, which is padded."""
+    if length <= tile:
+        return [0]
+    return [i * stride for i in range(math.ceil((length - tile) / stride) + 1)]
+
+
+class TileMerger:
+    """Merges per-tile detections into one image-level result, a tile at a time.
+
+    A detection is dropped when a higher scored detection of another tile
+    overlaps it: box IoU above `box_iou_threshold`, or mask IoU on the global
+    cell grid above `mask_iou_threshold` (None disables either test).
+    Detections of the same tile are kept as the tile's grounding returned
+    them. Only the decoder logits of the surviving detections are held.
+
+    Suppression is greedy by score within each `add`, but dropped detections
+    are gone for good, so the result depends on the tile order and can differ
+    from one greedy pass over all tiles: a detection that suppressed another
+    and is later suppressed itself does not bring the other back. Merging once
+    at the end would hold the logits of every tile.
+    """
+
+    def __init__(
+        self,
+        cell: float,
+        box_iou_threshold: Optional[float] = 0.5,
+        mask_iou_threshold: Optional[float] = 0.5,
+    ):
+        self.cell = cell
+        self.box_iou_threshold = box_iou_threshold
+        self.mask_iou_threshold = mask_iou_threshold
+        self.boxes = mx.zeros((0, 4))
+        self.scores = mx.zeros((0,))
+        self.logits = None
+        self.origins = np.zeros((0, 2), dtype=np.int64)
+        # Per detection: mask support (see LazyMasks), tile cell offset and positive cells
+        self.support = np.zeros((0, 4), dtype=np.int64)
+        self.offsets = np.zeros((0, 2), dtype=np.int64)
+        self.areas = np.zeros((0,), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.scores.shape[0]
+
+    def add(self, origin: Tuple[int, int], boxes: mx.array, scores: mx.array, logits: mx.array):
+        """Detections of the tile at pixel `origin` (y, x): [n, 4] boxes in
+        image pixels, [n] scores and [n, h, w] decoder mask logits."""
+        n = scores.shape[0]
+        if n == 0:
+            return
+
+        # Cell offset (y, x) of the tile on the global grid
+        offset = np.array([round(origin[0] / self.cell), round(origin[1] / self.cell)])
+        support, areas = mask_support_boxes(logits), (logits > 0).sum(axis=(1, 2))
+        old = len(self)
+        pending = [support, areas]
+        if old:
+            ious = box_iou(self.boxes, boxes)[0]
+            pending.append(ious)
+        mx.eval(*pending)
+        support, areas = np.array(support), np.array(areas)
+
+        # Overlaps between the held detections and the new ones
+        overlaps = np.zeros((old, n), dtype=bool)
+        if old and self.box_iou_threshold is not None:
+            overlaps |= np.array(ious) > self.box_iou_threshold
+        if old and self.mask_iou_threshold is not None:
+            overlaps |= self._mask_overlaps(offset, areas, logits)
+
+        # Greedy suppression by descending score, held and new together
+        scores_all = mx.concatenate([self.scores, scores])
+        order = np.argsort(-np.array(scores_all), kind="stable")
+        full = np.zeros((old + n, old + n), dtype=bool)
+        full[:old, old:] = overlaps
+        full |= full.T
+        full = full[order][:, order]
+        keep = np.ones(old + n, dtype=bool)
+        for i in range(old + n):
+            if keep[i]:
+                keep[i + 1 :] &= ~full[i, i + 1 :]
+        kept = order[keep]
+
+        index = mx.array(kept)
+        self.boxes = mx.concatenate([self.boxes, boxes])[index]
+        self.scores = scores_all[index]
+        self.logits = logits[index] if self.logits is None else mx.concatenate([self.logits, logits])[index]
+        self.origins = np.concatenate([self.origins, np.tile(origin, (n, 1))])[kept]
+        self.support = np.concatenate([self.support, support])[kept]
+        self.offsets = np.concatenate([self.offsets, np.tile(offset, (n, 1))])[kept]
+        self.areas = np.concatenate([self.areas, areas])[kept]
+        # Compacted: drops the references to the per-tile outputs
+        mx.eval(self.boxes, self.scores, self.logits)
+
+    def result(self):
+        """The held detections by descending score: boxes, scores, mask
+        logits, tile origins and mask support."""
+        logits = mx.zeros((0, 1, 1)) if self.logits is None else self.logits
+        return self.boxes, self.scores, logits, self.origins, self.support
+
+    def _mask_overlaps(self, offset, areas, logits) -> np.ndarray:
+        """Mask IoU test between the held and the new detections. Masks of two
+        tiles are compared over the cells the tiles share, with one matmul per
+        held tile."""
+        size = np.array(logits.shape[1:])
+        new = (logits > 0).astype(mx.float32)
+        groups, inters = [], []
+        for held in np.unique(self.offsets, axis=0):
+            lo = np.maximum(held, offset)
+            hi = np.minimum(held, offset) + size
+            if (lo >= hi).any():
+                continue
+            index = np.flatnonzero((self.offsets == held).all(axis=1))
+            (y0, x0), (y1, x1) = (lo - held).tolist(), (hi - held).tolist()
+            a = (self.logits[mx.array(index), y0:y1, x0:x1] > 0).astype(mx.float32)
+            (y0, x0), (y1, x1) = (lo - offset).tolist(), (hi - offset).tolist()
+            b = new[:, y0:y1, x0:x1]
+            inters.append(a.reshape(len(index), -1) @ b.reshape(b.shape[0], -1).T)
+            groups.append(index)
+        mx.eval(inters)
+
+        result = np.zeros((len(self), logits.shape[0]), dtype=bool)
+        for index, inter in zip(groups, inters):
+            inter = np.array(inter)
+            union = self.areas[index][:, None] + areas[None, :] - inter
+            result[index] = inter > self.mask_iou_threshold * np.maximum(union, 1)
+        return result
@@ -0,0 +1,133 @@
+"""
+Token merging for attention.
+
+At 1008 pixels the global ViT blocks and the fusion encoder self-attention
+attend over 72 x 72 = 5184 image tokens, many of them near duplicates of
+their neighbours (background, uniform regions). `TokenMerge` merges the most
+similar tokens before attention, with bipartite soft matching (Bolya et al.,
+"Token Merging: Your ViT But Faster"), and copies the output of each merged
+token back to the tokens it merged after attention, so the rest of the block
+runs on every token.
+
+Tokens are split into destinations (every DESTINATION_STRIDE-th token, an
+even spread over the image) and sources. Each source is matched to its most
+similar destination, by cosine similarity of the keys, and the `ratio` of
+all tokens that are best matched are averaged into their destination.
+Attention is proportional: the score of a merged key is offset by the log of
+the number of tokens it stands for, so that it weighs as much as they did.
+"""
+
+import math
+from typing import Optional
+
+import mlx.core as mx
+import numpy as np
+
+from .chunked_attention import ATTENTION_MEMORY_CAP, attention
+
+# One destination token per DESTINATION_STRIDE tokens: at most
+# 1 - 1 / DESTINATION_STRIDE of the tokens can be merged
+DESTINATION_STRIDE = 4
+MAX_MERGE_RATIO = 1 - 1 / DESTINATION_STRIDE
+
+
+class TokenMerge:
+    """Merges `ratio` of the L tokens of [B, heads, L, D] arrays, matched on
+    `metric` ([B, heads, L, D], e.g. the keys)."""
+
+    def __init__(self, metric: mx.array, ratio: float):
+        if not 0 < ratio <= MAX_MERGE_RATIO:
+            raise ValueError(f"Token merge ratio must be in (0, {MAX_MERGE_RATIO}], got {ratio}")
+        B, _, L, _ = metric.shape
+        index = np.arange(L)
+        self.dst_idx = mx.array(index[index % DESTINATION_STRIDE == 0], dtype=mx.uint32)
+        self.src_idx = mx.array(index[index % DESTINATION_STRIDE != 0], dtype=mx.uint32)
+        num_dst = self.dst_idx.shape[0]
+        num_src = L - num_dst
+        self.num_merged = min(int(math.floor(L * ratio)), num_src)
+
+        # Cosine similarity of the head averaged keys
+        metric = metric.mean(axis=1)
+        metric = metric / mx.linalg.norm(metric, axis=-1, keepdims=True)
+        similarity = metric[:, self.src_idx] @ metric[:, self.dst_idx].swapaxes(-1, -2)
+        best = similarity.max(axis=-1)
+        best_dst = similarity.argmax(axis=-1)
+
+        # Sources sorted from most to least similar: the first num_merged
+        # are merged, the others kept
+        order = mx.argsort(-best, axis=-1)
+        self.merged_src = order[:, : self.num_merged]
+        self.kept_src = order[:, self.num_merged :]
+        self.merged_dst = mx.take_along_axis(best_dst, self.merged_src, axis=-1)
+        num_kept = num_src - self.num_merged
+
+        # Number of tokens each merged token stands for: kept sources first,
+        # then destinations
+        batch = mx.arange(B)[:, None] * num_dst
+        flat_dst = (self.merged_dst + batch).flatten()
+        dst_sizes = mx.ones((B * num_dst,)).at[flat_dst].add(mx.ones(flat_dst.shape))
+        self.dst_sizes = dst_sizes.reshape(B, num_dst)
+        self._flat_dst = flat_dst
+        sizes = mx.concatenate([mx.ones((B, num_kept)), self.dst_sizes], axis=1)
+        # Additive attention bias over the merged keys, [B, 1, 1, L']
+        self.size_bias = mx.log(sizes)[:, None, None, :]
+
+        # Position in the merged sequence each original token reads back from
+        src_position = mx.zeros((B, num_src), dtype=mx.uint32)
+        src_position = mx.put_along_axis(
+            src_position, self.kept_src, mx.broadcast_to(mx.arange(num_kept, dtype=mx.uint32), (B, num_kept)), axis=1
+        )
+        src_position = mx.put_along_axis(
+            src_position, self.merged_src, (num_kept + self.merged_dst).astype(mx.uint32), axis=1
+        )
+        dst_position = mx.broadcast_to(mx.arange(num_kept, num_kept + num_dst, dtype=mx.uint32), (B, num_dst))
+        positions = mx.zeros((B, L), dtype=mx.uint32)
+        positions = mx.put_along_axis(positions, mx.broadcast_to(self.src_idx, (B, num_src)), src_position, axis=1)
+        positions = mx.put_along_axis(positions, mx.broadcast_to(self.dst_idx, (B, num_dst)), dst_position, axis=1)
+        self.positions = positions
+
+    def merge(self, x: mx.array) -> mx.array:
+        """[B, heads, L, D] -> [B, heads, L', D]: the kept sources, then the
+        destinations averaged with the sources merged into them."""
+        B, H, _, D = x.shape
+        src = x[:, :, self.src_idx]
+        dst = x[:, :, self.dst_idx]
+        kept = mx.take_along_axis(src, self.kept_src[:, None, :, None], axis=2)
+        merged = mx.take_along_axis(src, self.merged_src[:, None, :, None], axis=2)
+
+        # Scatter-add the merged sources into their destinations, tokens first
+        num_dst = dst.shape[2]
+        dst = dst.transpose(0, 2, 1, 3).reshape(B * num_dst, H, D)
+        merged = merged.transpose(0, 2, 1, 3).reshape(-1, H, D)
+        dst = dst.at[self._flat_dst].add(merged.astype(dst.dtype))
+        dst = dst / self.dst_sizes.reshape(-1, 1, 1).astype(dst.dtype)
+        dst = dst.reshape(B, num_dst, H, D).transpose(0, 2, 1, 3)
+        return mx.concatenate([kept, dst], axis=2)
+
+    def unmerge(self, x: mx.array) -> mx.array:
+        """[B, heads, L', D] -> [B, heads, L, D]: each token takes the output
+        of the merged token it went into."""
+        return mx.take_along_axis(x, self.positions[:, None, :, None], axis=2)
+
+
+def merged_attention(
+    q: mx.array,
+    k: mx.array,
+    v: mx.array,
+    scale: float,
+    ratio: float,
+    memory_cap: Optional[int] = ATTENTION_MEMORY_CAP,
+) -> mx.array:
+    """Self-attention (chunked_attention.attention) of [B, heads, L, D]
+    arrays over the tokens left once `ratio` of them are merged, unmerged
+    back to L tokens."""
+    tome = TokenMerge(k, ratio)
+    out = attention(
+        tome.merge(q),
+        tome.merge(k),
+        tome.merge(v),
+        scale,
+        mask=tome.size_bias.astype(q.dtype),
+        memory_cap=memory_cap,
+    )
+    return tome.unmerge(out)
@@ -11,14 +11,12 @@ import gzip
 import html
 import io
 import os
+import re
 import string
 from functools import lru_cache
 from typing import List, Optional, Union
 
-import ftfy
-import regex as re
 import mlx.core as mx
-from iopath.common.file_io import g_pathmgr
 
 
 # https://stackoverflow.com/q/62691279
@@ -66,6 +64,8 @@ def get_pairs(word):
 
 
 def basic_clean(text):
+    import ftfy
+
     text = ftfy.fix_text(text)
     text = html.unescape(html.unescape(text))
     return text.strip()
@@ -135,7 +135,13 @@ class SimpleTokenizer(object):
     ):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        with g_pathmgr.open(bpe_path, "rb") as fh:
+        if os.path.exists(bpe_path):
+            fh = open(bpe_path, "rb")
+        else:
+            from iopath.common.file_io import g_pathmgr
+
+            fh = g_pathmgr.open(bpe_path, "rb")
+        with fh:
             bpe_bytes = io.BytesIO(fh.read())
             merges = gzip.open(bpe_bytes).read().decode("utf-8").split("\n")
         # merges = gzip.open(bpe_path).read().decode("utf-8").split("\n")
@@ -154,9 +160,12 @@ class SimpleTokenizer(object):
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
         self.cache = {t: t for t in special_tokens}
         special = "|".join(special_tokens)
-        self.pat = re.compile(
+        # Unicode property classes need `regex`; the stdlib `re` does the rest
+        import regex
+
+        self.pat = regex.compile(
             special + r"""|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
-            re.IGNORECASE,
+            regex.IGNORECASE,
         )
         self.vocab_size = len(self.encoder)
         self.all_special_ids = [self.encoder[t] for t in special_tokens]
@@ -206,7 +215,7 @@ class SimpleTokenizer(object):
     def encode(self, text):
         bpe_tokens = []
         text = self.clean_fn(text)
-        for token in re.findall(self.pat, text):
+        for token in self.pat.findall(text):
             token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
             bpe_tokens.extend(
                 self.encoder[bpe_token] for bpe_token in self.bpe(token).split(" ")
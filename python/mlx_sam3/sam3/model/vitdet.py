@@ -1,4 +1,3 @@
-from curses import window
 from functools import partial
 import math
 from typing import Callable, List, Optional, Tuple, Union
@@ -6,7 +5,12 @@ from typing import Callable, List, Optional, Tuple, Union
 import mlx.core as mx
 import mlx.nn as nn
 
+from .chunked_attention import ATTENTION_MEMORY_CAP, attention
+from .compile_cache import CompiledFunction
+from .cpu_kernels import cpu_kernels_enabled, patch_embed
 from .model_misc import Mlp, LayerScale , DropPath
+from .positional_buffers import POSITIONAL_BUFFERS
+from .token_merging import merged_attention
 
 def polar(a, b):
     return (a * mx.exp(1j * b)).astype(mx.complex64)
@@ -29,7 +33,7 @@ def init_t_xy(
     t_y = mx.divide(t, end_x).astype(mx.float32)
     return t_x * scale + offset, t_y * scale + offset
 
-def compute_axial_cis(
+def compute_axial_angles(
     dim: int,
     end_x: int,
     end_y: int,
@@ -37,15 +41,35 @@ def compute_axial_cis(
     scale_pos: float = 1.0,
     offset: int = 0
 ) -> mx.array:
+    """Rotation angles [end_x * end_y, dim // 2] of the axial RoPE: x
+    frequencies on the first half of the pairs, y frequencies on the second."""
     freqs_x = 1.0 / (theta ** (mx.arange(0, dim, 4)[: (dim // 4)].astype(mx.float32) / dim))
     freqs_y = 1.0 / (theta ** (mx.arange(0, dim, 4)[: (dim // 4)].astype(mx.float32) / dim))
 
     t_x, t_y = init_t_xy(end_x, end_y, scale=scale_pos, offset=offset)
     freqs_x = mx.outer(t_x, freqs_x)
     freqs_y = mx.outer(t_y, freqs_y)
-    freqs_cis_x = polar(mx.ones_like(freqs_x), freqs_x) 
-    freqs_cis_y = polar(mx.ones_like(freqs_y), freqs_y)
-    return mx.concat([freqs_cis_x, freqs_cis_y], axis=-1)
+    return mx.concat([freqs_x, freqs_y], axis=-1)
+
+def compute_axial_cis(
+    dim: int,
+    end_x: int,
+    end_y: int,
+    theta: float = 10000.0,
+    scale_pos: float = 1.0,
+    offset: int = 0
+) -> mx.array:
+    angles = compute_axial_angles(dim, end_x, end_y, theta, scale_pos, offset)
+    return polar(mx.ones_like(angles), angles)
+
+def rope_cos_sin(angles: mx.array) -> Tuple[mx.array, mx.array]:
+    """Real tables of `apply_rotary_real` for [L, D/2] angles: the cosines and
+    the sines with the sign of each pair member, repeated over the pair to
+    [L, D]."""
+    cos, sin = mx.cos(angles), mx.sin(angles)
+    cos = mx.repeat(cos, 2, axis=-1)
+    sin = mx.stack([-sin, sin], axis=-1).reshape(*angles.shape[:-1], -1)
+    return cos, sin
 
 def reshape_for_broadcast(freqs_cis: mx.array, x: mx.array) -> mx.array:
     ndim = x.ndim
@@ -84,6 +108,30 @@ def apply_rotary_enc(
     xk_out = real(xk_ * freqs_cis).flatten(3)
     return xq_out.astype(xq.dtype), xk_out.astype(xk.dtype)
     
+@mx.compile
+def _rotate_pairs(x: mx.array, cos: mx.array, sin: mx.array) -> mx.array:
+    # (x0, x1) -> (x0 cos - x1 sin, x1 cos + x0 sin) for each interleaved
+    # pair, fused into one elementwise kernel
+    swapped = x.reshape(*x.shape[:-1], -1, 2)[..., ::-1].reshape(x.shape)
+    return (x * cos + swapped * sin).astype(x.dtype)
+
+def apply_rotary_real(
+    xq: mx.array,
+    xk: mx.array,
+    cos: mx.array,
+    sin: mx.array,
+    repeat_freqs_k: bool = False
+) -> Tuple[mx.array, mx.array]:
+    """`apply_rotary_enc` on the real tables of `rope_cos_sin`, without complex
+    arithmetic."""
+    xq_out = _rotate_pairs(xq, cos, sin)
+    if xk.shape[-2] == 0:
+        return xq_out, xk
+    if repeat_freqs_k:
+        r = xk.shape[-2] // xq.shape[-2]
+        cos, sin = mx.tile(cos, (r, 1)), mx.tile(sin, (r, 1))
+    return xq_out, _rotate_pairs(xk, cos, sin)
+
 def window_partition(x: mx.array, window_size: int) -> Tuple[mx.array, Tuple[int, int]]:
     B, H, W, C = x.shape
     
@@ -192,8 +240,12 @@ class PatchEmbed(nn.Module):
             padding=padding,
             bias=bias,
         )
+        self.nonoverlapping = tuple(self.proj.stride) == tuple(kernel_size) and tuple(self.proj.padding) == (0, 0)
     
     def __call__(self, x: mx.array) -> mx.array:
+        if self.nonoverlapping and cpu_kernels_enabled():
+            # B C H W -> B H W C, as a matmul over the patches
+            return patch_embed(x, self.proj.weight, self.proj.bias if "bias" in self.proj else None)
         # B C H W -> B H W C
         x = x.transpose(0, 2, 3, 1)
         x = self.proj(x)
@@ -236,6 +288,13 @@ class Attention(nn.Module):
         # init rel pos embeddings and rope
         self._setup_rel_pos(rel_pos_zero_init)
         self._setup_rope_freqs()
+
+        # Chunks the attention above this many bytes of scores when the fused
+        # kernel is unavailable, see chunked_attention.attention
+        self.attention_memory_cap = ATTENTION_MEMORY_CAP
+        # Merges this ratio of the tokens before attention when above 0, see
+        # token_merging.merged_attention
+        self.token_merge_ratio = 0.0
         
     def _setup_rel_pos(self, rel_pos_zero_init: bool = True) -> None:
         if not self.use_rel_pos:
@@ -261,8 +320,9 @@ class Attention(nn.Module):
         self.relative_coords = relative_coords.astype(mx.int64)
             
     def _setup_rope_freqs(self) -> None:
+        # The tables themselves are shared by the blocks through
+        # POSITIONAL_BUFFERS, see _get_rope_tables
         if not self.use_rope:
-            self.freqs_cis = None
             return
         
         assert self.input_size is not None
@@ -270,38 +330,51 @@ class Attention(nn.Module):
         if self.rope_pt_size is None:
             self.rope_pt_size = self.input_size
         
-        self.compute_cis = partial(
-            compute_axial_cis,
+        self.compute_angles = partial(
+            compute_axial_angles,
             dim=self.head_dim,
             theta=self.rope_theata,
         )
 
+    def _compute_rope_angles(self, input_size: Tuple[int, int]) -> mx.array:
         scale_pos = 1.0
         if self.rope_interp:
-            scale_pos = self.rope_pt_size[0] / self.input_size[0]
-        # get scaled freqs_cis
-        freqs_cis = self.compute_cis(
-            end_x=self.input_size[0],
-            end_y=self.input_size[1],
+            scale_pos = self.rope_pt_size[0] / input_size[0]
+        # get scaled angles
+        angles = self.compute_angles(
+            end_x=input_size[0],
+            end_y=input_size[1],
             scale_pos=scale_pos,
         )
         
         if self.cls_token:
-            t = mx.zeros(
-                self.head_dim // 2,
-                dtype=mx.float32,
-            )
-            cls_freqs_cis = polar(mx.ones_like(t), t)[None, :]
-            freqs_cis = mx.concat([cls_freqs_cis, freqs_cis], axis=0)
+            # The cls token is not rotated
+            cls_angles = mx.zeros((1, self.head_dim // 2), dtype=mx.float32)
+            angles = mx.concat([cls_angles, angles], axis=0)
         
-        self.freqs_cis = freqs_cis
+        return angles
+
+    def _compute_freqs_cis(self, input_size: Tuple[int, int]) -> mx.array:
+        """Complex table of `apply_rotary_enc`, the reference of the real
+        tables used by the blocks."""
+        angles = self._compute_rope_angles(input_size)
+        return polar(mx.ones_like(angles), angles)
+
+    def _compute_rope_tables(self, input_size: Tuple[int, int]) -> Tuple[mx.array, mx.array]:
+        return rope_cos_sin(self._compute_rope_angles(input_size))
+
+    def _get_rope_tables(self, hw: Tuple[int, int]) -> Tuple[mx.array, mx.array]:
+        hw = tuple(hw)
+        scale_pos = self.rope_pt_size[0] / hw[0] if self.rope_interp else 1.0
+        key = ("rope", hw, self.head_dim, self.rope_theata, scale_pos, self.cls_token)
+        return POSITIONAL_BUFFERS.get(key, lambda: self._compute_rope_tables(hw))
         
-    def _apply_rope(self, q, k) -> Tuple[mx.array, mx.array]:
+    def _apply_rope(self, q, k, hw: Optional[Tuple[int, int]] = None) -> Tuple[mx.array, mx.array]:
         if not self.use_rope:
             return q, k
 
-        assert self.freqs_cis is not None
-        return apply_rotary_enc(q, k, freqs_cis=self.freqs_cis)
+        cos, sin = self._get_rope_tables(self.input_size if hw is None else hw)
+        return apply_rotary_real(q, k, cos, sin)
     
     def __call__(self, x: mx.array) -> mx.array:
         s = 1 if self.cls_token else 0
@@ -323,13 +396,18 @@ class Attention(nn.Module):
         q, k, v = qkv[0], qkv[1], qkv[2]
 
         # handle rope and pos embeddings
-        q, k = self._apply_rope(q, k)
+        q, k = self._apply_rope(q, k, (H, W) if ndim == 4 else None)
         if self.use_rel_pos:
             # TODO: Skipping relative positional embeddings for now
             pass
             
         scale = q.shape[-1] ** -0.5
-        x = mx.fast.scaled_dot_product_attention(q, k, v, scale=scale)
+        if self.token_merge_ratio > 0:
+            x = merged_attention(
+                q, k, v, scale, self.token_merge_ratio, memory_cap=self.attention_memory_cap
+            )
+        else:
+            x = attention(q, k, v, scale, memory_cap=self.attention_memory_cap)
         
         if ndim == 4:
             new_shape = (B, self.num_heads, H, W, -1)
@@ -481,6 +559,7 @@ class ViT(nn.Module):
         if isinstance(norm_layer, str):
             norm_layer = partial(getattr(nn, norm_layer), eps=1e-5)
         
+        self.patch_size = patch_size
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
             stride=(patch_size, patch_size),
@@ -556,8 +635,9 @@ class ViT(nn.Module):
         
         self._init_weights(self)
 
-        # TODO: handing compiled mode
-        
+        # Compiled per input resolution, see CompiledFunction
+        self.compile_mode = compile_mode
+        self.compiled = CompiledFunction(self._forward, inputs=self) if compile_mode else None
     
     def _init_weights(self, m: nn.Module) -> None:
         if isinstance(m, nn.Linear):
@@ -569,7 +649,33 @@ class ViT(nn.Module):
             m.bias = mx.zeros_like(m.bias)
 
     def __call__(self, x: mx.array) -> List[mx.array]:
-        x = self.patch_embed(x)
+        abs_pos = None
+        if self.pos_embed is not None:
+            abs_pos = self._get_abs_pos((x.shape[2] // self.patch_size, x.shape[3] // self.patch_size))
+        if self.compiled is not None and not self.training:
+            return self.compiled(x, abs_pos)
+        return self._forward(x, abs_pos)
+
+    def _get_abs_pos(self, hw: Tuple[int, int]) -> mx.array:
+        """The absolute position embedding of a grid of `hw` patches, tiled
+        once per grid and shared through POSITIONAL_BUFFERS."""
+        def compute():
+            return get_abs_pos(
+                self.pos_embed,
+                self.pretrain_use_cls_token,
+                hw,
+                self.retain_cls_token,
+                tiling=self.tile_abs_pos,
+            )
+
+        if self.training:
+            return compute()
+        key = ("abs_pos", hw, self.pos_embed.shape[-1], self.retain_cls_token, self.tile_abs_pos)
+        return POSITIONAL_BUFFERS.get(key, compute, source=self.pos_embed)
+
+    def _forward(self, x: mx.array, abs_pos: Optional[mx.array] = None) -> List[mx.array]:
+        # The trunk runs in the dtype of its weights, see model_builder.cast_model
+        x = self.patch_embed(x.astype(self.patch_embed.proj.weight.dtype))
         h, w = x.shape[1], x.shape[2]
 
         s = 0
@@ -577,14 +683,8 @@ class ViT(nn.Module):
             x = mx.concat([self.class_embedding, x.flatten(1, 2)], dim=1)
             s = 1
         
-        if self.pos_embed is not None:
-            x = x + get_abs_pos(
-                self.pos_embed,
-                self.pretrain_use_cls_token,
-                (h, w),
-                self.retain_cls_token,
-                tiling=self.tile_abs_pos,
-            )
+        if abs_pos is not None:
+            x = x + abs_pos.astype(x.dtype)
         
         x = self.ln_pre(x)
         
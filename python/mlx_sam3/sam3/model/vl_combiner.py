@@ -15,10 +15,14 @@ class SAM3VLBackbone(nn.Module):
         scalp=0
     ):
         super().__init__()
-        # TODO: check if we can compile like they do in PyTorch version
+        # Compiled paths live in the ViT trunk, the text encoder and Sam3Image
+        # (build_sam3_image_model(compile=True)), see CompiledFunction
         self.vision_backbone: Sam3DualViTDetNeck = visual
         self.language_backbone = text
         self.scalp = scalp
+        # The neck skips the scalped levels, see
+        # model_builder.set_inference_mode
+        self.inference_mode = False
         
         # TODO: Learn more about this from pytorch
         self.act_ckpt_whole_vision_backbone = act_ckpt_whole_vision_backbone
@@ -33,9 +37,13 @@ class SAM3VLBackbone(nn.Module):
         )
 
     def _call_image_no_ack_ckpt(self, samples):
-        sam3_features, sam3_pos, sam2_features, sam2_pos = self.vision_backbone(samples)
+        # At inference the neck does not compute the levels scalped below
+        neck_scalp = self.scalp if self.inference_mode and not self.training else 0
+        sam3_features, sam3_pos, sam2_features, sam2_pos = self.vision_backbone(
+            samples, scalp=neck_scalp
+        )
 
-        if self.scalp > 0:
+        if self.scalp > neck_scalp:
             sam3_features, sam3_pos = (
                 sam3_features[: -self.scalp],
                 sam3_pos[: -self.scalp],
@@ -61,8 +69,9 @@ class SAM3VLBackbone(nn.Module):
             "vision_features": sam3_src,
             "vision_pos_enc": sam3_pos,
             "backbone_fpn": sam3_features,
-            "sam2_backbone_out": sam2_output
         }
+        if sam2_output is not None:
+            output["sam2_backbone_out"] = sam2_output
 
         return output
     
@@ -1,10 +1,15 @@
+import json
 import os
+from fnmatch import fnmatch
 
 import mlx.core as mx
 import mlx.nn as nn
+from mlx.utils import tree_map_with_path
 
 from sam3.convert import load_from_hub, download_and_convert, MLX_COMMUNITY_REPO
+from sam3.model.chunked_attention import ATTENTION_MEMORY_CAP
 from sam3.model.sam3_image import Sam3Image
+from sam3.model.token_merging import MAX_MERGE_RATIO
 from sam3.model.text_encoder_ve import VETextEncoder
 from sam3.model.tokenizer_ve import SimpleTokenizer
 from sam3.model.vitdet import ViT
@@ -34,6 +39,8 @@ def _create_position_encoding(precompute_resolution=None):
         scale=None,
         temperature=10000,
         precompute_resolution=precompute_resolution,
+        # ViT patch size 14 at the neck scale factors 4, 2, 1 and 0.5
+        precompute_strides=(3.5, 7, 14, 28),
     )
 
 def _create_vit_backbone(compile_mode=None):
@@ -229,26 +236,29 @@ def _create_sam3_model(
     input_geometry_encoder,
     segmentation_head,
     dot_prod_scoring,
+    compile_mode=None,
 ):
     common_params = {
         "backbone": backbone,
         "transformer": transformer,
         "input_geometry_encoder": input_geometry_encoder,
         "segmentation_head": segmentation_head,
-        "dot_prod_scoring": dot_prod_scoring
+        "dot_prod_scoring": dot_prod_scoring,
+        "compile_mode": compile_mode,
     }
 
     model = Sam3Image(**common_params)
     return model
 
-def _create_text_encoder(bpe_path: str) -> VETextEncoder:
+def _create_text_encoder(bpe_path: str, compile_mode=None) -> VETextEncoder:
     tokenizer = SimpleTokenizer(bpe_path=bpe_path)
     return VETextEncoder(
         tokenizer=tokenizer,
         d_model=256,
         width=1024,
         heads=16,
-        layers=24
+        layers=24,
+        compile_mode=compile_mode,
     )
 
 def _create_vision_backbone(
@@ -272,8 +282,144 @@ def _create_sam3_transformer(has_presence_token: bool = True):
 
     return TransformerWrapper(encoder=encoder, decoder=decoder, d_model=256)
 
+# Modules whose nn.Linear layers `quantize_model` quantizes
+QUANTIZED_MODULES = (
+    "backbone.vision_backbone.trunk",
+    "backbone.language_backbone",
+    "transformer.encoder",
+    "transformer.decoder",
+)
+
+def quantize_model(model, bits=8, group_size=64, exclude=()):
+    """Quantizes the nn.Linear layers of QUANTIZED_MODULES in place, with
+    MLX's affine quantization. Layers whose path matches a glob in `exclude`
+    (e.g. "transformer.decoder.bbox_embed" or "*.out_proj") or lies under a
+    listed module are skipped, as are those whose input width is not a
+    multiple of `group_size`.
+    """
+    def predicate(path, module):
+        if not isinstance(module, nn.Linear):
+            return False
+        if not any(path.startswith(prefix + ".") for prefix in QUANTIZED_MODULES):
+            return False
+        if any(fnmatch(path, pattern) or path.startswith(pattern + ".") for pattern in exclude):
+            return False
+        return module.weight.shape[-1] % group_size == 0
+
+    nn.quantize(model, group_size=group_size, bits=bits, class_predicate=predicate)
+    return model
+
+# Modules `cast_model` casts to half precision
+HALF_PRECISION_MODULES = ("backbone", "transformer")
+
+# Numerically sensitive parameters kept in float32 by `cast_model`: the
+# learned position embedding of the ViT (tiled once, then cast), and the box
+# refinement, box relative position bias and presence heads of the decoder,
+# which read the float32 reference boxes or produce logits
+FLOAT32_MODULES = (
+    "backbone.vision_backbone.trunk.pos_embed",
+    "transformer.decoder.reference_points",
+    "transformer.decoder.bbox_embed",
+    "transformer.decoder.instance_bbox_embed",
+    "transformer.decoder.boxRPB_embed_x",
+    "transformer.decoder.boxRPB_embed_y",
+    "transformer.decoder.presence_token_head",
+    "transformer.decoder.presence_token_out_norm",
+)
+
+def cast_model(model, dtype=mx.bfloat16):
+    """Casts the floating point parameters of HALF_PRECISION_MODULES, except
+    FLOAT32_MODULES, to `dtype` (mx.float16 or mx.bfloat16) in place. The
+    ViT, the text encoder and the transformer then run in `dtype`; attention
+    softmax and layer norm statistics are still accumulated in float32 by
+    the fused kernels, and the geometry encoder, scoring and segmentation
+    heads stay in float32.
+    """
+    def in_modules(path, modules):
+        return any(path == m or path.startswith(m + ".") for m in modules)
+
+    def cast(path, v):
+        if (
+            mx.issubdtype(v.dtype, mx.floating)
+            and in_modules(path, HALF_PRECISION_MODULES)
+            and not in_modules(path, FLOAT32_MODULES)
+        ):
+            return v.astype(dtype)
+        return v
+
+    model.update(tree_map_with_path(cast, model.parameters()))
+    return model
+
+def set_attention_memory_cap(model, memory_cap, modules=None):
+    """Sets the score memory cap of the attention modules under `modules`
+    (paths or globs, e.g. "backbone.vision_backbone.trunk.blocks.7" or
+    "transformer.encoder.*.self_attn"; all of them by default), see
+    chunked_attention.attention. None disables chunking there. Compiled
+    stages do not chunk, and the others only within
+    chunked_attention.bound_attention_memory(), as entered by the blocking
+    Sam3Processor calls and by set_image at resolutions above the cap.
+    """
+    for path, module in model.named_modules():
+        if not hasattr(module, "attention_memory_cap"):
+            continue
+        if modules is None or any(
+            fnmatch(path, pattern) or path.startswith(pattern + ".") for pattern in modules
+        ):
+            module.attention_memory_cap = memory_cap
+    return model
+
+def token_merge_modules(model):
+    """The attention modules token merging targets: the global attention
+    blocks of the ViT and the self-attention of the fusion encoder."""
+    trunk = model.backbone.vision_backbone.trunk
+    return [
+        *(f"backbone.vision_backbone.trunk.blocks.{i}.attn" for i in trunk.full_attn_ids),
+        "transformer.encoder.layers.*.self_attn",
+    ]
+
+def set_token_merge_ratio(model, ratio, modules=None):
+    """Merges `ratio` of the tokens (0 disables it, at most
+    token_merging.MAX_MERGE_RATIO) in the attention modules under `modules`
+    (paths or globs, `token_merge_modules(model)` by default) before
+    attention, see token_merging.merged_attention. Compiled stages keep the
+    ratio their graphs were traced with: set it before their first call.
+    """
+    if not 0 <= ratio <= MAX_MERGE_RATIO:
+        raise ValueError(f"Token merge ratio must be in [0, {MAX_MERGE_RATIO}], got {ratio}")
+    if modules is None:
+        modules = token_merge_modules(model)
+    for path, module in model.named_modules():
+        if not hasattr(module, "token_merge_ratio"):
+            continue
+        if any(fnmatch(path, pattern) or path.startswith(pattern + ".") for pattern in modules):
+            module.token_merge_ratio = ratio
+    return model
+
+def set_inference_mode(model, enabled=True):
+    """Skips the training outputs nothing reads at inference: the decoder
+    computes its scores, boxes and presence for the last layer only, the
+    neck skips the FPN level the backbone drops, and the text encoder embeds
+    the tokens once and does not project the pooled output. The outputs are
+    unchanged. Has no effect in training mode. Compiled stages keep the mode
+    their graphs were traced with: set it before their first call.
+    """
+    for _, module in model.named_modules():
+        if hasattr(module, "inference_mode"):
+            module.inference_mode = enabled
+    return model
+
 def load_checkpoint(model, checkpoint_path):
-    weights = mx.load(checkpoint_path)
+    weights, metadata = mx.load(checkpoint_path, return_metadata=True)
+    if "quantization" in metadata:
+        # Saved by `sam3.convert quantize`: the layers with scales are
+        # quantized before their weights are loaded
+        config = json.loads(metadata["quantization"])
+        nn.quantize(
+            model,
+            group_size=config["group_size"],
+            bits=config["bits"],
+            class_predicate=lambda path, module: f"{path}.scales" in weights,
+        )
     try:
         model.load_weights(weights, strict=False)
         mx.eval(model.parameters())
@@ -300,8 +446,36 @@ def build_sam3_image_model(
     convert_from_pytorch=False,
     enable_segmentation=True,
     enable_inst_interactivity=False,
-    compile=False
+    compile=False,
+    quantize_bits=None,
+    quantize_group_size=64,
+    quantize_exclude=(),
+    dtype=None,
+    attention_memory_cap=ATTENTION_MEMORY_CAP,
+    token_merge_ratio=0.0,
+    inference_mode=True,
 ):
+    """`attention_memory_cap` bounds, in bytes, the attention scores of the
+    ViT, the transformer and the heads where the fused attention kernel is
+    unavailable (e.g. on the CPU), by chunking larger attentions in the
+    blocking Sam3Processor calls; None disables chunking. See
+    `set_attention_memory_cap` to set it per module.
+    `token_merge_ratio` merges that ratio of the image tokens before the
+    global ViT attention and the fusion encoder self-attention, trading
+    accuracy for speed, see `set_token_merge_ratio`.
+    `inference_mode` skips the per-layer decoder outputs, the dropped FPN
+    level and the unused text encoder outputs, see `set_inference_mode`. It
+    is on by default: callers that read the auxiliary decoder outputs in eval
+    mode, e.g. for export, pass False.
+    `dtype` (mx.float16 or mx.bfloat16) runs the ViT, the text encoder and
+    the transformer in half precision, with float32 islands, see
+    `cast_model`.
+    `quantize_bits` (8 or 4) quantizes the linear layers of the ViT, the
+    text encoder and the fusion encoder and decoder after loading, see
+    `quantize_model`.
+    Checkpoints saved by `python -m sam3.convert quantize` or `half` are
+    quantized or cast already and are loaded as such.
+    """
     if bpe_path is None:
         bpe_path = os.path.join(
             os.path.dirname(__file__), "..", "assets", "bpe_simple_vocab_16e6.txt.gz"
@@ -311,7 +485,7 @@ def build_sam3_image_model(
         compile_mode=compile, enable_inst_interactivity=enable_inst_interactivity
     )
     
-    text_encoder = _create_text_encoder(bpe_path)
+    text_encoder = _create_text_encoder(bpe_path, compile_mode=compile)
 
     backbone = _create_vl_backbone(vision_encoder, text_encoder)
 
@@ -332,7 +506,8 @@ def build_sam3_image_model(
         transformer,
         input_geometry_encoder,
         segmentation_head,
-        dot_prod_scoring=dot_product_scoring
+        dot_prod_scoring=dot_product_scoring,
+        compile_mode=compile,
     )
 
     if checkpoint_path is None:
@@ -348,6 +523,18 @@ def build_sam3_image_model(
             )
     
     load_checkpoint(model, f"{checkpoint_path}")
+    if attention_memory_cap != ATTENTION_MEMORY_CAP:
+        set_attention_memory_cap(model, attention_memory_cap)
+    if token_merge_ratio:
+        set_token_merge_ratio(model, token_merge_ratio)
+    if inference_mode:
+        set_inference_mode(model)
+    if dtype is not None:
+        cast_model(model, dtype)
+    if quantize_bits is not None:
+        quantize_model(model, quantize_bits, quantize_group_size, quantize_exclude)
+    if dtype is not None or quantize_bits is not None:
+        mx.eval(model.parameters())
 
     model.eval()
 
@@ -0,0 +1,573 @@
+"""
+Serving helpers shared by the FastAPI backends.
+
+The model is expensive to run and its outputs are a pure function of the
+image, the prompts and the confidence threshold, so the backends key their
+work on those inputs: identical requests in flight share one computation, and
+the already-encoded JSON responses are kept around.
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable, Optional, Sequence
+
+import mlx.core as mx
+from PIL import Image
+
+
+def content_hash(data) -> str:
+    """
+    Hash raw image bytes or a decoded PIL image.
+
+    Args:
+        data: bytes-like object with the encoded file, or a PIL image
+
+    Returns:
+        Hex digest identifying the image content
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(data, Image.Image):
+        h.update(f"{data.mode}:{data.size[0]}x{data.size[1]}:".encode())
+        h.update(data.tobytes())
+    else:
+        h.update(memoryview(data))
+    return h.hexdigest()
+
+
+def normalize_text_prompt(prompt: str) -> str:
+    """Normalize a text prompt the same way the tokenizer does (whitespace and case)."""
+    return " ".join(prompt.split()).lower()
+
+
+def normalize_box_prompts(boxes: Sequence, ndigits: int = 6) -> tuple:
+    """
+    Normalize a sequence of (box, label) prompts into a hashable key.
+
+    Prompt order is kept since geometric prompts are concatenated in order.
+    """
+    return tuple(
+        (tuple(round(float(v), ndigits) for v in box), bool(label))
+        for box, label in boxes
+    )
+
+
+def normalize_outputs(outputs: Optional[Sequence[str]], allowed: Sequence[str], default: Sequence[str]) -> tuple:
+    """
+    Normalize a requested selection of result outputs into a hashable key.
+
+    None selects `default`. Raises a 400 ServingError for names not in `allowed`.
+    """
+    if outputs is None:
+        outputs = default
+    unknown = set(outputs).difference(allowed)
+    if unknown:
+        raise ServingError(400, f"Unknown outputs {sorted(unknown)}, expected a subset of {list(allowed)}")
+    return tuple(sorted(set(outputs)))
+
+
+def encode_fields(**fields) -> bytes:
+    """Encode keyword fields as the members of a JSON object, without the braces."""
+    return json.dumps(fields, separators=(",", ":")).encode()[1:-1]
+
+
+def encode_member(name: str, payload: bytes) -> bytes:
+    """Encode a single JSON object member whose value is already encoded."""
+    return json.dumps(name).encode() + b":" + payload
+
+
+def json_object(*members: bytes) -> bytes:
+    """Join pre-encoded JSON members into one JSON object."""
+    return b"{" + b",".join(m for m in members if m) + b"}"
+
+
+class ResultCache:
+    """
+    LRU cache of encoded response payloads bounded by a byte budget.
+
+    Keys are built by the caller from (image hash, operation, normalized
+    prompts, threshold). Values are the serialized bytes, so a hit costs no
+    model work and no re-encoding.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: Total size of the stored payloads before least recently
+                used entries are evicted. 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key: Hashable, payload: bytes):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= len(old)
+            self._entries[key] = payload
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ServingError(Exception):
+    """An error that maps to an HTTP status for the client."""
+
+    def __init__(self, status_code: int, detail: str, headers: Optional[dict] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.headers = headers
+
+
+class RequestCancelled(ServingError):
+    """The request's deadline passed (504) or its client disconnected (499)."""
+
+
+class Deadline:
+    """
+    A request's deadline and client-disconnect flag.
+
+    `cancelled` and `check` are safe to call from the model worker thread.
+    The disconnect flag is refreshed by whoever awaits `wait()` on the event
+    loop, which polls the request.
+    """
+
+    HEADER = "X-Request-Timeout-Ms"
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, timeout: Optional[float] = None, request=None):
+        """
+        Args:
+            timeout: Seconds from now, or None for no deadline
+            request: Starlette request polled for disconnects, if any
+        """
+        self.expires_at = time.monotonic() + timeout if timeout is not None else None
+        self._request = request
+        self._disconnected = threading.Event()
+
+    @classmethod
+    def from_request(cls, request, default_timeout: Optional[float]) -> "Deadline":
+        """Deadline from the X-Request-Timeout-Ms header, else the server default."""
+        header = request.headers.get(cls.HEADER)
+        timeout = default_timeout
+        if header is not None:
+            try:
+                timeout = max(0.0, float(header) / 1000)
+            except ValueError:
+                raise ServingError(400, f"Invalid {cls.HEADER} header: {header!r}")
+        return cls(timeout, request)
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    @property
+    def disconnected(self) -> bool:
+        return self._disconnected.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.disconnected or self.expired()
+
+    def check(self):
+        """Raise RequestCancelled if the request was abandoned."""
+        if self.disconnected:
+            raise RequestCancelled(499, "Client disconnected")
+        if self.expired():
+            raise RequestCancelled(504, "Request deadline exceeded")
+
+    async def wait(self):
+        """Return once the deadline passes or the client disconnects."""
+        while True:
+            if self.expired():
+                return
+            if self._request is not None and await self._request.is_disconnected():
+                self._disconnected.set()
+                return
+            interval = self.POLL_INTERVAL
+            remaining = self.remaining()
+            if remaining is not None:
+                interval = min(interval, remaining)
+            await asyncio.sleep(interval)
+
+
+class DeadlineGroup:
+    """
+    The deadlines of every request sharing one computation.
+
+    The computation is cancelled only once all of them are; a member of None
+    stands for a caller without a deadline.
+    """
+
+    def __init__(self):
+        self.members: list = []
+
+    def add(self, deadline: Optional[Deadline]):
+        self.members.append(deadline)
+
+    def remaining(self) -> Optional[float]:
+        if not self.members or any(d is None or d.expires_at is None for d in self.members):
+            return None
+        return max(d.remaining() for d in self.members)
+
+    @property
+    def cancelled(self) -> bool:
+        return bool(self.members) and all(d is not None and d.cancelled for d in self.members)
+
+    def check(self):
+        if self.cancelled:
+            if all(d.disconnected for d in self.members):
+                raise RequestCancelled(499, "Client disconnected")
+            raise RequestCancelled(504, "Request deadline exceeded")
+
+
+class ModelWorker:
+    """
+    Runs model calls on a single dedicated thread.
+
+    Keeps the event loop free while the model runs, and serializes access to
+    the model and to the per-image states it mutates.
+    """
+
+    def __init__(self, name: str = "sam3-model"):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, fn: Callable, *args, deadline=None, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` on the worker thread.
+
+        With a `deadline` (Deadline or DeadlineGroup), work that was abandoned
+        while queued is dropped before it reaches the model.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._call, fn, args, kwargs, deadline)
+        )
+
+    @staticmethod
+    def _call(fn, args, kwargs, deadline):
+        if deadline is not None:
+            deadline.check()
+        return fn(*args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller starts the computation as its own task; callers arriving
+    while it is in flight await the same task. A caller that goes away stops
+    waiting without cancelling the computation for the others; the
+    computation sees the callers' deadlines as one DeadlineGroup, which is
+    cancelled once every caller is gone.
+    """
+
+    def __init__(self):
+        self._inflight: dict = {}
+        self._groups: dict = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def run(
+        self,
+        key: Hashable,
+        fn: Callable[[DeadlineGroup], Awaitable],
+        deadline: Optional[Deadline] = None,
+    ):
+        """
+        Args:
+            key: Identity of the computation, e.g. (image hash, operation, prompt)
+            fn: Coroutine function doing the work, called with the DeadlineGroup
+                of all the callers
+            deadline: This caller's deadline; it stops waiting once it passes
+
+        Returns:
+            The result of the (possibly shared) computation
+        """
+        while True:
+            task = self._inflight.get(key)
+            if task is None or task.done():
+                group = DeadlineGroup()
+                group.add(deadline)
+                task = asyncio.ensure_future(fn(group))
+                self._inflight[key] = task
+                self._groups[key] = group
+                task.add_done_callback(functools.partial(self._done, key))
+                self.executions += 1
+            else:
+                self._groups[key].add(deadline)
+                self.coalesced += 1
+
+            if deadline is None:
+                await asyncio.wait({task})
+            else:
+                waiter = asyncio.ensure_future(deadline.wait())
+                try:
+                    await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if not task.done():
+                    self.abandoned += 1
+                    deadline.check()
+                    raise RequestCancelled(504, "Request deadline exceeded")
+
+            try:
+                return task.result()
+            except RequestCancelled:
+                # Everyone else abandoned the computation before this caller
+                # joined it; run it again unless this caller is gone too
+                if deadline is not None and deadline.cancelled:
+                    raise
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._groups[key]
+        # Mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+class AdmissionRejected(ServingError):
+    """Raised when a request cannot be admitted."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int] = None):
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+        super().__init__(status_code, detail, headers)
+        self.retry_after = retry_after
+
+
+def default_memory_budget() -> int:
+    """Three quarters of the device's recommended working set (or MLX memory limit)."""
+    info = mx.device_info()
+    total = info.get("max_recommended_working_set_size") or info.get("memory_size")
+    if not total:
+        total = mx.get_memory_limit()
+    return int(0.75 * total)
+
+
+class AdmissionController:
+    """
+    Admission control for model work based on predicted memory and queue depth.
+
+    Each request's memory cost is estimated from its operation and image size.
+    A request runs only while the current MLX active memory, plus the
+    reservations of admitted requests, plus its own cost fits the budget, and
+    no more than `max_active` requests are admitted at once. Others wait in a
+    bounded queue; when the queue is full or the wait times out the request is
+    rejected with a Retry-After hint.
+    """
+
+    # Transient bytes of one pass at the model resolution, independent of the
+    # image size. For segment this includes the decoder-resolution mask logits
+    # of every query, which LazyMasks keeps instead of full-resolution masks.
+    BASE_COST = {
+        "set_image": 1536 * 1024 * 1024,
+        "segment": 512 * 1024 * 1024,
+    }
+    # Bytes per input pixel: decoding for set_image. For segment, the semantic
+    # map upsampled to the image (float32 on device and host, bool and uint8 to
+    # encode), and one kept mask crop at a time (float32 logits, bool on device
+    # and host, uint8 to encode), which is at most the whole image.
+    PIXEL_COST = {
+        "set_image": 3 + 3 * 4,
+        "segment": (4 + 4 + 1 + 1) + (4 + 1 + 1 + 1),
+    }
+
+    def __init__(
+        self,
+        memory_budget: Optional[int] = None,
+        max_active: int = 2,
+        max_queue: int = 16,
+        queue_timeout: float = 30.0,
+    ):
+        """
+        Args:
+            memory_budget: Bytes of MLX memory admitted work may use. Defaults
+                to `default_memory_budget()`, queried on first use so that
+                creating a controller at import does not touch the device.
+            max_active: Requests admitted (running or handed to the model worker) at once
+            max_queue: Requests allowed to wait for admission before rejecting
+            queue_timeout: Seconds a request may wait before being rejected
+        """
+        self._memory_budget = memory_budget
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond: Optional[asyncio.Condition] = None
+        self._active = 0
+        self._waiting = 0
+        self._reserved = 0
+        # Moving average of seconds per admitted request, for Retry-After
+        self._avg_seconds = 1.0
+
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0, "too_large": 0}
+
+    @property
+    def memory_budget(self) -> int:
+        if not self._memory_budget:
+            self._memory_budget = default_memory_budget()
+        return self._memory_budget
+
+    def estimate(self, operation: str, width: int, height: int) -> int:
+        """Predicted peak memory in bytes of running `operation` on a width x height image."""
+        return self.BASE_COST[operation] + self.PIXEL_COST[operation] * width * height
+
+    def _fits(self, cost: int) -> bool:
+        if self._active >= self.max_active:
+            return False
+        # Always let one request through when nothing else is admitted
+        if self._active == 0:
+            return True
+        return mx.get_active_memory() + self._reserved + cost <= self.memory_budget
+
+    def _retry_after(self) -> int:
+        pending = self._active + self._waiting + 1
+        return max(1, math.ceil(self._avg_seconds * pending))
+
+    @asynccontextmanager
+    async def admit(self, operation: str, width: int, height: int, deadline=None):
+        """
+        Wait until the request fits, hold its reservation for the duration of the block.
+
+        A `deadline` (Deadline or DeadlineGroup) bounds the wait, and abandoned
+        requests leave the queue as soon as they are noticed.
+        """
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        cost = self.estimate(operation, width, height)
+        if cost > self.memory_budget:
+            self.rejected["too_large"] += 1
+            raise AdmissionRejected(
+                413, f"Image of {width}x{height} exceeds the memory budget for {operation}"
+            )
+
+        async with self._cond:
+            if not self._fits(cost):
+                if self._waiting >= self.max_queue:
+                    self.rejected["queue_full"] += 1
+                    raise AdmissionRejected(503, "Server is busy", self._retry_after())
+                timeout = self.queue_timeout
+                remaining = deadline.remaining() if deadline is not None else None
+                if remaining is not None and remaining < timeout:
+                    timeout = remaining
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(
+                            lambda: self._fits(cost)
+                            or (deadline is not None and deadline.cancelled)
+                        ),
+                        timeout,
+                    )
+                except asyncio.TimeoutError:
+                    if deadline is not None and deadline.cancelled:
+                        deadline.check()
+                    self.rejected["timeout"] += 1
+                    raise AdmissionRejected(503, "Server is busy", self._retry_after())
+                finally:
+                    self._waiting -= 1
+                if deadline is not None:
+                    deadline.check()
+            self._active += 1
+            self._reserved += cost
+            self.admitted += 1
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+            async with self._cond:
+                self._active -= 1
+                self._reserved -= cost
+                self._cond.notify_all()
+
+    async def run(
+        self, operation: str, width: int, height: int, fn: Callable[[], Awaitable], deadline=None
+    ):
+        """Run `fn` once admitted."""
+        async with self.admit(operation, width, height, deadline):
+            return await fn()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._waiting,
+            "active": self._active,
+            "reserved_bytes": self._reserved,
+            "memory_budget": self.memory_budget,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
@@ -1,9 +1 @@
-import torch
 import mlx.core as mx
-from huggingface_hub import hf_hub_download
-
-
-
-
-    
-
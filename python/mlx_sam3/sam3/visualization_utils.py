@@ -2,25 +2,19 @@ import mlx.core as mx
 import numpy as np
 
 from PIL import Image
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
-from matplotlib.colors import to_rgb
-from skimage.color import lab2rgb, rgb2lab
-from sklearn.cluster import KMeans
 
 def generate_colors(n_colors=256, n_samples=5000):
+    from skimage.color import lab2rgb, rgb2lab
+    from sklearn.cluster import KMeans
+
     # Step 1: Random RGB samples
     np.random.seed(42)
     rgb = np.random.rand(n_samples, 3)
     # Step 2: Convert to LAB for perceptual uniformity
-    # print(f"Converting {n_samples} RGB samples to LAB color space...")
     lab = rgb2lab(rgb.reshape(1, -1, 3)).reshape(-1, 3)
-    # print("Conversion to LAB complete.")
     # Step 3: k-means clustering in LAB
     kmeans = KMeans(n_clusters=n_colors, n_init=10)
-    # print(f"Fitting KMeans with {n_colors} clusters on {n_samples} samples...")
     kmeans.fit(lab)
-    # print("KMeans fitting complete.")
     centers_lab = kmeans.cluster_centers_
     # Step 4: Convert LAB back to RGB
     colors_rgb = lab2rgb(centers_lab.reshape(1, -1, 3)).reshape(-1, 3)
@@ -28,7 +22,42 @@ def generate_colors(n_colors=256, n_samples=5000):
     return colors_rgb
 
 
-COLORS = generate_colors(n_colors=128, n_samples=5000)
+# generate_colors(n_colors=128, n_samples=5000), precomputed to keep
+# scikit-learn and scikit-image out of the import
+COLORS = np.array([
+    (0.9181, 0.1592, 0.1127), (0.2426, 0.4811, 0.6301), (0.6801, 0.8243, 0.1774), (0.4911, 0.1246, 0.6454),
+    (0.6987, 0.5937, 0.3546), (0.5019, 0.1197, 0.2858), (0.2924, 0.9238, 0.6538), (0.2586, 0.9470, 0.1473),
+    (0.5550, 0.5247, 0.6434), (0.4511, 0.3717, 0.6158), (0.2094, 0.0828, 0.2551), (0.2262, 0.1744, 0.8931),
+    (0.2152, 0.7196, 0.7610), (0.1680, 0.5236, 0.1002), (0.9232, 0.1792, 0.6756), (0.6399, 0.2604, 0.1259),
+    (0.8836, 0.1259, 0.9381), (0.3448, 0.2476, 0.1697), (0.2215, 0.3736, 0.8860), (0.6509, 0.8755, 0.8467),
+    (0.9085, 0.1441, 0.4519), (0.8384, 0.5232, 0.1386), (0.3830, 0.4933, 0.1053), (0.2284, 0.8957, 0.4727),
+    (0.7813, 0.9144, 0.6523), (0.1441, 0.0772, 0.4276), (0.8375, 0.4283, 0.7325), (0.7837, 0.6005, 0.1694),
+    (0.2996, 0.6310, 0.4402), (0.9066, 0.8608, 0.1751), (0.1251, 0.2473, 0.0843), (0.9113, 0.6375, 0.7800),
+    (0.1350, 0.1744, 0.1521), (0.1977, 0.5713, 0.8803), (0.6056, 0.9296, 0.1499), (0.4421, 0.1335, 0.7977),
+    (0.8555, 0.5536, 0.4857), (0.4957, 0.4233, 0.9158), (0.5547, 0.9105, 0.8135), (0.7060, 0.1706, 0.3432),
+    (0.2360, 0.6666, 0.8879), (0.4462, 0.6401, 0.1312), (0.5187, 0.9083, 0.5181), (0.3623, 0.3453, 0.1038),
+    (0.7403, 0.5026, 0.8559), (0.5815, 0.5221, 0.1182), (0.2097, 0.1281, 0.6162), (0.1725, 0.7421, 0.1721),
+    (0.7839, 0.2168, 0.1170), (0.8461, 0.9530, 0.1780), (0.8550, 0.7991, 0.3378), (0.8290, 0.3308, 0.5391),
+    (0.8571, 0.7134, 0.6017), (0.8617, 0.8799, 0.7603), (0.7026, 0.1522, 0.6529), (0.2355, 0.3805, 0.4581),
+    (0.1914, 0.5172, 0.5183), (0.1997, 0.2297, 0.4876), (0.4833, 0.5319, 0.3312), (0.7122, 0.1187, 0.1970),
+    (0.5763, 0.8120, 0.3997), (0.3856, 0.8628, 0.9251), (0.9045, 0.1734, 0.8176), (0.1951, 0.4165, 0.1410),
+    (0.2295, 0.6956, 0.2614), (0.4231, 0.1448, 0.1255), (0.5813, 0.3751, 0.4404), (0.8268, 0.1614, 0.5315),
+    (0.2099, 0.5895, 0.2992), (0.4233, 0.5129, 0.4349), (0.8155, 0.2978, 0.9048), (0.8596, 0.4521, 0.2666),
+    (0.6434, 0.7585, 0.8915), (0.3224, 0.2667, 0.6578), (0.2139, 0.0752, 0.6982), (0.4163, 0.4705, 0.7936),
+    (0.5824, 0.6577, 0.6273), (0.5770, 0.6756, 0.3621), (0.3585, 0.1371, 0.3795), (0.1733, 0.3847, 0.7070),
+    (0.9164, 0.3864, 0.3711), (0.2185, 0.9410, 0.3566), (0.2479, 0.9233, 0.7974), (0.8456, 0.4724, 0.6099),
+    (0.1390, 0.4725, 0.3163), (0.2284, 0.7416, 0.4479), (0.2851, 0.8492, 0.1516), (0.7234, 0.9310, 0.3961),
+    (0.8473, 0.5783, 0.3248), (0.5329, 0.1026, 0.1137), (0.6041, 0.3859, 0.8416), (0.5974, 0.5681, 0.9379),
+    (0.2566, 0.0984, 0.1265), (0.6112, 0.3208, 0.5488), (0.2346, 0.4486, 0.8609), (0.4491, 0.7966, 0.9236),
+    (0.4262, 0.1237, 0.5083), (0.8276, 0.8372, 0.8663), (0.6001, 0.1315, 0.4592), (0.0948, 0.1058, 0.1969),
+    (0.8329, 0.6422, 0.8883), (0.3466, 0.6985, 0.6181), (0.8375, 0.4365, 0.4483), (0.5777, 0.3580, 0.1559),
+    (0.5866, 0.4644, 0.3856), (0.2674, 0.2742, 0.8708), (0.1507, 0.3503, 0.3087), (0.6641, 0.1149, 0.8383),
+    (0.7027, 0.7237, 0.1637), (0.9074, 0.8433, 0.5583), (0.5520, 0.8621, 0.6058), (0.2079, 0.7778, 0.6175),
+    (0.9152, 0.3868, 0.1016), (0.2555, 0.8863, 0.8755), (0.6038, 0.1197, 0.9561), (0.2661, 0.0845, 0.9376),
+    (0.3963, 0.7347, 0.1178), (0.8720, 0.7284, 0.7877), (0.8420, 0.8937, 0.4659), (0.5803, 0.2931, 0.8745),
+    (0.5670, 0.6514, 0.9207), (0.1765, 0.3459, 0.5578), (0.2692, 0.6290, 0.7402), (0.9267, 0.7247, 0.1833),
+    (0.4833, 0.9149, 0.3687), (0.3381, 0.2821, 0.3728), (0.8677, 0.4457, 0.8827), (0.8935, 0.1616, 0.3145),
+])
 
 def draw_box_on_image(image, box, color=(0, 255, 0)):
     """
@@ -94,6 +123,9 @@ def plot_bbox(
         y *= img_height
         h *= img_height
 
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+
     if ax is None:
         ax = plt.gca()
     rect = patches.Rectangle(
@@ -119,6 +151,9 @@ def plot_bbox(
         )
 
 def plot_mask(mask, color="r", ax=None):
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import to_rgb
+
     im_h, im_w = mask.shape
     mask_img = np.zeros((im_h, im_w, 4), dtype=np.float32)
     mask_img[..., :3] = to_rgb(color)
@@ -154,6 +189,8 @@ def normalize_bbox(bbox_xywh, img_w, img_h):
     return normalized_bbox
 
 def plot_results(img, results):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(12, 8))
     plt.imshow(img)
     # Convert MLX tensors to NumPy so Matplotlib gets plain Python scalars
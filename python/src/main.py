@@ -1,9 +1,28 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+from PIL import Image
 from pydantic import BaseModel
 from typing import Optional
 import io
 
+import mlx.core as mx
+
+from sam3.serving import (
+    AdmissionController,
+    Deadline,
+    ModelWorker,
+    ResultCache,
+    ServingError,
+    SingleFlight,
+    content_hash,
+    encode_fields,
+    json_object,
+    normalize_box_prompts,
+    normalize_outputs,
+    normalize_text_prompt,
+)
+
 from .sam_service import SAMService
 from .video_service import VideoService
 
@@ -26,6 +45,24 @@ app.add_middleware(
 sam_service: Optional[SAMService] = None
 video_service: Optional[VideoService] = None
 
+# Encoded segmentation results keyed by (image hash, operation, prompt, threshold)
+RESULT_CACHE_BYTES = 256 * 1024 * 1024
+result_cache = ResultCache(max_bytes=RESULT_CACHE_BYTES)
+
+# SAMService calls run on one model thread; identical concurrent requests share a call
+model_worker = ModelWorker()
+inflight = SingleFlight()
+
+# Bounds the model work admitted at once by predicted memory and queue depth
+admission = AdmissionController()
+
+# Seconds a request may take unless it sends an X-Request-Timeout-Ms header
+REQUEST_TIMEOUT_S = 120.0
+
+# Results a segment request may select with `outputs`, and the default selection
+RESPONSE_OUTPUTS = ("boxes", "scores", "masks", "semantic_seg")
+DEFAULT_OUTPUTS = ("boxes", "scores", "masks")
+
 
 def get_sam_service() -> SAMService:
     global sam_service
@@ -41,13 +78,41 @@ def get_video_service() -> VideoService:
     return video_service
 
 
+def _encode_prediction(service: SAMService, masks: list[dict], outputs: tuple, **fields) -> bytes:
+    """Encode the detections, plus the semantic mask if it was selected."""
+    if "semantic_seg" in outputs:
+        fields["semantic_mask"] = service.semantic_mask()
+    return encode_fields(**fields, masks=masks)
+
+
+def _predict_text(service: SAMService, prompt: str, outputs: tuple, deadline) -> bytes:
+    """Run, encode and cache a text prediction. Runs on the model worker."""
+    # Keyed here since a queued set-image may have changed the current image
+    key = service.result_key("text", (normalize_text_prompt(prompt), outputs))
+    masks = service.predict_with_text(prompt, cancel_check=deadline.check, outputs=outputs)
+    payload = _encode_prediction(service, masks, outputs, count=len(masks))
+    result_cache.put(key, payload)
+    return payload
+
+
+def _predict_box(service: SAMService, box: list[float], label: int, outputs: tuple, deadline) -> bytes:
+    """Run, encode and cache a box prediction. Runs on the model worker."""
+    key = service.result_key("box", (normalize_box_prompts([(box, label)]), outputs))
+    masks = service.predict_with_box(box, label, cancel_check=deadline.check, outputs=outputs)
+    payload = _encode_prediction(service, masks, outputs)
+    result_cache.put(key, payload)
+    return payload
+
+
 class SegmentTextRequest(BaseModel):
     prompt: str  # e.g., "cat", "red car", "person"
+    outputs: Optional[list[str]] = None  # subset of RESPONSE_OUTPUTS
 
 
 class SegmentBoxRequest(BaseModel):
     box: list[float]  # [x1, y1, x2, y2]
     label: int = 1  # 1 = include (foreground), 0 = exclude (background)
+    outputs: Optional[list[str]] = None  # subset of RESPONSE_OUTPUTS
 
 
 class SetFrameRequest(BaseModel):
@@ -64,32 +129,68 @@ async def health_check():
     return {"status": "healthy", "platform": "Apple Silicon (MLX)"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Admission, cache and memory counters."""
+    return {
+        "admission": admission.stats(),
+        "result_cache": result_cache.stats(),
+        "single_flight": inflight.stats(),
+        "memory": {
+            "active_bytes": mx.get_active_memory(),
+            "peak_bytes": mx.get_peak_memory(),
+            "cache_bytes": mx.get_cache_memory(),
+        },
+    }
+
+
+def _serving_error(e: ServingError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+
 # ============== Image Endpoints ==============
 
 @app.post("/api/set-image")
-async def set_image(file: UploadFile = File(...)):
+async def set_image(http_request: Request, file: UploadFile = File(...)):
     """Upload an image to be segmented."""
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
     try:
+        deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
         contents = await file.read()
         image_bytes = io.BytesIO(contents)
+        image_hash = content_hash(contents)
+        # Only reads the header, the image is decoded on the model worker
+        width, height = Image.open(io.BytesIO(contents)).size
 
         service = get_sam_service()
-        image_shape = service.set_image(image_bytes)
+        image_shape = await inflight.run(
+            ("set_image", image_hash),
+            lambda group: admission.run(
+                "set_image", width, height,
+                lambda: model_worker.run(
+                    service.set_image, image_bytes,
+                    image_hash=image_hash, cancel_check=group.check, deadline=group,
+                ),
+                deadline=group,
+            ),
+            deadline=deadline,
+        )
 
         return {
             "status": "ok",
             "message": "Image loaded successfully",
             "image_shape": image_shape,
         }
+    except ServingError as e:
+        raise _serving_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/segment/text")
-async def segment_with_text(request: SegmentTextRequest):
+async def segment_with_text(request: SegmentTextRequest, http_request: Request):
     """
     Generate segmentation masks from a text prompt.
 
@@ -102,19 +203,35 @@ async def segment_with_text(request: SegmentTextRequest):
         raise HTTPException(status_code=400, detail="No image set. Upload an image first.")
 
     try:
-        masks = service.predict_with_text(request.prompt)
-        return {
-            "status": "ok",
-            "prompt": request.prompt,
-            "count": len(masks),
-            "masks": masks,
-        }
+        outputs = normalize_outputs(request.outputs, RESPONSE_OUTPUTS, DEFAULT_OUTPUTS)
+        key = service.result_key("text", (normalize_text_prompt(request.prompt), outputs))
+        payload = result_cache.get(key)
+        if payload is None:
+            deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+            width, height = service.image_size
+            payload = await inflight.run(
+                key,
+                lambda group: admission.run(
+                    "segment", width, height,
+                    lambda: model_worker.run(
+                        _predict_text, service, request.prompt, outputs, group, deadline=group
+                    ),
+                    deadline=group,
+                ),
+                deadline=deadline,
+            )
+        return Response(
+            json_object(encode_fields(status="ok", prompt=request.prompt), payload),
+            media_type="application/json",
+        )
+    except ServingError as e:
+        raise _serving_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/segment/box")
-async def segment_with_box(request: SegmentBoxRequest):
+async def segment_with_box(request: SegmentBoxRequest, http_request: Request):
     """Generate segmentation mask from a bounding box prompt."""
     service = get_sam_service()
 
@@ -125,11 +242,29 @@ async def segment_with_box(request: SegmentBoxRequest):
         raise HTTPException(status_code=400, detail="Box must have 4 values: [x1, y1, x2, y2]")
 
     try:
-        masks = service.predict_with_box(request.box, request.label)
-        return {
-            "status": "ok",
-            "masks": masks,
-        }
+        outputs = normalize_outputs(request.outputs, RESPONSE_OUTPUTS, DEFAULT_OUTPUTS)
+        key = service.result_key("box", (normalize_box_prompts([(request.box, request.label)]), outputs))
+        payload = result_cache.get(key)
+        if payload is None:
+            deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+            width, height = service.image_size
+            payload = await inflight.run(
+                key,
+                lambda group: admission.run(
+                    "segment", width, height,
+                    lambda: model_worker.run(
+                        _predict_box, service, request.box, request.label, outputs, group, deadline=group
+                    ),
+                    deadline=group,
+                ),
+                deadline=deadline,
+            )
+        return Response(
+            json_object(encode_fields(status="ok"), payload),
+            media_type="application/json",
+        )
+    except ServingError as e:
+        raise _serving_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -193,7 +328,7 @@ async def get_video_thumbnails(count: int = 10):
 
 
 @app.post("/api/video/set-frame")
-async def set_video_frame_for_segmentation(request: SetFrameRequest):
+async def set_video_frame_for_segmentation(request: SetFrameRequest, http_request: Request):
     """Set a specific video frame as the current image for segmentation."""
     vs = get_video_service()
     sam = get_sam_service()
@@ -206,7 +341,14 @@ async def set_video_frame_for_segmentation(request: SetFrameRequest):
         pil_image = vs.get_frame_as_pil(request.frame_index)
 
         # Set it as the current image in SAM service
-        image_shape = sam.set_image(pil_image)
+        deadline = Deadline.from_request(http_request, REQUEST_TIMEOUT_S)
+        image_shape = await admission.run(
+            "set_image", pil_image.width, pil_image.height,
+            lambda: model_worker.run(
+                sam.set_image, pil_image, cancel_check=deadline.check, deadline=deadline
+            ),
+            deadline=deadline,
+        )
 
         return {
             "status": "ok",
@@ -214,6 +356,8 @@ async def set_video_frame_for_segmentation(request: SetFrameRequest):
             "frame_index": request.frame_index,
             "image_shape": image_shape,
         }
+    except ServingError as e:
+        raise _serving_error(e)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
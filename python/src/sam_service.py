@@ -15,6 +15,7 @@ from PIL import Image
 # MLX SAM3 imports
 from sam3 import build_sam3_image_model
 from sam3.model.sam3_image_processor import Sam3Processor
+from sam3.serving import content_hash
 
 
 def to_python(obj: Any) -> Any:
@@ -52,6 +53,8 @@ class SAMService:
         self.processor: Optional[Sam3Processor] = None
         self.inference_state = None
         self.current_image: Optional[Image.Image] = None
+        self.image_size: Optional[tuple[int, int]] = None
+        self.image_hash: Optional[str] = None
         self._model_loaded = False
 
     def _load_model(self):
@@ -65,12 +68,14 @@ class SAMService:
         self._model_loaded = True
         print("MLX SAM 3 model loaded successfully.")
 
-    def set_image(self, image_input) -> dict:
+    def set_image(self, image_input, image_hash: Optional[str] = None, cancel_check=None) -> dict:
         """
         Set the image for segmentation.
 
         Args:
             image_input: PIL Image, numpy array, or file-like object
+            image_hash: Precomputed `content_hash` of the input, if known
+            cancel_check: Optional callable raising to abandon the call between stages
 
         Returns:
             dict with image shape info
@@ -80,16 +85,26 @@ class SAMService:
         # Load image
         if isinstance(image_input, np.ndarray):
             image = Image.fromarray(image_input).convert("RGB")
+            image_hash = image_hash or content_hash(image)
         elif isinstance(image_input, Image.Image):
             image = image_input.convert("RGB")
+            image_hash = image_hash or content_hash(image)
         else:
             # Assume file-like object
-            image = Image.open(image_input).convert("RGB")
+            data = image_input.getvalue() if hasattr(image_input, "getvalue") else image_input.read()
+            image_hash = image_hash or content_hash(data)
+            # Left undecoded so the processor can decode JPEGs at a reduced scale
+            image = Image.open(io.BytesIO(data))
 
+        width, height = image.size
+
+        # Re-setting the image that is already loaded needs no backbone pass
+        if image_hash != self.image_hash or self.inference_state is None:
+            self.inference_state = self.processor.set_image(image, cancel_check=cancel_check)
         self.current_image = image
-        self.inference_state = self.processor.set_image(image)
+        self.image_size = (width, height)
+        self.image_hash = image_hash
 
-        width, height = image.size
         return {
             "height": height,
             "width": width,
@@ -100,12 +115,27 @@ class SAMService:
         """Check if an image is currently set."""
         return self.current_image is not None and self.inference_state is not None
 
-    def predict_with_text(self, text_prompt: str) -> list[dict]:
+    def result_key(self, operation: str, prompt) -> tuple:
+        """
+        Key identifying the result of a prediction on the current image.
+
+        Args:
+            operation: Prediction kind, e.g. "text" or "box"
+            prompt: Normalized, hashable prompt
+
+        Returns:
+            (image hash, operation, prompt, confidence threshold)
+        """
+        return (self.image_hash, operation, prompt, self.confidence_threshold)
+
+    def predict_with_text(self, text_prompt: str, cancel_check=None, outputs=None) -> list[dict]:
         """
         Generate segmentation masks from a text prompt.
 
         Args:
             text_prompt: Text description of what to segment (e.g., "cat", "red car", "person")
+            cancel_check: Optional callable raising to abandon the call between stages
+            outputs: Optional subset of "boxes", "scores", "masks", "semantic_seg" to compute
 
         Returns:
             List of mask dictionaries with base64 data and metadata
@@ -113,53 +143,26 @@ class SAMService:
         if not self.has_image():
             raise ValueError("No image set")
 
-        # Run text prompt segmentation
-        self.inference_state = self.processor.set_text_prompt(
+        # Run text prompt segmentation, replacing any previous prompt (e.g. a
+        # box) so that the result only depends on the text
+        self.inference_state = self.processor.set_prompts(
             text_prompt,
-            self.inference_state
+            [],
+            self.inference_state,
+            cancel_check=cancel_check,
+            outputs=outputs,
         )
+        return self._detections()
 
-        # Get results and convert to Python types
-        masks = self.inference_state.get("masks", [])
-        boxes = self.inference_state.get("boxes", [])
-        scores = self.inference_state.get("scores", [])
-
-        # Convert to Python native types
-        masks = to_python(masks)
-        boxes = to_python(boxes)
-        scores = to_python(scores)
-
-        # Handle case where scores might be a single value or list
-        if not isinstance(scores, list):
-            scores = [scores] if scores is not None else []
-
-        results = []
-        for i in range(len(masks)):
-            mask = masks[i] if i < len(masks) else None
-            box = boxes[i] if i < len(boxes) else None
-            score = scores[i] if i < len(scores) else 1.0
-
-            if mask is None:
-                continue
-
-            # Convert mask to numpy array for encoding
-            mask_np = np.array(mask)
-
-            results.append({
-                "mask": self._mask_to_base64(mask_np),
-                "bbox": box,
-                "score": float(score) if score is not None else 1.0,
-            })
-
-        return results
-
-    def predict_with_box(self, box: list[float], label: int = 1) -> list[dict]:
+    def predict_with_box(self, box: list[float], label: int = 1, cancel_check=None, outputs=None) -> list[dict]:
         """
         Generate segmentation masks from a bounding box prompt.
 
         Args:
             box: Bounding box as [x1, y1, x2, y2]
             label: 1 for include (foreground), 0 for exclude (background)
+            cancel_check: Optional callable raising to abandon the call between stages
+            outputs: Optional subset of "boxes", "scores", "masks", "semantic_seg" to compute
 
         Returns:
             List of mask dictionaries with base64 data
@@ -167,36 +170,57 @@ class SAMService:
         if not self.has_image():
             raise ValueError("No image set")
 
-        # Run box prompt segmentation
-        self.inference_state = self.processor.set_box_prompt(
-            boxes=[box],
-            labels=[label],
-            state=self.inference_state
+        # The processor takes normalized [center_x, center_y, width, height] boxes
+        width, height = self.image_size
+        x1, y1, x2, y2 = box
+        normalized = [(x1 + x2) / 2 / width, (y1 + y2) / 2 / height, (x2 - x1) / width, (y2 - y1) / height]
+
+        # Run box prompt segmentation, replacing any previous prompt
+        self.inference_state = self.processor.set_prompts(
+            None,
+            [(normalized, bool(label))],
+            self.inference_state,
+            cancel_check=cancel_check,
+            outputs=outputs,
         )
+        return self._detections()
 
-        masks = self.inference_state.get("masks", [])
-        scores = self.inference_state.get("scores", [])
-
-        # Convert to Python types
-        masks = to_python(masks)
-        scores = to_python(scores)
+    def _detections(self) -> list[dict]:
+        """Per-detection results of the last prediction, with the outputs it computed."""
+        state = self.inference_state
+        fields = {"mask": "masks", "bbox": "boxes", "score": "scores"}
+        fields = {name: key for name, key in fields.items() if key in state}
+        if not fields:
+            return []
 
-        if not isinstance(scores, list):
-            scores = [scores] if scores is not None else [1.0]
+        # Masks are upsampled one at a time, see LazyMasks
+        values = {name: state[key] if name == "mask" else to_python(state[key]) for name, key in fields.items()}
+        count = len(next(iter(values.values())))
 
         results = []
-        for i, mask in enumerate(masks):
-            mask_np = np.array(mask)
-            score = scores[i] if i < len(scores) else 1.0
-
-            results.append({
-                "mask": self._mask_to_base64(mask_np),
-                "bbox": box,
-                "score": float(score) if score is not None else 1.0,
-            })
+        for i in range(count):
+            detection = {}
+            if "mask" in values:
+                detection["mask"] = self._mask_to_base64(np.array(values["mask"][i]))
+            if "bbox" in values:
+                detection["bbox"] = values["bbox"][i]
+            if "score" in values:
+                detection["score"] = float(values["score"][i])
+            results.append(detection)
 
         return results
 
+    def semantic_mask(self) -> Optional[str]:
+        """Semantic mask of the last prediction as base64 PNG, if it was computed."""
+        if not self.inference_state or "semantic_seg" not in self.inference_state:
+            return None
+        semantic_seg = self.inference_state["semantic_seg"]
+        if semantic_seg is None:
+            # Gated by the presence score, see Sam3Processor: nothing is positive
+            state = self.inference_state
+            return self._mask_to_base64(np.zeros((state["original_height"], state["original_width"]), dtype=bool))
+        return self._mask_to_base64(np.array(semantic_seg[0, 0]) > 0)
+
     def _mask_to_base64(self, mask: np.ndarray) -> str:
         """Convert a numpy mask to base64-encoded PNG."""
         # Handle different mask shapes